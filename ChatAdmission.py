@@ -0,0 +1,183 @@
+# ChatAdmission.py
+"""
+Connection admission and per-client rate limits for ChatServer.
+
+AdmissionControl decides whether an accepted connection may stay: it caps the
+number of concurrent connections overall and per client IP, with one dict
+lookup and two counter updates under a lock per connect and disconnect.
+Clients that are admitted get a ClientLimiter, a pair of token buckets (messages
+per second and bytes per second) that every incoming frame must pass before the
+server routes or broadcasts it. A bucket refills lazily from the elapsed time
+when it is checked, so the per-message cost is a clock read and a few float
+operations, with no timers and no lock (each client's frames are handled by
+one thread or by the event loop).
+
+Frames over the limit are dropped. The client is told once per limiting
+episode with an error frame, so a flood does not turn into a flood of errors.
+"""
+
+import socket
+import threading
+import time
+
+from ChatMetrics import CounterSet
+
+DEFAULT_BACKLOG = socket.SOMAXCONN  # Pending connections the kernel queues before refusing new ones
+
+
+class AdmissionStats(CounterSet):
+    """Server-wide counters of what admission control did."""
+    FIELDS = ('admitted', 'rejected_connections', 'rejected_per_ip', 'limited_messages', 'limited_bytes')
+
+
+class TokenBucket:
+    """
+    A token bucket refilled lazily on every check.
+
+    Args:
+        rate: Tokens added per second.
+        capacity: Most tokens the bucket holds, i.e. the burst allowed after an idle period.
+    """
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = now
+
+    def refill(self, now):
+        tokens = self.tokens + (now - self.updated) * self.rate
+        self.tokens = tokens if tokens < self.capacity else self.capacity
+        self.updated = now
+
+
+class ClientLimiter:
+    """
+    One client's message and byte buckets; a frame passes only if both have room.
+    """
+    __slots__ = ('messages', 'bytes', 'stats', 'limited')
+
+    def __init__(self, message_rate, message_burst, byte_rate, byte_burst, stats):
+        now = time.monotonic()
+        self.messages = TokenBucket(message_rate, message_burst, now) if message_rate else None
+        self.bytes = TokenBucket(byte_rate, byte_burst, now) if byte_rate else None
+        self.stats = stats
+        self.limited = False  # Inside a limiting episode; the client has been told
+
+    def allow(self, size):
+        """
+        Charges one frame of size bytes.
+
+        Returns:
+            bool: True if the frame may be processed, False if it must be dropped.
+        """
+        now = time.monotonic()
+        messages = self.messages
+        if messages is not None:
+            messages.refill(now)
+            if messages.tokens < 1:
+                self.stats.record('limited_messages')
+                return False
+        data = self.bytes
+        if data is not None:
+            data.refill(now)
+            if data.tokens < size:  # Frames larger than the burst never pass
+                self.stats.record('limited_bytes')
+                return False
+            data.tokens -= size
+        if messages is not None:
+            messages.tokens -= 1
+        self.limited = False
+        return True
+
+    def start_episode(self):
+        """Returns True the first time a frame is dropped since frames last passed."""
+        if self.limited:
+            return False
+        self.limited = True
+        return True
+
+
+class AdmissionControl:
+    """
+    Connection caps and the rate limits handed to every admitted client.
+
+    All limits are off when 0. Bursts default to one second's worth of the rate.
+
+    Args:
+        max_connections: Concurrent connections overall.
+        max_per_ip: Concurrent connections from one IP address.
+        message_rate: Frames per second per client.
+        byte_rate: Frame payload bytes per second per client.
+        peer_message_rate: Frames per second per federation peer link, which carries many clients' traffic.
+        peer_byte_rate: Frame payload bytes per second per federation peer link.
+    """
+
+    def __init__(self, max_connections=0, max_per_ip=0, message_rate=0, message_burst=0, byte_rate=0, byte_burst=0,
+                 peer_message_rate=0, peer_byte_rate=0):
+        if min(max_connections, max_per_ip, message_rate, message_burst, byte_rate, byte_burst,
+               peer_message_rate, peer_byte_rate) < 0:
+            raise ValueError('Admission limits must not be negative')
+        self.max_connections = max_connections
+        self.max_per_ip = max_per_ip
+        self.message_rate = message_rate
+        self.message_burst = message_burst or max(1, message_rate)
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst or byte_rate
+        self.peer_message_rate = peer_message_rate
+        self.peer_byte_rate = peer_byte_rate
+        self.stats = AdmissionStats()
+        self.connections = 0
+        self._per_ip = {}  # IP -> open connections
+        self._lock = threading.Lock()
+
+    def admit(self, addr, force=False):
+        """
+        Registers a new connection from addr unless a cap is reached.
+
+        Args:
+            force: Register it even over a cap (a connection handed over by another process).
+
+        Returns:
+            bool: True if admitted; the caller must then release(addr) when it closes.
+        """
+        ip = addr[0]
+        with self._lock:
+            if force:
+                rejected = None
+            elif self.max_connections and self.connections >= self.max_connections:
+                rejected = 'rejected_connections'
+            elif self.max_per_ip and self._per_ip.get(ip, 0) >= self.max_per_ip:
+                rejected = 'rejected_per_ip'
+            else:
+                rejected = None
+            if rejected is None:
+                self.connections += 1
+                self._per_ip[ip] = self._per_ip.get(ip, 0) + 1
+        self.stats.record(rejected or 'admitted')
+        return rejected is None
+
+    def release(self, addr):
+        """Forgets a connection admitted by admit()."""
+        ip = addr[0]
+        with self._lock:
+            self.connections -= 1
+            remaining = self._per_ip.get(ip, 1) - 1
+            if remaining:
+                self._per_ip[ip] = remaining
+            else:
+                self._per_ip.pop(ip, None)
+
+    def limiter(self):
+        """Returns a ClientLimiter for a new client, or None if no rate limit is set."""
+        if not self.message_rate and not self.byte_rate:
+            return None
+        return ClientLimiter(self.message_rate, self.message_burst, self.byte_rate, self.byte_burst, self.stats)
+
+    def peer_limiter(self):
+        """Returns the ClientLimiter for an authenticated peer link, or None if peer links are not limited."""
+        if not self.peer_message_rate and not self.peer_byte_rate:
+            return None
+        return ClientLimiter(self.peer_message_rate, max(1, self.peer_message_rate), self.peer_byte_rate,
+                             self.peer_byte_rate, self.stats)
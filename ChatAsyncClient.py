@@ -0,0 +1,303 @@
+# ChatAsyncClient.py
+"""
+asyncio client API for the chat server.
+
+AsyncChatClient wraps a ChatClient (for its message builders, codec and stats
+counters) around an asyncio stream instead of a blocking socket and input()
+loop, so services and bots can run thousands of sessions in one process:
+
+    client = AsyncChatClient('127.0.0.1', 12345, 'bot', '001')
+    await client.connect()
+    await client.send('hello')
+    async for message in client:
+        print(message['nickname'], message['message'])
+    await client.close()
+
+If the connection drops, the client reconnects with exponential backoff and
+jitter, repeats the nickname handshake, rejoins its rooms and asks the server
+for the messages it missed since the last message ID it saw, repeating the
+request until the server reports it is caught up; messages the server replays
+more than once are dropped by ID. If the server's history epoch has changed
+(it restarted without a journal, so IDs started over), the remembered IDs are
+forgotten and the server replays everything it holds. send() waits for the
+reconnect instead of failing. If the server still holds the nickname (typically for
+the previous connection, until its heartbeat drops it), the handshake is
+repeated with the same backoff until the nickname is free again. With a ChatTLS.client_context() the session runs over TLS
+and reconnects resume the previous TLS session. Server heartbeat pings are
+answered without reaching the iterator.
+"""
+
+import asyncio
+import logging
+import random
+
+from ChatClient import DEFAULT_ROOM, NICKNAME_IN_USE, ChatClient
+from ChatCodec import CodecError
+from ChatCompression import ALGORITHM
+from ChatFraming import FrameDecoder, RECV_SIZE, encode_frame
+
+INITIAL_BACKOFF = 0.5  # Seconds before the first reconnect attempt
+MAX_BACKOFF = 30.0
+MAX_QUEUED = 1000  # Received messages held for the iterator; the oldest are dropped beyond this
+
+
+class AsyncChatClient:
+    """
+    One chat session on the running event loop.
+
+    Args:
+        ip, port, nickname, client_id: As for ChatClient.
+        codec: JSON backend name (default: the fastest installed).
+        transport: 'default' or 'low-latency' (TCP_NODELAY); asyncio already coalesces writes.
+        compression: Compression algorithm to offer, or None.
+        tls: A ChatTLS.client_context() to connect with TLS; reconnects resume the last session.
+        server_hostname: Name to verify the server certificate against (default: ip).
+        reconnect: Reconnect automatically when the connection drops.
+        max_queued: Received messages buffered for the iterator.
+    """
+
+    def __init__(self, ip, port, nickname, client_id, codec=None, transport="default", compression=ALGORITHM,
+                 tls=None, server_hostname=None, reconnect=True, max_queued=MAX_QUEUED):
+        self.session = ChatClient(ip, port, nickname, client_id, create_socket=False, codec=codec,
+                                  transport=transport, compression=compression, tls=tls)
+        self.session.server_hostname = server_hostname or ip
+        self.stats = self.session.stats  # Same counters as the blocking client, plus reconnects/messages_dropped/nickname_retries
+        self.reconnect = reconnect
+        self.rooms = {DEFAULT_ROOM}
+        self.logger = logging.getLogger(__name__)
+        self._messages = asyncio.Queue(max_queued)
+        self._last_ids = {}  # Room -> highest message ID delivered, to drop replayed duplicates
+        self._gaps = {}  # Room -> (ID caught up to, IDs delivered since) while replaying what was missed
+        self._epoch = None  # The server's history epoch; message IDs are only comparable within one
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._nickname_retry = None  # Task repeating a refused nickname handshake
+        self._nickname_delay = INITIAL_BACKOFF
+        self._connected = asyncio.Event()
+        self._closed = False
+        self._stopped = asyncio.Event()  # Set along with _closed, so senders waiting for a reconnect give up
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    async def connect(self):
+        """Connects and sends the nickname handshake; retries with backoff if reconnect is enabled."""
+        await self._open(retry=self.reconnect)
+        self._reader_task = asyncio.ensure_future(self._read_loop())
+
+    async def _open(self, retry):
+        delay = INITIAL_BACKOFF
+        tls = {} if self.session.tls is None else {'ssl': self.session.tls, 'server_hostname': self.session.server_hostname}
+        while True:
+            try:
+                reader, writer = await asyncio.open_connection(self.session.ip, self.session.port, **tls)
+                break
+            except OSError as e:
+                if not retry or self._closed:
+                    raise
+                self.logger.warning(f'Cannot reach {self.session.ip}:{self.session.port} ({str(e)}); '
+                                    f'retrying in {delay:.1f}s')
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))  # Jitter spreads out a reconnect storm
+                delay = min(delay * 2, MAX_BACKOFF)
+        self.session.configure_socket(writer.get_extra_info('socket'))
+        ssl_object = writer.get_extra_info('ssl_object')
+        if ssl_object is not None:
+            self.stats["tls_resumed"] += ssl_object.session_reused
+        self.session.compression = None  # Negotiated again by this handshake
+        self._reader = reader
+        self._writer = writer
+        self._nickname_delay = INITIAL_BACKOFF
+        writer.write(encode_frame(self.session.get_nickname_string()))
+        for room in self.rooms - {DEFAULT_ROOM}:
+            writer.write(encode_frame(self.session.get_join_string(room)))
+        if self.session.last_message_id is not None:  # Catch up on what was missed while disconnected
+            for room in self.rooms:
+                self._gaps[room] = (self.session.last_message_id, set())
+                writer.write(encode_frame(self.session.get_history_string(room, self.session.last_message_id, self._epoch)))
+        self._connected.set()
+
+    async def _read_loop(self):
+        while not self._closed:
+            decoder = FrameDecoder()
+            ssl_object = self._writer.get_extra_info('ssl_object')
+            try:
+                while True:
+                    data = await self._reader.read(RECV_SIZE)
+                    if not data:
+                        break
+                    if ssl_object is not None:
+                        self.session.tls.remember(self.session.server_hostname, ssl_object)  # Tickets arrive after the handshake
+                        ssl_object = None
+                    for payload in decoder.feed(data):
+                        self._deliver(payload)
+            except (OSError, ValueError) as e:
+                self.logger.warning(f'Connection to {self.session.ip}:{self.session.port} lost: {str(e)}')
+            self._connected.clear()
+            self._writer.close()
+            if self._closed or not self.reconnect:
+                break
+            self.stats["reconnects"] += 1
+            try:
+                await self._open(retry=True)
+            except OSError:
+                break
+        self._closed = True
+        self._stopped.set()
+        self._wake_iterator()
+
+    def _deliver(self, payload):
+        self.stats["messages_received"] += 1
+        self.stats["characters_received"] += len(payload)
+        try:
+            message = self.session.codec.decode(payload)
+        except CodecError:
+            return
+        if message.get("type") == "ping":
+            self._writer.write(self.session.frame(self.session.get_pong_string()))  # Not delivered to the iterator
+            return
+        if message.get("type") == "error" and message.get("message") == NICKNAME_IN_USE:
+            self._retry_nickname()
+            return
+        if message.get("type") == "history_end":
+            self._check_epoch(message.get("epoch"))
+            room = message.get("room") or DEFAULT_ROOM
+            if message.get("since") is None:
+                return  # The end of a join replay, not of a catch-up
+            if message.get("more") and isinstance(message.get("next"), int):  # The server replays long gaps in parts
+                self._writer.write(self.session.frame(
+                    self.session.get_history_string(room, message["next"], self._epoch)))
+            else:
+                self._gaps.pop(room, None)
+            return
+        self.session.accept_compression(message)
+        msg_id = message.get("id")
+        if isinstance(msg_id, int):
+            room = message.get("room") or DEFAULT_ROOM
+            gap = self._gaps.get(room)
+            if gap is not None:  # Catching up: the replay arrives out of order with live messages
+                if msg_id <= gap[0] or msg_id in gap[1]:
+                    return
+                gap[1].add(msg_id)
+            elif msg_id <= self._last_ids.get(room, 0):
+                return  # Already delivered before a reconnect
+            self._last_ids[room] = max(msg_id, self._last_ids.get(room, 0))
+            self.session.last_message_id = max(msg_id, self.session.last_message_id or 0)
+        if self._messages.full():
+            self._messages.get_nowait()  # Nobody is keeping up with the iterator; keep the newest
+            self.stats["messages_dropped"] += 1
+        self._messages.put_nowait(message)
+
+    def _check_epoch(self, epoch):
+        """Forgets the message IDs seen so far if the server's history epoch has changed."""
+        if epoch is None or epoch == self._epoch:
+            return
+        if self._epoch is not None:
+            # IDs started over: the catch-up requests in flight carry the old epoch,
+            # so the server answers them from its oldest message instead
+            self.logger.warning('Server history was reset; message IDs have started over')
+            self._last_ids.clear()
+            self.session.last_message_id = None
+            for room in self._gaps:
+                self._gaps[room] = (0, set())
+        self._epoch = epoch
+
+    def _retry_nickname(self):
+        delay = self._nickname_delay
+        self._nickname_delay = min(delay * 2, MAX_BACKOFF)
+        self.stats["nickname_retries"] += 1
+        self.logger.warning(f'Nickname {self.session.nickname} is in use; retrying in {delay:.1f}s')
+        self._nickname_retry = asyncio.ensure_future(self._repeat_handshake(delay * random.uniform(0.5, 1.0), self._writer))
+
+    async def _repeat_handshake(self, delay, writer):
+        await asyncio.sleep(delay)
+        if writer is self._writer and self.connected:  # Not after a reconnect, which sent its own handshake
+            writer.write(encode_frame(self.session.get_nickname_string()))
+
+    async def send_frame(self, frame):
+        """
+        Writes an encoded frame, waiting for a reconnect if the connection is down.
+
+        Raises:
+            ConnectionError: If the client is closed, including while waiting (close() or reconnecting gave up).
+        """
+        if not self._closed and not self._connected.is_set():
+            waits = [asyncio.ensure_future(self._connected.wait()), asyncio.ensure_future(self._stopped.wait())]
+            try:
+                await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for wait in waits:
+                    wait.cancel()
+        if self._closed:
+            raise ConnectionError('Client is closed')
+        self._writer.write(frame)
+        await self._writer.drain()
+
+    async def send(self, message):
+        """Sends a chat message to the current room and updates stats."""
+        self.stats["messages_sent"] += 1
+        self.stats["characters_sent"] += len(message)
+        await self.send_frame(self.session.frame(self.session.get_message_string(message)))
+
+    async def send_direct(self, nickname, message):
+        """Sends a message to the one client using nickname instead of the current room."""
+        self.stats["messages_sent"] += 1
+        self.stats["characters_sent"] += len(message)
+        await self.send_frame(self.session.frame(self.session.get_direct_string(nickname, message)))
+
+    async def join(self, room):
+        """Joins a room and makes it the room send() writes to."""
+        self.rooms.add(room)
+        self.session.room = room
+        await self.send_frame(self.session.frame(self.session.get_join_string(room)))
+
+    async def leave(self, room):
+        """Leaves a room; send() falls back to the lobby if it was the current room."""
+        self.rooms.discard(room)
+        if self.session.room == room:
+            self.session.room = DEFAULT_ROOM
+        await self.send_frame(self.session.frame(self.session.get_leave_string(room)))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Returns the next received message as a dict; stops once the client is closed."""
+        if self._closed and self._messages.empty():
+            raise StopAsyncIteration
+        message = await self._messages.get()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self, disconnect=True):
+        """
+        Ends the session.
+
+        Args:
+            disconnect: Send the disconnect request first if connected.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._stopped.set()
+        if disconnect and self.connected:
+            try:
+                self._writer.write(self.session.frame(self.session.get_disconnect_string()))
+                await self._writer.drain()
+            except OSError:
+                pass
+        if self._writer is not None:
+            self._writer.close()
+        if self._nickname_retry is not None:
+            self._nickname_retry.cancel()
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            await asyncio.gather(self._reader_task, return_exceptions=True)
+        self._connected.clear()
+        self._wake_iterator()
+
+    def _wake_iterator(self):
+        if not self._messages.full():
+            self._messages.put_nowait(None)  # Ends an iterator waiting for messages
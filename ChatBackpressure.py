@@ -0,0 +1,120 @@
+# ChatBackpressure.py
+"""
+Slow-consumer policies for the per-client outbound queues.
+
+Every OutboundQueue is bounded by a high and a low watermark (in bytes). When a
+client's backlog crosses the high watermark the queue becomes congested and each
+new frame is handed to the server's BackpressurePolicy until the writer has
+drained the backlog below the low watermark again.
+"""
+
+from ChatMetrics import CounterSet
+
+DEFAULT_HIGH_WATERMARK = 256 * 1024  # Bytes a client may fall behind before the policy applies
+DEFAULT_LOW_WATERMARK = 64 * 1024  # Backlog at which a congested client is considered healthy again
+
+
+class BackpressureStats(CounterSet):
+    """Server-wide counters of what the policy did to slow consumers."""
+    FIELDS = ('congestion_events', 'dropped_frames', 'dropped_bytes', 'coalesced_frames', 'disconnects')
+
+
+class BackpressurePolicy:
+    """
+    Decides what happens to a frame pushed onto a congested OutboundQueue.
+
+    Subclasses implement admit(), which is called with the queue's lock held and
+    returns True if the frame should be appended as usual, or False if the policy
+    has dealt with it (dropped, coalesced or evicted the client).
+    """
+    name = None
+
+    def __init__(self, high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK, stats=None):
+        if not 0 <= low_watermark <= high_watermark:
+            raise ValueError(f'Watermarks must satisfy 0 <= low ({low_watermark}) <= high ({high_watermark})')
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.stats = stats if stats is not None else BackpressureStats()
+
+    def admit(self, queue, frame, key):
+        """
+        Handles a frame pushed while the queue is congested.
+
+        Args:
+            queue: The congested OutboundQueue (its lock is held).
+            frame: The encoded frame being pushed.
+            key: The sender the frame came from, or None.
+
+        Returns:
+            bool: True if the queue should append the frame.
+        """
+        raise NotImplementedError
+
+
+class DropNewestPolicy(BackpressurePolicy):
+    """Refuses new frames until the client has caught up to the low watermark."""
+    name = 'drop-newest'
+
+    def admit(self, queue, frame, key):
+        self.stats.record('dropped_frames')
+        self.stats.record('dropped_bytes', len(frame))
+        return False
+
+
+class DropOldestPolicy(BackpressurePolicy):
+    """Keeps the newest frames by discarding the oldest pending ones to make room."""
+    name = 'drop-oldest'
+
+    def admit(self, queue, frame, key):
+        dropped_frames, dropped_bytes = queue.discard_oldest(self.high_watermark - len(frame))
+        if dropped_frames:
+            self.stats.record('dropped_frames', dropped_frames)
+            self.stats.record('dropped_bytes', dropped_bytes)
+        return True
+
+
+class CoalescePolicy(BackpressurePolicy):
+    """
+    Keeps only the newest pending frame from each sender while congested.
+
+    The backlog is then bounded by the number of active senders rather than the
+    message rate, and the client still sees the latest message from everyone.
+    Frames pushed without a key (pings, errors, acknowledgements, history
+    replays) have no sender to coalesce by and are always queued.
+    """
+    name = 'coalesce'
+
+    def admit(self, queue, frame, key):
+        if key is None:
+            return True
+        if queue.coalesce(key, frame):
+            self.stats.record('coalesced_frames')
+        return False
+
+
+class DisconnectPolicy(BackpressurePolicy):
+    """Evicts a client as soon as it falls behind the high watermark."""
+    name = 'disconnect'
+
+    def admit(self, queue, frame, key):
+        queue.evict()
+        self.stats.record('disconnects')
+        return False
+
+
+POLICIES = {policy.name: policy for policy in (DropNewestPolicy, DropOldestPolicy, CoalescePolicy, DisconnectPolicy)}
+
+
+def make_policy(name, high_watermark=DEFAULT_HIGH_WATERMARK, low_watermark=DEFAULT_LOW_WATERMARK):
+    """
+    Builds a policy by its CLI name.
+
+    Args:
+        name: One of the keys of POLICIES.
+        high_watermark: Backlog in bytes at which the policy starts to apply.
+        low_watermark: Backlog in bytes at which it stops applying.
+    """
+    try:
+        return POLICIES[name](high_watermark, low_watermark)
+    except KeyError:
+        raise ValueError(f'Unknown backpressure policy {name!r}; choose from {", ".join(POLICIES)}') from None
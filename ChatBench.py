@@ -0,0 +1,418 @@
+# ChatBench.py
+"""
+Headless load generator for ChatServer.py and ChatServerModified.py.
+
+For each server under test the benchmark starts the server on a fresh port,
+connects --clients simulated clients from one asyncio event loop, and has
+--senders of them broadcast --rate messages per second of --size bytes for
+--duration seconds. Messages are built with ChatClient's own builders and carry
+their send time, so every receiving client records the broadcast latency. The
+report gives the rate of bare connections (TCP or TLS handshakes only), the
+connect rate including the chat handshake, sent and delivered messages per second,
+p50/p99/p999 latency and the server's RSS. Finally every client disconnects
+and reconnects at once, which gives the reconnect rate a restart would see.
+With --tls the servers get a freshly generated self-signed certificate; bare
+handshakes are measured once without and once with session resumption, and
+the reconnect storm resumes sessions too (--tls both runs every server with
+and without TLS). With --handoff a second server process takes over from the
+first halfway through the sending phase (ChatServer.py --mode asyncio), and
+the report adds how long that took, how many client connections dropped and
+how many messages clients missed; a clean handoff drops none and still
+delivers every message, and the benchmark exits with status 1 if any run
+did not. Results can be saved as JSON for regression tracking.
+
+Example:
+    python ChatBench.py --servers ChatServer.py ChatServerModified.py --clients 1000 --output bench.json
+    python ChatBench.py --servers ChatServer.py --server-args="--mode asyncio" --clients 5000
+    python ChatBench.py --servers ChatServer.py --tls both --clients 1000
+    python ChatBench.py --servers ChatServer.py --server-args="--mode asyncio" --handoff
+"""
+
+import argparse
+from array import array
+import asyncio
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+from ChatClient import ChatClient
+from ChatCompression import ALGORITHM
+from ChatClusterHarness import HERE, percentile, wait_for_port
+from ChatFraming import FrameDecoder, encode_frame
+from ChatServer import raise_fd_limit
+from ChatTLS import client_context, generate_self_signed
+
+PLAINTEXT_ONLY = ('ChatServerModified.py',)  # Servers without --tls-cert; skipped for TLS runs
+NO_HANDOFF = ('ChatServerModified.py',)  # Servers without --handoff-socket; skipped for handoff runs
+MARKER = 'bench'  # Prefix of benchmark message texts: bench:<client>:<seq>:<send time ns>:<padding>
+
+
+def read_rss(pid):
+    """Returns the resident set size of a process in bytes (Linux only; None elsewhere)."""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class SimulatedClient:
+    """One benchmark connection: ChatClient's message builders over an asyncio stream."""
+
+    def __init__(self, index, host, port, compression=None, tls=None):
+        self.index = index
+        self.session = ChatClient(host, port, f'bench{index}', str(index), create_socket=False,
+                                  compression=compression, tls=tls)
+        self.reader = None
+        self.writer = None
+        self.latencies = array('q')  # Broadcast latencies in ns of messages from other clients
+        self.received = {}  # Sender index -> [messages received, highest sequence number], to count misses
+        self.sent = 0
+        self.resumed = False  # The last connection resumed a TLS session
+        self.dropped = False  # The server closed the connection
+
+    async def connect(self):
+        tls = {} if self.session.tls is None else {'ssl': self.session.tls, 'server_hostname': self.session.ip}
+        self.reader, self.writer = await asyncio.open_connection(self.session.ip, self.session.port, **tls)
+        ssl_object = self.writer.get_extra_info('ssl_object')
+        self.resumed = ssl_object is not None and ssl_object.session_reused
+        self.writer.write(encode_frame(self.session.get_nickname_string()))
+
+    async def receive(self):
+        decoder = FrameDecoder()
+        own = f'{MARKER}:{self.index}:'
+        ssl_object = self.writer.get_extra_info('ssl_object')
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    self.dropped = True
+                    return
+                if ssl_object is not None:
+                    self.session.tls.remember(self.session.ip, ssl_object)  # For the reconnect phase
+                    ssl_object = None
+                now = time.time_ns()
+                for payload in decoder.feed(data):
+                    try:
+                        message = json.loads(payload)
+                        text = message.get('message', '')
+                    except (ValueError, AttributeError):
+                        continue
+                    if message.get('type') == 'ping':
+                        self.writer.write(encode_frame(self.session.get_pong_string()))
+                        continue
+                    if isinstance(text, str) and text.startswith(MARKER) and not text.startswith(own):
+                        _, sender, seq, sent_ns, _ = text.split(':', 4)
+                        self.latencies.append(now - int(sent_ns))
+                        counted = self.received.setdefault(int(sender), [0, -1])
+                        if int(seq) > counted[1]:  # A sender's messages arrive in order; replays are not counted twice
+                            counted[0] += 1
+                            counted[1] = int(seq)
+        except (OSError, ValueError):
+            self.dropped = True
+
+    async def send_loop(self, rate, size, duration):
+        """Sends rate messages per second, padded to size bytes of text, for duration seconds."""
+        loop = asyncio.get_running_loop()
+        interval = 1.0 / rate
+        deadline = loop.time() + duration
+        next_send = loop.time() + random.random() * interval  # Spread senders across the interval
+        seq = 0
+        while next_send < deadline:
+            await asyncio.sleep(max(0.0, next_send - loop.time()))
+            text = f'{MARKER}:{self.index}:{seq}:{time.time_ns()}:'
+            text += 'x' * max(0, size - len(text))
+            try:
+                self.writer.write(encode_frame(self.session.get_message_string(text)))
+                await self.writer.drain()
+            except OSError:
+                self.dropped = True  # Reported by the handoff check instead of ending the run
+                return
+            self.sent += 1
+            seq += 1
+            next_send += interval
+
+    def missed(self, senders):
+        """Returns how many messages of the other senders never reached this client."""
+        return sum(sender.sent - self.received.get(sender.index, (0,))[0] for sender in senders if sender is not self)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def connect_all(clients, concurrency):
+    """
+    Connects every client, at most concurrency at a time.
+
+    Returns:
+        tuple: (connected clients, failed connection attempts, seconds taken)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def attempt(client):
+        async with semaphore:
+            try:
+                await asyncio.wait_for(client.connect(), 30)
+                return client
+            except (OSError, asyncio.TimeoutError):
+                return None
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(attempt(client) for client in clients))
+    elapsed = time.perf_counter() - started
+    connected = [client for client in results if client is not None]
+    return connected, len(clients) - len(connected), elapsed
+
+
+async def handshake_rate(host, port, tls, count, concurrency):
+    """
+    Opens and closes count bare connections (no chat handshake), at most concurrency at a time.
+
+    With TLS each connection is one TLS handshake, resumed if tls holds a session for host.
+
+    Returns:
+        float: Completed connections per second.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    options = {} if tls is None else {'ssl': tls, 'server_hostname': host}
+
+    async def attempt():
+        async with semaphore:
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(host, port, **options), 30)
+            except (OSError, asyncio.TimeoutError):
+                return 0
+            writer.close()
+            return 1
+
+    started = time.perf_counter()
+    completed = sum(await asyncio.gather(*(attempt() for _ in range(count))))
+    return completed / (time.perf_counter() - started)
+
+
+async def run_handoff(handoff, delay):
+    """Waits delay seconds, then runs the blocking handoff() callable and returns its result."""
+    await asyncio.sleep(delay)
+    return await asyncio.get_running_loop().run_in_executor(None, handoff)
+
+
+async def run_load(host, port, args, pid, tls=None, handoff=None):
+    """
+    Drives one workload against a running server and returns its measurements.
+
+    Args:
+        handoff: A blocking callable that hands the server over to a new process and
+            returns the seconds it took; it is run halfway through the sending phase.
+    """
+    rss = {'idle': read_rss(pid)}
+    compression = None if args.compression == 'none' else args.compression
+    clients = [SimulatedClient(index, host, port, compression, tls) for index in range(args.clients)]
+    handshakes = {'full': await handshake_rate(host, port, tls, args.clients, args.connect_concurrency)}
+    await asyncio.sleep(0.5)
+    connected, failed, connect_time = await connect_all(clients, args.connect_concurrency)
+    receivers = [asyncio.ensure_future(client.receive()) for client in connected]
+    await asyncio.sleep(0.5)  # Let the server register every client before traffic starts
+    rss['connected'] = read_rss(pid)
+
+    peak = [rss['connected'] or 0]
+
+    async def sample_rss():
+        while True:
+            value = read_rss(pid)
+            if value:
+                peak[0] = max(peak[0], value)
+            await asyncio.sleep(0.25)
+
+    sampler = asyncio.ensure_future(sample_rss())
+    senders = connected[:args.senders]
+    handoff_task = asyncio.ensure_future(run_handoff(handoff, args.duration / 2)) if handoff is not None else None
+    started = time.perf_counter()
+    await asyncio.gather(*(client.send_loop(args.rate, args.size, args.duration) for client in senders))
+    send_time = time.perf_counter() - started
+    expected = sum(client.sent for client in senders) * (len(connected) - 1)
+    settle_deadline = time.monotonic() + args.settle
+    while time.monotonic() < settle_deadline and sum(len(c.latencies) for c in connected) < expected:
+        await asyncio.sleep(0.05)
+    total_time = time.perf_counter() - started
+    sampler.cancel()
+    handoff_result = None
+    if handoff_task is not None:
+        missed = [client.missed(senders) for client in connected]
+        handoff_result = {'seconds': await handoff_task,
+                          'dropped_connections': sum(client.dropped for client in connected),
+                          'missed_messages': sum(missed),
+                          'clients_missing_messages': sum(1 for count in missed if count)}
+    rss['peak'] = peak[0] or None
+
+    for client in connected:
+        client.close()
+    for task in receivers:
+        task.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    await asyncio.sleep(0.5)  # Let the server drop the old connections
+    if tls is not None:  # The clients have remembered a session by now
+        handshakes['resumed'] = await handshake_rate(host, port, tls, args.clients, args.connect_concurrency)
+        await asyncio.sleep(0.5)
+    reconnected, _, reconnect_time = await connect_all(connected, args.connect_concurrency)
+    resumed = sum(client.resumed for client in reconnected)
+    for client in reconnected:
+        client.close()
+
+    latencies = sorted(value for client in connected for value in client.latencies)
+    sent = sum(client.sent for client in senders)
+    return {
+        'connected': len(connected),
+        'connect_failures': failed,
+        'handshakes_per_s': handshakes,
+        'connect_rate': len(connected) / connect_time if connect_time else None,
+        'reconnected': len(reconnected),
+        'reconnect_rate': len(reconnected) / reconnect_time if reconnect_time else None,
+        'tls_resumed': resumed,
+        'sent': sent,
+        'sent_per_s': sent / send_time if send_time else None,
+        'delivered': len(latencies),
+        'expected_deliveries': expected,
+        'delivered_per_s': len(latencies) / total_time if total_time else None,
+        'latency_us': {name: percentile(latencies, fraction) / 1000 if latencies else None
+                       for name, fraction in (('p50', 0.50), ('p99', 0.99), ('p999', 0.999), ('max', 1.0))},
+        'rss_bytes': rss,
+        'handoff': handoff_result,
+    }
+
+
+def bench_server(script, args, port, certificate=None, directory=None):
+    """
+    Starts one server script, benchmarks it and stops it.
+
+    Args:
+        certificate: (certificate, key) paths to serve TLS with, or None for plaintext.
+        directory: Scratch directory for the handoff socket (with --handoff).
+    """
+    command = [sys.executable, os.path.join(HERE, script), str(port), args.host] + shlex.split(args.server_args)
+    tls = None
+    if certificate is not None:
+        command += ['--tls-cert', certificate[0], '--tls-key', certificate[1]]
+        tls = client_context(certificate[0])
+    handoff_path = os.path.join(directory, f'handoff-{port}.sock') if args.handoff else None
+    process = subprocess.Popen(command + (['--handoff-socket', handoff_path] if handoff_path else []),
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    processes = [process]
+
+    def handoff():
+        started = time.perf_counter()
+        processes.append(subprocess.Popen(command + ['--takeover', handoff_path],
+                                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        process.wait(60)  # The old server exits once the new one holds every client
+        return time.perf_counter() - started
+
+    try:
+        wait_for_port(port)
+        result = asyncio.run(run_load(args.host, port, args, process.pid, tls, handoff if handoff_path else None))
+    finally:
+        for running in processes:
+            running.terminate()
+            try:
+                running.wait(5)
+            except subprocess.TimeoutExpired:
+                running.kill()  # The threaded servers wait for their handler threads otherwise
+                running.wait()
+    return {'server': script, 'command': command[1:], 'tls': tls is not None, **result}
+
+
+def format_result(result):
+    def number(value, spec):
+        return format(value, spec) if value is not None else 'n/a'
+
+    latency = result['latency_us']
+    peak = result['rss_bytes'].get('peak')
+    handoff = result.get('handoff')
+    name = f"{result['server']} (TLS)" if result['tls'] else result['server']
+    resumed = f" ({result['tls_resumed']} resumed)" if result['tls'] else ''
+    handshakes = ', '.join(f"{kind} {rate:.0f}/s" for kind, rate in result['handshakes_per_s'].items())
+    return (f"{name}: {'handshakes' if result['tls'] else 'bare connects'} {handshakes} | "
+            f"{result['connected']} clients ({result['connect_failures']} failed) "
+            f"at {number(result['connect_rate'], '.0f')} conn/s, reconnect {number(result['reconnect_rate'], '.0f')} conn/s{resumed} | "
+            f"sent {number(result['sent_per_s'], '.0f')} msg/s, delivered {result['delivered']}/{result['expected_deliveries']} "
+            f"({number(result['delivered_per_s'], '.0f')} msg/s) | "
+            f"latency p50 {number(latency['p50'], '.0f')}us p99 {number(latency['p99'], '.0f')}us "
+            f"p999 {number(latency['p999'], '.0f')}us | "
+            f"RSS peak {number(peak / 2 ** 20 if peak else None, '.1f')} MiB"
+            + (f" | handoff in {handoff['seconds']:.2f}s, {handoff['dropped_connections']} connections dropped, "
+               f"{handoff['missed_messages']} messages missed by {handoff['clients_missing_messages']} clients"
+               if handoff else ''))
+
+
+def failed_handoffs(results):
+    """Returns the results of handoff runs that dropped a client or lost a message."""
+    return [result for result in results if result.get('handoff') is not None
+            and (result['handoff']['dropped_connections'] or result['handoff']['missed_messages'])]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark chat servers with simulated clients.')
+    parser.add_argument('--servers', nargs='+', default=['ChatServer.py', 'ChatServerModified.py'],
+                        help='Server scripts to compare, each run with the same workload.')
+    parser.add_argument('--server-args', default='', help='Extra arguments for every server, e.g. "--mode asyncio".')
+    parser.add_argument('--host', default='127.0.0.1', help='Address the servers listen on.')
+    parser.add_argument('--port', type=int, default=7000, help='Port of the first server; the others follow.')
+    parser.add_argument('--clients', type=int, default=200, help='Simulated clients connected to each server.')
+    parser.add_argument('--senders', type=int, default=10, help='How many of the clients send messages.')
+    parser.add_argument('--rate', type=float, default=10.0, help='Messages per second per sender.')
+    parser.add_argument('--size', type=int, default=128, help='Message text size in bytes.')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds of sending.')
+    parser.add_argument('--settle', type=float, default=5.0, help='Seconds to wait for outstanding deliveries.')
+    parser.add_argument('--connect-concurrency', type=int, default=200, help='Connection attempts in flight at once.')
+    parser.add_argument('--compression', choices=(ALGORITHM, 'none'), default='none',
+                        help='Compression the simulated clients offer in their handshake.')
+    parser.add_argument('--tls', choices=('off', 'on', 'both'), default='off',
+                        help='Serve TLS with a generated self-signed certificate; both runs each server with and without.')
+    parser.add_argument('--handoff', action='store_true',
+                        help='Hand each server over to a new process halfway through sending (needs --mode asyncio); '
+                             'exits with status 1 if a client is dropped or misses a message.')
+    parser.add_argument('--output', default=None, help='Write the results to this JSON file.')
+    args = parser.parse_args()
+    if args.senders > args.clients or args.rate <= 0 or args.clients < 2:
+        parser.error('Need at least 2 clients, no more senders than clients and a positive rate.')
+    if args.handoff and 'asyncio' not in args.server_args:
+        parser.error('--handoff needs --server-args="--mode asyncio".')
+
+    raise_fd_limit()  # Thousands of simulated clients need as many sockets
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        certificate = generate_self_signed(directory) if args.tls != 'off' else None
+        runs = [(script, tls) for script in args.servers for tls in
+                {'off': (None,), 'on': (certificate,), 'both': (None, certificate)}[args.tls]]
+        for offset, (script, tls) in enumerate(runs):
+            if tls is not None and script in PLAINTEXT_ONLY:
+                print(f'{script}: skipped, it has no TLS support')
+                continue
+            if args.handoff and script in NO_HANDOFF:
+                print(f'{script}: skipped, it cannot hand over to a new process')
+                continue
+            result = bench_server(script, args, args.port + offset, tls, directory)
+            results.append(result)
+            print(format_result(result))
+
+    if args.output:
+        config = {name: value for name, value in vars(args).items() if name != 'output'}
+        with open(args.output, 'w') as f:
+            json.dump({'timestamp': time.time(), 'config': config, 'results': results}, f, indent=2)
+        print(f'Results written to {args.output}')
+    failed = failed_handoffs(results)
+    if failed:
+        print(f"Handoff check failed for {', '.join(result['server'] for result in failed)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,62 @@
 # ChatClient.py
 import argparse
 import io
-import json
 import socket   # Import socket module
 import sys   # Import system module
 from datetime import datetime
 import threading  # Import datetime module for timestamping
 from collections import Counter, defaultdict
 
+from ChatCodec import BACKENDS, ChatMessage, CodecError, DirectMessage, DisconnectMessage, MessageCodec, NicknameMessage
+from ChatCompression import ALGORITHM
+from ChatFraming import compress_frame, encode_frame, iter_frames
+from ChatTLS import client_context, client_handshake
+
+DEFAULT_ROOM = "lobby"  # The room the server puts every client in on connect
+# Transport modes: 'default' sends each message at once with Nagle's algorithm on,
+# 'low-latency' sends each message at once with TCP_NODELAY, and 'throughput' queues
+# messages and writes everything queued in one sendall every flush interval (also with TCP_NODELAY).
+TRANSPORTS = ("default", "low-latency", "throughput")
+NICKNAME_IN_USE = "Nickname already in use"  # Server error refusing the handshake; the user picks another nickname
+DEFAULT_FLUSH_INTERVAL = 0.005  # Seconds between coalesced writes in 'throughput' mode
+
 # Initialize global variables for statistics tracking
 class ChatClient:
-    def __init__(self, ip, port, nickname, client_id):
+    def __init__(self, ip, port, nickname, client_id, create_socket=True, codec=None,
+                 transport="default", flush_interval=DEFAULT_FLUSH_INTERVAL, compression=ALGORITHM, tls=None):
         self.ip = ip
         self.port = port
         self.nickname = nickname
         self.client_id = client_id
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.room = DEFAULT_ROOM  # Room that chat messages are sent to
+        self.last_message_id = None  # Highest server message ID received, for 'history' requests after a reconnect
+        self.nickname_refused = threading.Event()  # Set by the reader when the server refuses the nickname
+        # Headless users (e.g. ChatBench) only need the message builders and bring their own connection
+        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM) if create_socket else None
+        self.codec = MessageCodec(codec)  # JSON backend: orjson or msgspec when installed, else stdlib json
+        if transport not in TRANSPORTS:
+            raise ValueError(f"Transport must be one of {', '.join(TRANSPORTS)}")
+        self.transport = transport
+        self.flush_interval = flush_interval
+        self.compression_offer = compression  # Algorithm offered in the handshake, or None
+        self.compression = None  # Set once the server accepts the offer
+        self.tls = tls  # ChatTLS.client_context(), or None for plaintext
+        self.server_hostname = ip  # Name the server certificate is checked against
+        self._pending = []  # Frames waiting for the next coalesced write ('throughput' mode)
+        self._pending_lock = threading.Lock()
+        self._queued = threading.Condition(self._pending_lock)  # Wakes the flusher when a frame is queued or on close
+        self._write_lock = threading.Lock()  # One write at a time, so frames never interleave (the reader answers pings)
+        self._flusher = None
+        self._closed = False
+        if self.client_socket is not None:
+            self.configure_socket(self.client_socket)
         self.start_time = datetime.now()
         self.stats = defaultdict(int)
 
     def _generate_json_message(self, msg_type, **kwargs):
         payload = {"timestamp": datetime.now().isoformat()}
         payload.update(**kwargs)  # Add additional key-value pairs to the payload
-        return json.dumps({"type": msg_type, **payload})
+        return self.codec.encode({"type": msg_type, **payload}).decode()
 
     def get_hello_string(self):
         """Generates a JSON 'hello' message for initiating a chat session."""
@@ -44,7 +78,8 @@ class ChatClient:
         Returns:
             str: A JSON string with the user's nickname, client ID, and timestamp.
         """
-        return self._generate_json_message("nickname", nickname=self.nickname, clientID=self.client_id)
+        offer = [self.compression_offer] if self.compression_offer else None
+        return self.codec.encode(NicknameMessage(self.nickname, self.client_id, offer)).decode()
 
     def get_message_string(self, message):
         """
@@ -57,7 +92,67 @@ class ChatClient:
         Returns:
             str: A JSON-formatted string representing the user's sent message.
         """
-        return self._generate_json_message("message", nickname=self.nickname, message=message)
+        return self.codec.encode(ChatMessage(self.nickname, message, self.room)).decode()
+
+    def get_direct_string(self, recipient, message):
+        """
+        Returns a JSON-formatted string representing a message for one user only.
+
+        Parameters:
+            recipient (str): The nickname of the user to deliver the message to.
+            message (str): The content of the message.
+
+        Returns:
+            str: A JSON-formatted string representing the direct message.
+        """
+        return self.codec.encode(DirectMessage(self.nickname, recipient, message)).decode()
+
+    def get_join_string(self, room):
+        """
+        Returns a JSON-formatted string asking the server to subscribe the user to a room.
+
+        Parameters:
+            room (str): The name of the room to join.
+
+        Returns:
+            str: A JSON-formatted string representing the join request.
+        """
+        return self._generate_json_message("join", nickname=self.nickname, room=room)
+
+    def get_leave_string(self, room):
+        """
+        Returns a JSON-formatted string asking the server to unsubscribe the user from a room.
+
+        Parameters:
+            room (str): The name of the room to leave.
+
+        Returns:
+            str: A JSON-formatted string representing the leave request.
+        """
+        return self._generate_json_message("leave", nickname=self.nickname, room=room)
+
+    def get_history_string(self, room, since=None, epoch=None):
+        """
+        Returns a JSON-formatted string asking the server to replay a room's recent messages.
+
+        Parameters:
+            room (str): The room whose history is requested.
+            since (int): Only replay messages with a greater message ID (default: the server's replay count).
+            epoch (str): The history epoch since was seen in, from the server's 'history_end' messages.
+
+        Returns:
+            str: A JSON-formatted string representing the history request.
+        """
+        return self._generate_json_message("history", nickname=self.nickname, room=room, since=since, epoch=epoch)
+
+    def get_pong_string(self):
+        """
+        Returns a JSON-formatted string answering a server's 'ping' heartbeat.
+
+        Returns:
+            str: A JSON-formatted string representing the pong.
+        """
+        return self._generate_json_message("pong")
 
     def get_disconnect_string(self):
         """
@@ -70,14 +165,112 @@ class ChatClient:
         Returns:
             str: A JSON-formatted string representing the user's disconnection request.
         """
-        return self._generate_json_message("disconnect", nickname=self.nickname, clientID=self.client_id)
+        return self.codec.encode(DisconnectMessage(self.nickname, self.client_id)).decode()
 
     def print_summary(self):
         """
         Prints a summary of the chat session statistics.
         """
         end_time = datetime.now()
-        print(f'Summary: start: {self.start_time}, end:{end_time}, msg sent:{self.stats["messages_sent"]},msg rcv:{self.stats["messages_received"]}, char sent: {self.stats["characters_sent"]}, char rcv: {self.stats["characters_received"]}')
+        elapsed = max((end_time - self.start_time).total_seconds(), 1e-9)
+        print(f'Summary: start: {self.start_time}, end:{end_time}, msg sent:{self.stats["messages_sent"]},msg rcv:{self.stats["messages_received"]}, char sent: {self.stats["characters_sent"]}, char rcv: {self.stats["characters_received"]}, '
+              f'msg/s sent: {self.stats["messages_sent"] / elapsed:.1f}, msg/s rcv: {self.stats["messages_received"] / elapsed:.1f}, writes: {self.stats["writes"]} ({self.transport})')
+
+    def connect(self, server_hostname=None):
+        """
+        Connects to the server, with a TLS handshake if a TLS context was given.
+
+        Args:
+            server_hostname: Name to verify the server certificate against (default: the IP).
+        """
+        self.client_socket.connect((self.ip, self.port))
+        if self.tls is not None:
+            self.server_hostname = server_hostname or self.ip
+            self.client_socket = client_handshake(self.tls, self.client_socket, self.server_hostname)
+            self.stats["tls_resumed"] += self.client_socket.session_reused
+
+    def configure_socket(self, sock):
+        """
+        Applies the transport mode's socket options.
+
+        Both 'low-latency' and 'throughput' disable Nagle's algorithm: the former
+        so every message leaves immediately, the latter because it already
+        coalesces messages itself and Nagle would only hold its batches back.
+        """
+        if self.transport != "default":
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def send_frame(self, frame):
+        """
+        Sends an encoded frame according to the transport mode.
+
+        In 'throughput' mode the frame is queued and written by the flusher
+        thread together with every other frame queued within the flush interval.
+        Otherwise it is written at once, under the write lock, since the reader
+        thread sends too (a TLS socket must not be written from two threads).
+        """
+        if self.transport != "throughput":
+            with self._write_lock:
+                self.client_socket.sendall(frame)
+                self.stats["writes"] += 1
+            return
+        with self._pending_lock:
+            self._pending.append(frame)
+            if len(self._pending) == 1:
+                self._queued.notify()  # The first frame of a batch starts the flush interval
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._flush_loop, name="client-flusher", daemon=True)
+                self._flusher.start()
+
+    def flush(self):
+        """Writes every queued frame in one sendall ('throughput' mode)."""
+        with self._write_lock:
+            with self._pending_lock:
+                frames, self._pending = self._pending, []
+            if frames:
+                self.client_socket.sendall(b"".join(frames))
+                self.stats["writes"] += 1
+
+    def _flush_loop(self):
+        while True:
+            with self._queued:
+                self._queued.wait_for(lambda: self._pending or self._closed)  # Idle sessions sleep here
+                # Batching deadline: frames queued within the interval share this write
+                if self._queued.wait_for(lambda: self._closed, self.flush_interval):
+                    return  # close() writes what is left
+            try:
+                self.flush()
+            except OSError:
+                return  # The reader notices the broken connection
+
+    def close(self):
+        """Writes anything still queued and closes the socket."""
+        with self._queued:
+            self._closed = True
+            self._queued.notify_all()
+        if self._flusher is not None:
+            self._flusher.join()
+        try:
+            self.flush()
+        except OSError:
+            pass
+        self.client_socket.close()
+
+    def frame(self, payload):
+        """Frames a message, compressed if the server accepted compression and it pays."""
+        frame = encode_frame(payload)
+        return compress_frame(frame) if self.compression is not None else frame
+
+    def accept_compression(self, message):
+        """Enables compression when a server message acknowledges the offered algorithm."""
+        if message.get("type") == "compression" and message.get("algorithm") == self.compression_offer:
+            self.compression = self.compression_offer
+
+    def change_nickname(self, nickname):
+        """Repeats the nickname handshake with a new nickname, e.g. after the server refused the previous one."""
+        self.nickname = nickname
+        self.nickname_refused.clear()
+        self.send_frame(encode_frame(self.get_nickname_string()))
 
     def send_message(self, message):
         """
@@ -85,21 +278,34 @@ class ChatClient:
         """
         self.stats["messages_sent"] += 1  # Increment count of sent messages
         self.stats["characters_sent"] += len(message)  # Update total character count for all sent messages
-        message_string = self.get_message_string(self.nickname, message).encode()  # Encode the JSON-formatted string to bytes before sending
-        self.client_socket.send(message_string)
+        message_string = self.get_message_string(message)
+        self.send_frame(self.frame(message_string))  # Frame the JSON-formatted string so the server can split the stream
 
 
     def read_from_server(self, clientSocket):
         """
         Reads incoming message from the server and updates statistics.
         """
-        while True:
-            data = clientSocket.recv(1024)
-            if not data:
-                break
+        for data in iter_frames(clientSocket):  # One complete server message per iteration
+            if self.tls is not None and not self.stats["messages_received"]:
+                self.tls.remember(self.server_hostname, clientSocket)  # TLS 1.3 tickets arrive after the handshake
             self.stats["messages_received"] += 1  # Increment message count
             self.stats["characters_received"] += len(data)  # Update character count
-            print('FROM SERVER:', json.loads(data)["timestamp"])  # Correctly parse the JSON data
+            try:
+                message = self.codec.decode(data)
+            except CodecError:
+                continue  # Not a JSON object, e.g. the bare DISCONNECT broadcast for a legacy client
+            if message.get("type") == "ping":  # The server checks that idle clients are still there
+                self.send_frame(self.frame(self.get_pong_string()))
+                continue
+            if message.get("type") == "error" and message.get("message") == NICKNAME_IN_USE:
+                self.nickname_refused.set()
+                print(f'Nickname {self.nickname} is already in use; enter another nickname:')
+                continue
+            self.accept_compression(message)
+            if isinstance(message.get("id"), int):
+                self.last_message_id = max(message["id"], self.last_message_id or 0)
+            print('FROM SERVER:', message.get("timestamp", message))  # Correctly parse the JSON data
 
 
 def main():
@@ -110,6 +316,18 @@ def main():
     parser.add_argument('hostname', type=str, help='The server hostname')
     parser.add_argument('port', type=int, help='The server port number')
     parser.add_argument('nickname', type=str, help='Your chat nickname')
+    parser.add_argument('--codec', choices=tuple(BACKENDS), default=None,
+                        help='JSON backend (default: the fastest one installed)')
+    parser.add_argument('--transport', choices=TRANSPORTS, default='default',
+                        help='low-latency sets TCP_NODELAY; throughput coalesces messages into fewer writes')
+    parser.add_argument('--flush-interval', type=float, default=DEFAULT_FLUSH_INTERVAL,
+                        help='Seconds between coalesced writes in throughput mode')
+    parser.add_argument('--compression', choices=(ALGORITHM, 'none'), default=ALGORITHM,
+                        help='Compression to offer the server (frames are compressed only if it agrees)')
+    parser.add_argument('--tls', action='store_true', help='Connect with TLS')
+    parser.add_argument('--tls-ca', default=None, metavar='PEM',
+                        help='Trust this certificate (e.g. the server\'s self-signed one) instead of the system store')
+    parser.add_argument('--tls-insecure', action='store_true', help='Do not verify the server certificate')
     args = parser.parse_args()
 
     try:
@@ -117,24 +335,24 @@ def main():
     except socket.gaierror as e:
         print(f"Error resolving hostname: {e}")
         sys.exit(1)
-    if len(sys.argv) != 4:
-        print("ERR - Usage: python ChatClient.py <hostname> <port> <nickname>")
-        sys.exit()
 
     ip = socket.gethostbyname(args.hostname)  # Get IP address from hostname provided as command-line argument
     port = int(args.port)  # Convert port number to integer type
     nickname = str(args.nickname)   # Set user's chosen nickname from command-line argument
 
-    clientSession = ChatClient(ip, port, nickname, str(f"{ip}:{port}"))
+    clientSession = ChatClient(ip, port, nickname, str(f"{ip}:{port}"), codec=args.codec,
+                               transport=args.transport, flush_interval=args.flush_interval,
+                               compression=None if args.compression == 'none' else args.compression,
+                               tls=client_context(args.tls_ca, not args.tls_insecure) if args.tls else None)
 
     # Create a TCP/IP socket object
-    clientSession.client_socket.connect((ip, port))  # Establish connection with the server using provided IP address and port number
+    clientSession.connect(args.hostname)  # Establish connection with the server (and the TLS session if --tls) using provided IP address and port number
 
     print(f"ChatClient started with IP: {clientSession.ip},port: {clientSession.port}, nickname: {clientSession.nickname}, client ID: {clientSession.client_id}")  # Inform the user of their unique identifier
     
     # Send the nickname and client ID to the server using the get_nickname_string function
     nickname_string = clientSession.get_nickname_string()
-    clientSession.client_socket.send(nickname_string.encode())
+    clientSession.send_frame(encode_frame(nickname_string))
     print(nickname_string)  # Optionally print the sent JSON-formatted string to the console
 
     server = threading.Thread(target=clientSession.read_from_server, args=[clientSession.client_socket])  # Create a separate thread for reading from server
@@ -143,19 +361,38 @@ def main():
     while True:
         clientSentence = input('Enter message:\n') # Prompt user for their sent message and assign it to variable 'clientSentence'
         if clientSentence.upper().strip() == "DISCONNECT": # Check if user entered command to disconnect from chat session
-            clientSession.get_disconnect_string()  # Exit loop and proceed with further steps in program execution flow
-            break
+            clientSession.send_frame(clientSession.frame(clientSession.get_disconnect_string()))  # Ask the server to end the session
+            clientSession.flush()  # Don't leave the request queued in throughput mode
+            break  # Exit loop and proceed with further steps in program execution flow
+        if clientSession.nickname_refused.is_set():  # The server refused the nickname, so this line is the next one to try
+            if clientSentence.strip():
+                clientSession.change_nickname(clientSentence.strip())
+            continue
+        command, _, room = clientSentence.strip().partition(" ")
+        if command.lower() == "/join" and room:  # Switch the room that messages are sent to
+            clientSession.send_frame(clientSession.frame(clientSession.get_join_string(room)))
+            clientSession.room = room
+            continue
+        if command.lower() == "/msg" and room.strip():  # '/msg <nickname> <message>' reaches that user only
+            recipient, _, message = room.strip().partition(" ")
+            clientSession.send_frame(clientSession.frame(clientSession.get_direct_string(recipient, message)))
+            continue
+        if command.lower() == "/history":  # Catch up on messages missed since the last one received
+            clientSession.send_frame(clientSession.frame(clientSession.get_history_string(clientSession.room, clientSession.last_message_id)))
+            continue
+        if command.lower() == "/leave" and room:  # Stop receiving a room's messages
+            clientSession.send_frame(clientSession.frame(clientSession.get_leave_string(room)))
+            if clientSession.room == room:
+                clientSession.room = DEFAULT_ROOM
+            continue
         if clientSentence != "":  # Check if user entered any message
             clientSession.stats.update({clientSentence: clientSession.stats[clientSentence] + 1})  # Increment the count for the message in the stats dictionary
-        
-            message_string = clientSession.get_message_string(clientSentence)   # Generate JSON-formatted string representing user's sent message using helper function 'get_message_string()'
-
-            clientSession.client_socket.send(message_string.encode())  # Send generated JSON-formatted string to server over established TCP/IP connection
+            clientSession.send_message(clientSentence)  # Builds, frames and sends (or queues) the message and counts it in stats
 
     server.join()  # Wait for the thread to finish
 
     clientSession.print_summary()  # Print chat session summary to console
-    clientSession.client_socket.close()  # Close the socket
+    clientSession.close()  # Flush anything queued and close the socket
 
 if __name__ == "__main__":
     main()
@@ -4,6 +4,9 @@ import socket   # Import socket module
 import sys   # Import system module
 from datetime import datetime
 import threading  # Import datetime module for timestamping
+import json
+
+from ChatFraming import encode_frame, iter_frames
 
 # Initialize global variables for statistics tracking
 start_time = None
@@ -11,6 +14,8 @@ number_of_messages_sent = 0
 number_of_messages_received = 0
 number_of_characters_sent = 0
 number_of_characters_received = 0
+nickname_refused = threading.Event()  # Set by the reader when the server refuses the nickname
+NICKNAME_IN_USE = "Nickname already in use"  # Server error refusing the handshake; the user picks another nickname
 
 def get_hello_string(ip, port, nickname, client_id):
     """
@@ -39,7 +44,7 @@ def get_nickname_string(nickname, client_id):
         str: A JSON string with the user's nickname, client ID, and timestamp.
     """
     timestamp = datetime.now()  # Get current UTC timestamp
-    return f"""{{"type": "nickname", "nickname": {nickname}, "clientID": {client_id}, "timestamp": "{timestamp}"}}"""
+    return f"""{{"type": "nickname", "nickname": "{nickname}", "clientID": "{client_id}", "timestamp": "{timestamp}"}}"""
 
 def get_message_string(nickname, message):
     """
@@ -83,6 +88,16 @@ def get_disconnect_string(nickname, client_id):
     timestamp = datetime.now()  # Get current timestamp
     return f"""{{"type": "disconnect", "nickname": "{nickname}", "clientID": "{client_id}", "timestamp": "{timestamp}"}}"""
 
+def get_pong_string():
+    """
+    Returns a JSON-formatted string answering a server's 'ping' heartbeat.
+
+    Returns:
+        str: A JSON-formatted string representing the pong.
+     """
+    timestamp = datetime.now()  # Get current timestamp
+    return f"""{{"type": "pong", "timestamp": "{timestamp}"}}"""
+
 def print_summary():
     """
     Prints a summary of the chat session statistics.
@@ -95,15 +110,24 @@ def read_from_server(clientSocket):
     Reads incoming message from the server and updates statistics.
      """
     global number_of_messages_received, number_of_characters_received  # Access global variables for update
-    while True:
-        serverSentence = clientSocket.recv(1024)   # Receive data from the server
-        if not serverSentence:
-            break
+    for serverSentence in iter_frames(clientSocket):   # Receive one complete message from the server
         serverSentence = serverSentence.decode()  # Decode received bytes to string
 
         number_of_messages_received += 1  # Increment message count
         number_of_characters_received += len(serverSentence)   # Update character count
 
+        try:
+            message = json.loads(serverSentence)
+        except ValueError:
+            message = None  # Not JSON, e.g. the bare DISCONNECT broadcast
+        if isinstance(message, dict) and message.get("type") == "ping":  # The server checks that idle clients are still there
+            clientSocket.sendall(encode_frame(get_pong_string()))
+            continue
+        if isinstance(message, dict) and message.get("type") == "error" and message.get("message") == NICKNAME_IN_USE:
+            nickname_refused.set()
+            print('Nickname already in use; enter another nickname:')
+            continue
+
         print('FROM SERVER:', serverSentence)   # Print received message to console
 
 def main():
@@ -130,7 +154,7 @@ def main():
     
     # Send the nickname and client ID to the server using the get_nickname_string function
     nickname_string = get_nickname_string(nickname, client_id)
-    clientSocket.send(nickname_string.encode())
+    clientSocket.sendall(encode_frame(nickname_string))
     print(nickname_string)  # Optionally print the sent JSON-formatted string to the console
 
     t1 = threading.Thread(target=read_from_server, args=[clientSocket])  # Create a separate thread for reading from server
@@ -142,14 +166,21 @@ def main():
         if clientSentence.lower() == "disconnect":  # Check if user entered command to disconnect from chat session
             break  # Exit loop and proceed with further steps in program execution flow
 
+        if nickname_refused.is_set():  # The server refused the nickname, so this line is the next one to try
+            if clientSentence.strip():
+                nickname = clientSentence.strip()
+                nickname_refused.clear()
+                clientSocket.sendall(encode_frame(get_nickname_string(nickname, client_id)))
+            continue
+
         message_string = get_message_string(nickname, clientSentence)   # Generate JSON-formatted string representing user's sent message using helper function 'get_message_string()'
 
-        clientSocket.send(message_string.encode())  # Send generated JSON-formatted string to server over established TCP/IP connection
+        clientSocket.sendall(encode_frame(message_string))  # Send generated JSON-formatted string to server over established TCP/IP connection
 
         number_of_messages_sent += len(clientSentence)  # Increment count of sent messages by user in current chat session
         number_of_characters_sent += len(message_string)   # Update total character count for all sent messages by user in current chat session
 
-    clientSocket.send(get_disconnect_string(nickname, client_id).encode())  # Send JSON-formatted string representing user's disconnection request to server over established TCP/IP connection using helper function 'get_disconnect_string()'
+    clientSocket.sendall(encode_frame(get_disconnect_string(nickname, client_id)))  # Send JSON-formatted string representing user's disconnection request to server over established TCP/IP connection using helper function 'get_disconnect_string()'
 
     t1.join()  # Wait for the thread to finish
 
@@ -0,0 +1,169 @@
+# ChatClusterHarness.py
+"""
+Local stand-in topology for federated ChatServer nodes.
+
+Starts three (or --nodes) ChatServer processes on consecutive localhost ports,
+fully meshed with --peer, connects one ChatClient to every node and has each
+client take turns broadcasting timestamped messages. Every delivery is checked
+and the end-to-end latency is reported for same-node and cross-node hops.
+
+Example: python ChatClusterHarness.py --base-port 6000 --messages 300 --mode asyncio
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from ChatClient import ChatClient
+from ChatFraming import encode_frame, iter_frames
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(sorted_values, fraction):
+    """Returns the value at the given fraction (0..1) of an already sorted list."""
+    if not sorted_values:
+        return float('nan')
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def wait_for_port(port, timeout=10.0):
+    """Blocks until something accepts connections on localhost:port."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'Nothing is listening on port {port}')
+
+
+def start_cluster(base_port, nodes, mode):
+    """
+    Starts a fully meshed cluster; node i dials every node j < i.
+
+    Returns:
+        list: The subprocess.Popen handles, one per node.
+    """
+    processes = []
+    environment = dict(os.environ, CHAT_PEER_SECRET=os.urandom(16).hex())  # One secret for the whole cluster
+    for index in range(nodes):
+        command = [sys.executable, os.path.join(HERE, 'ChatServer.py'), str(base_port + index), '127.0.0.1',
+                   '--mode', mode, '--node-id', f'node{index}']
+        for peer in range(index):
+            command += ['--peer', f'127.0.0.1:{base_port + peer}']
+        processes.append(subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=environment))
+    for index in range(nodes):
+        wait_for_port(base_port + index)
+    return processes
+
+
+class Receiver:
+    """A ChatClient connected to one node that timestamps every message it receives."""
+
+    def __init__(self, node, port):
+        self.node = node
+        self.session = ChatClient('127.0.0.1', port, f'probe{node}', str(node))
+        self.session.client_socket.connect(('127.0.0.1', port))
+        self.session.client_socket.sendall(encode_frame(self.session.get_nickname_string()))
+        self.arrivals = {}  # message text -> arrival time in ns
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def send(self, text):
+        self.session.client_socket.sendall(encode_frame(self.session.get_message_string(text)))
+
+    def _read(self):
+        try:
+            for data in iter_frames(self.session.client_socket):
+                now = time.time_ns()
+                message = json.loads(data)
+                if message.get('type') == 'message':
+                    self.arrivals.setdefault(message['message'], now)
+        except (OSError, ValueError):
+            pass
+
+
+def wait_for_mesh(receivers, timeout=15.0):
+    """Sends probes from every node until each probe reaches every node."""
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while time.monotonic() < deadline:
+        attempt += 1
+        probes = [f'probe:{attempt}:{sender.node}' for sender in receivers]
+        for sender, probe in zip(receivers, probes):
+            sender.send(probe)
+        time.sleep(0.3)
+        if all(probe in receiver.arrivals for probe in probes for receiver in receivers):
+            return
+    raise TimeoutError('The federation mesh did not converge')
+
+
+def measure(receivers, messages, interval):
+    """
+    Broadcasts messages round-robin from every node and collects latencies.
+
+    Returns:
+        tuple: (latencies by hop kind in microseconds, number of missing deliveries)
+    """
+    sent = []
+    for seq in range(messages):
+        sender = receivers[seq % len(receivers)]
+        text = f'bench:{seq}:{time.time_ns()}'
+        sender.send(text)
+        sent.append((sender.node, text))
+        if interval:
+            time.sleep(interval)
+    time.sleep(1.0)
+
+    latencies = {'same-node': [], 'cross-node': []}
+    missing = 0
+    for origin, text in sent:
+        sent_ns = int(text.rsplit(':', 1)[1])
+        for receiver in receivers:
+            arrived = receiver.arrivals.get(text)
+            if arrived is None:
+                missing += 1
+                continue
+            kind = 'same-node' if receiver.node == origin else 'cross-node'
+            latencies[kind].append((arrived - sent_ns) / 1000)
+    return latencies, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run a local federated ChatServer cluster and measure broadcast latency.')
+    parser.add_argument('--base-port', type=int, default=6000, help='Port of the first node; the others follow.')
+    parser.add_argument('--nodes', type=int, default=3, help='Number of nodes (default 3).')
+    parser.add_argument('--messages', type=int, default=300, help='Messages to broadcast in total.')
+    parser.add_argument('--interval', type=float, default=0.002, help='Seconds between messages.')
+    parser.add_argument('--mode', choices=('thread', 'asyncio'), default='asyncio', help='Server engine.')
+    args = parser.parse_args()
+
+    processes = start_cluster(args.base_port, args.nodes, args.mode)
+    try:
+        receivers = [Receiver(node, args.base_port + node) for node in range(args.nodes)]
+        wait_for_mesh(receivers)
+        latencies, missing = measure(receivers, args.messages, args.interval)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    print(f'{args.nodes} nodes, {args.messages} broadcasts, {missing} missing deliveries')
+    for kind, values in latencies.items():
+        values.sort()
+        print(f'{kind:>10}: n={len(values)} p50={percentile(values, 0.50):.0f}us '
+              f'p99={percentile(values, 0.99):.0f}us max={percentile(values, 1.0):.0f}us')
+    sys.exit(1 if missing else 0)
+
+
+if __name__ == '__main__':
+    main()
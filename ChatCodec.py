@@ -0,0 +1,322 @@
+# ChatCodec.py
+"""
+Message encoding for the chat clients and servers.
+
+A backend turns plain dicts into JSON bytes and back; stdlib json is always
+available, orjson and msgspec are used when installed (best_backend() picks the
+fastest present). MessageCodec adds typed message structs on top: NicknameMessage,
+ChatMessage, DirectMessage, DisconnectMessage and BroadcastMessage keep the wire
+format the clients already use ({"type": ..., "timestamp": ..., fields...}).
+
+Servers that only forward messages use MessageCodec.validate(): the payload is
+checked to be a JSON object with a string "type" and the original bytes are
+forwarded as they are, instead of decoding and re-encoding every message.
+
+Run this module for a microbenchmark of every installed backend:
+    python ChatCodec.py [--count 100000]
+"""
+
+import argparse
+from datetime import datetime
+import json
+import time
+
+try:
+    import orjson
+except ImportError:  # Optional speedup
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # Optional speedup
+    msgspec = None
+
+
+class CodecError(ValueError):
+    """Raised when a payload is not a valid chat message."""
+
+
+class JsonBackend:
+    """The standard library json module."""
+    name = 'json'
+
+    def __init__(self):
+        self._encoder = json.JSONEncoder()
+        self._decoder = json.JSONDecoder()
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj).encode()
+
+    def loads(self, data):
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            data = bytes(data).decode()
+        return self._decoder.decode(data)
+
+
+DECODE_ERRORS = (ValueError, TypeError)  # orjson.JSONDecodeError subclasses ValueError
+if msgspec is not None:
+    DECODE_ERRORS += (msgspec.DecodeError,)
+
+
+class OrjsonBackend:
+    """orjson: Rust implementation, returns bytes directly."""
+    name = 'orjson'
+
+    def dumps(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class MsgspecBackend:
+    """msgspec.json with reusable encoder and decoder objects."""
+    name = 'msgspec'
+
+    def __init__(self):
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+
+    def dumps(self, obj):
+        return self._encoder.encode(obj)
+
+    def loads(self, data):
+        return self._decoder.decode(data)
+
+
+BACKENDS = {'json': JsonBackend}
+if orjson is not None:
+    BACKENDS['orjson'] = OrjsonBackend
+if msgspec is not None:
+    BACKENDS['msgspec'] = MsgspecBackend
+PREFERENCE = ('orjson', 'msgspec', 'json')
+
+
+def best_backend():
+    """Returns an instance of the fastest installed backend."""
+    for name in PREFERENCE:
+        if name in BACKENDS:
+            return BACKENDS[name]()
+
+
+def make_backend(name=None):
+    """
+    Returns a backend by name, or the best installed one.
+
+    Raises:
+        ValueError: If the backend is unknown or not installed.
+    """
+    if name is None:
+        return best_backend()
+    if name not in BACKENDS:
+        raise ValueError(f'Codec backend {name!r} is not available (installed: {", ".join(BACKENDS)})')
+    return BACKENDS[name]()
+
+
+class Message:
+    """
+    Base of the typed message structs; FIELDS lists the keys after type and
+    timestamp, OPTIONAL those among them left out of the wire format when None.
+    """
+    __slots__ = ('timestamp',)
+    TYPE = None
+    FIELDS = ()
+    OPTIONAL = ()
+
+    def to_dict(self):
+        data = {'type': self.TYPE, 'timestamp': self.timestamp}
+        for field in self.FIELDS:
+            value = getattr(self, field)
+            if value is not None or field not in self.OPTIONAL:
+                data[field] = value
+        return data
+
+    @classmethod
+    def from_dict(cls, data):
+        message = cls.__new__(cls)
+        message.timestamp = data.get('timestamp')
+        for field in cls.FIELDS:
+            setattr(message, field, data.get(field))
+        return message
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.to_dict() == other.to_dict()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+
+def _now():
+    return datetime.now().isoformat()
+
+
+class NicknameMessage(Message):
+    """The handshake a client sends after connecting; compression lists the algorithms it accepts."""
+    __slots__ = ('nickname', 'clientID', 'compression')
+    TYPE = 'nickname'
+    FIELDS = ('nickname', 'clientID', 'compression')
+    OPTIONAL = ('compression',)
+
+    def __init__(self, nickname, clientID, compression=None, timestamp=None):
+        self.timestamp = timestamp or _now()
+        self.nickname = nickname
+        self.clientID = clientID
+        self.compression = compression
+
+
+class ChatMessage(Message):
+    """A chat line sent to a room."""
+    __slots__ = ('nickname', 'message', 'room')
+    TYPE = 'message'
+    FIELDS = ('nickname', 'message', 'room')
+
+    def __init__(self, nickname, message, room=None, timestamp=None):
+        self.timestamp = timestamp or _now()
+        self.nickname = nickname
+        self.message = message
+        self.room = room
+
+
+class DirectMessage(Message):
+    """A chat line for one client, addressed by its nickname instead of a room."""
+    __slots__ = ('nickname', 'to', 'message')
+    TYPE = 'direct'
+    FIELDS = ('nickname', 'to', 'message')
+
+    def __init__(self, nickname, to, message, timestamp=None):
+        self.timestamp = timestamp or _now()
+        self.nickname = nickname
+        self.to = to
+        self.message = message
+
+
+class DisconnectMessage(Message):
+    """A client's request to end its session."""
+    __slots__ = ('nickname', 'clientID')
+    TYPE = 'disconnect'
+    FIELDS = ('nickname', 'clientID')
+
+    def __init__(self, nickname, clientID, timestamp=None):
+        self.timestamp = timestamp or _now()
+        self.nickname = nickname
+        self.clientID = clientID
+
+
+class BroadcastMessage(Message):
+    """A chat line as a server relays it to the other clients."""
+    __slots__ = ('nickname', 'message')
+    TYPE = 'broadcast'
+    FIELDS = ('nickname', 'message')
+
+    def __init__(self, nickname, message, timestamp=None):
+        self.timestamp = timestamp or _now()
+        self.nickname = nickname
+        self.message = message
+
+
+MESSAGE_TYPES = {cls.TYPE: cls for cls in (NicknameMessage, ChatMessage, DirectMessage, DisconnectMessage,
+                                                  BroadcastMessage)}
+
+
+class MessageCodec:
+    """
+    Encodes and decodes chat messages with one backend.
+
+    Args:
+        backend: A backend instance or name (default: the best installed one).
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None and not isinstance(backend, str) else make_backend(backend)
+        self.name = self.backend.name
+
+    def encode(self, message):
+        """Encodes a Message struct or a plain dict to JSON bytes."""
+        return self.backend.dumps(message.to_dict() if isinstance(message, Message) else message)
+
+    def decode(self, data):
+        """
+        Decodes a payload into a dict.
+
+        Raises:
+            CodecError: If the payload is not a JSON object.
+        """
+        try:
+            message = self.backend.loads(data)
+        except DECODE_ERRORS as e:
+            raise CodecError(f'Malformed message: {str(e)}') from None
+        if not isinstance(message, dict):
+            raise CodecError('Message is not a JSON object')
+        return message
+
+    def decode_message(self, data):
+        """
+        Decodes a payload into its typed struct (or a dict for types without one).
+
+        Raises:
+            CodecError: If the payload is not a JSON object with a string "type".
+        """
+        message = self.decode(data)
+        kind = message.get('type')
+        if not isinstance(kind, str):
+            raise CodecError('Message has no "type"')
+        cls = MESSAGE_TYPES.get(kind)
+        return cls.from_dict(message) if cls is not None else message
+
+    def validate(self, data):
+        """
+        Pass-through check: the payload must be a JSON object with a string "type".
+
+        Returns:
+            tuple: (message type, decoded dict); forward the original bytes, not the dict.
+        """
+        message = self.decode(data)
+        kind = message.get('type')
+        if not isinstance(kind, str):
+            raise CodecError('Message has no "type"')
+        return kind, message
+
+
+def benchmark(count):
+    """
+    Times encode/decode per message for every installed backend.
+
+    Returns:
+        list: One dict per backend with ns per message for each operation.
+    """
+    sample = ChatMessage('alice', 'hello there, this is a typical chat line of moderate length', 'lobby')
+    payload = MessageCodec('json').encode(sample)
+    results = []
+    for name in BACKENDS:
+        codec = MessageCodec(name)
+        timings = {}
+        operations = {
+            'encode struct': lambda: codec.encode(sample),
+            'encode dict': lambda: codec.backend.dumps({'type': 'message', 'timestamp': sample.timestamp,
+                                                        'nickname': 'alice', 'message': sample.message}),
+            'decode struct': lambda: codec.decode_message(payload),
+            'validate (pass-through)': lambda: codec.validate(payload),
+            'decode+re-encode': lambda: codec.backend.dumps(codec.backend.loads(payload)),
+        }
+        for operation, run in operations.items():
+            started = time.perf_counter_ns()
+            for _ in range(count):
+                run()
+            timings[operation] = (time.perf_counter_ns() - started) / count
+        results.append({'backend': name, 'ns_per_message': timings})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare chat message codec backends.')
+    parser.add_argument('--count', type=int, default=100000, help='Messages per measurement.')
+    args = parser.parse_args()
+    results = benchmark(args.count)
+    operations = list(results[0]['ns_per_message'])
+    print(f'{"backend":<10}' + ''.join(f'{operation:>26}' for operation in operations))
+    for result in results:
+        print(f'{result["backend"]:<10}' + ''.join(f'{result["ns_per_message"][op]:>23.0f} ns' for op in operations))
+
+
+if __name__ == '__main__':
+    main()
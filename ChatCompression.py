@@ -0,0 +1,138 @@
+# ChatCompression.py
+"""
+Frame compression for chat traffic.
+
+Chat frames are short JSON objects that repeat the same keys ("type",
+"timestamp", "nickname", ...) in every message, which plain deflate cannot
+exploit within a single small frame. Every frame is therefore compressed on
+its own with raw deflate primed with DICTIONARY, a preset dictionary of typical
+frames: a 157 byte chat message shrinks to about 68 bytes (127 without it).
+
+Because no stream state carries over between frames, a server compresses a
+broadcast once and sends the same compressed bytes to every recipient that
+negotiated compression, in any order. Clients offer the algorithm in their
+'nickname' handshake ("compression": ["deflate-dict"]) and the server answers
+with {"type": "compression", "algorithm": "deflate-dict"} if it agrees; only
+then does either side send compressed frames (ChatFraming marks them with a
+flag bit in the length header).
+
+Run this module to see the ratio and cost on sample frames:
+    python ChatCompression.py [--count 20000]
+"""
+
+import argparse
+import time
+import zlib
+
+ALGORITHM = 'deflate-dict'  # Name used in the handshake; change it whenever DICTIONARY changes
+ALGORITHMS = (ALGORITHM,)
+MIN_COMPRESS_SIZE = 64  # Smaller payloads are sent as they are
+LEVEL = 6
+WINDOW_BITS = -12  # Raw deflate with a 4 KiB window: room for the dictionary and any chat frame
+MEM_LEVEL = 5  # Smaller compressor state; a compressor is created for every frame
+
+# Typical frames from both codec spacings, most common last (deflate prefers the nearest match)
+DICTIONARY = (
+    b'{"type": "disconnect", "timestamp": "", "nickname": "", "clientID": ""}'
+    b'{"type":"error","message":"Not a member of room "}{"type":"join","room":"}{"type":"leave","room":"'
+    b'{"type": "nickname", "timestamp": "2026-10-17T00:00:00.000000", "nickname": "", "clientID": "", '
+    b'"compression": ["deflate-dict"]}'
+    b'{"type":"nickname","timestamp":"2026-10-17T00:00:00.000000","nickname":"","clientID":"",'
+    b'"compression":["deflate-dict"]}'
+    b'{"type": "message", "timestamp": "2026-10-17T00:00:00.000000", "nickname": "", "message": "", '
+    b'"room": "lobby", "id": 1'
+    b'{"type":"message","timestamp":"2026-10-17T00:00:00.000000","nickname":"","message":" the ",'
+    b'"room":"lobby","id":1'
+)
+
+
+class CompressionError(ValueError):
+    """Raised when a compressed payload cannot be decompressed."""
+
+
+def negotiate(offer):
+    """
+    Picks the algorithm to use from a client's handshake offer.
+
+    Args:
+        offer: The handshake's "compression" value (a list of names, or None).
+
+    Returns:
+        str: The first offered algorithm this side supports, or None.
+    """
+    if not isinstance(offer, list):
+        return None
+    for name in offer:
+        if name in ALGORITHMS:
+            return name
+    return None
+
+
+def compress(payload):
+    """
+    Compresses one payload on its own.
+
+    Returns:
+        bytes: The compressed payload, or None if it is too small or would not shrink.
+    """
+    if len(payload) < MIN_COMPRESS_SIZE:
+        return None
+    compressor = zlib.compressobj(LEVEL, zlib.DEFLATED, WINDOW_BITS, MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, DICTIONARY)
+    compressed = compressor.compress(payload) + compressor.flush()
+    return compressed if len(compressed) < len(payload) else None
+
+
+def decompress(data, max_size):
+    """
+    Decompresses one payload.
+
+    Args:
+        data: The compressed payload.
+        max_size: Refuse to produce more than this many bytes.
+
+    Raises:
+        CompressionError: If the data is corrupt or expands beyond max_size.
+    """
+    decompressor = zlib.decompressobj(WINDOW_BITS, zdict=DICTIONARY)
+    try:
+        payload = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise CompressionError(f'Corrupt compressed frame: {str(e)}') from None
+    if decompressor.unconsumed_tail:
+        raise CompressionError(f'Compressed frame expands beyond {max_size} bytes')
+    if not decompressor.eof:
+        raise CompressionError('Truncated compressed frame')
+    return payload
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure chat frame compression.')
+    parser.add_argument('--count', type=int, default=20000, help='Frames per measurement.')
+    args = parser.parse_args()
+
+    from ChatClient import ChatClient  # Only for building realistic sample frames
+    session = ChatClient('127.0.0.1', 0, 'alice', '001', create_socket=False)
+    samples = {
+        'nickname': session.get_nickname_string().encode(),
+        'message': session.get_message_string('hello there, this is a typical chat line').encode(),
+        'long message': session.get_message_string('lorem ipsum dolor sit amet ' * 20).encode(),
+    }
+    print(f'{"frame":<14}{"bytes":>8}{"compressed":>12}{"no dictionary":>15}{"compress":>12}{"decompress":>12}')
+    for name, payload in samples.items():
+        compressed = compress(payload) or payload
+        plain = zlib.compressobj(LEVEL, zlib.DEFLATED, WINDOW_BITS)
+        without = len(plain.compress(payload) + plain.flush())
+        started = time.perf_counter_ns()
+        for _ in range(args.count):
+            compress(payload)
+        compress_ns = (time.perf_counter_ns() - started) / args.count
+        started = time.perf_counter_ns()
+        for _ in range(args.count):
+            decompress(compressed, len(payload))
+        decompress_ns = (time.perf_counter_ns() - started) / args.count
+        print(f'{name:<14}{len(payload):>8}{len(compressed):>12}{without:>15}'
+              f'{compress_ns / 1000:>10.1f}us{decompress_ns / 1000:>10.1f}us')
+
+
+if __name__ == '__main__':
+    main()
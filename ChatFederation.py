@@ -0,0 +1,276 @@
+# ChatFederation.py
+"""
+Server-to-server federation for ChatServer.
+
+Servers started with --peer host:port dial each other's client port and
+announce themselves with a 'peer_hello' message; from then on the connection is
+a peer link instead of a client. Every room message a node delivers locally is
+wrapped once in a 'relay' envelope with a unique message ID and flooded to all
+peer links. A node that receives a relay delivers it to its own clients and
+forwards it to its other peers. Loops are cut by never sending a relay back
+over the link it arrived on and by dropping IDs that were already seen.
+
+Every node of a federation is configured with the same shared secret. A
+'peer_hello' carries an HMAC of the sender's node ID, the time and a random
+nonce under that secret; a connection is only promoted to a peer link if the
+HMAC matches, the time is within PEER_HELLO_MAX_AGE of the local clock and the
+nonce has not been used before, so ordinary clients cannot inject relays and a
+captured hello cannot be replayed.
+"""
+
+from collections import OrderedDict
+import hashlib
+import hmac
+import itertools
+import json
+import os
+import logging
+import socket
+import threading
+import time
+import uuid
+
+from ChatBackpressure import make_policy
+from ChatFraming import encode_frame, iter_frames
+from ChatMetrics import CounterSet
+from ChatOutbound import SocketConnection
+from ChatTLS import client_handshake
+
+SEEN_CAPACITY = 65536  # Message IDs remembered for de-duplication
+PEER_HIGH_WATERMARK = 16 * 1024 * 1024  # Backlog a peer link may build before relays are dropped
+PEER_LOW_WATERMARK = 4 * 1024 * 1024
+RECONNECT_DELAY = 0.5  # First retry delay for a peer that cannot be reached; doubles up to MAX_RECONNECT_DELAY
+MAX_RECONNECT_DELAY = 10.0
+PONG_FRAME = encode_frame(json.dumps({"type": "pong"}))
+PEER_HELLO_MAX_AGE = 60.0  # Seconds a 'peer_hello' stays valid; allows for clock skew between nodes
+
+
+def parse_peer(value):
+    """
+    Parses a --peer argument.
+
+    Args:
+        value: A "host:port" string.
+
+    Returns:
+        tuple: (host, port)
+    """
+    host, sep, port = value.rpartition(':')
+    if not sep or not host or not port.isdigit() or not 1 <= int(port) <= 65535:
+        raise ValueError(f'Peer {value!r} must be given as host:port')
+    return host, int(port)
+
+
+class FederationStats(CounterSet):
+    """Counters of the relays this node published, received, forwarded and dropped as duplicates."""
+    FIELDS = ('published', 'relayed_in', 'forwarded', 'duplicates')
+
+
+class PeerLink:
+    """One connection to another node, whichever side dialed it."""
+    __slots__ = ('node', 'addr', 'connection', 'record')
+
+    def __init__(self, node, addr, connection, record=None):
+        self.node = node
+        self.addr = addr
+        self.connection = connection
+        self.record = record  # The ClientRecord of an accepted link, which the server's heartbeat watches
+
+
+class Federation:
+    """
+    The peer links of one node and the relay/de-duplication logic.
+
+    Dialed links are served by a thread each; accepted links are read by the
+    server's own engine, which hands their frames to handle_relay(). With the
+    asyncio engine, frames from dialed links are handed to the event loop too,
+    so relays are always forwarded to accepted links from the loop thread.
+    """
+
+    def __init__(self, server, node_id=None, peers=(), secret=None):
+        if not secret:
+            raise ValueError('Federation needs a shared peer secret')
+        self.server = server
+        self.node_id = node_id or uuid.uuid4().hex[:12]
+        self.peers = list(peers)
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.logger = logging.getLogger(__name__)
+        self.links = {}  # addr -> PeerLink
+        self._snapshot = ()  # Links as an immutable tuple for flooding without the lock
+        self._lock = threading.Lock()
+        self._seq = itertools.count(1)
+        self._seen = OrderedDict()
+        self._seen_lock = threading.Lock()
+        self.policy = make_policy('drop-newest', PEER_HIGH_WATERMARK, PEER_LOW_WATERMARK)
+        self.stats = FederationStats()
+        self.tls = None  # ChatTLS client context for dialing peers that serve TLS
+
+    def start(self):
+        """Starts dialing every configured peer in the background."""
+        for addr in self.peers:
+            threading.Thread(target=self._dial_loop, args=(addr,), name=f'peer-{addr[0]}:{addr[1]}', daemon=True).start()
+
+    def hello_string(self):
+        sent = time.time()
+        nonce = os.urandom(16).hex()
+        return json.dumps({"type": "peer_hello", "node": self.node_id, "time": sent, "nonce": nonce,
+                           "auth": self._sign(self.node_id, sent, nonce)})
+
+    def _sign(self, node, sent, nonce):
+        return hmac.new(self.secret, f'{node}|{sent!r}|{nonce}'.encode(), hashlib.sha256).hexdigest()
+
+    def authenticate(self, hello):
+        """
+        Checks a 'peer_hello' against the shared secret.
+
+        Returns:
+            bool: True if it was signed with the secret, is recent and has not been seen before.
+        """
+        try:
+            node, sent, nonce, auth = str(hello['node']), float(hello['time']), str(hello['nonce']), str(hello['auth'])
+        except (KeyError, TypeError, ValueError):
+            return False
+        if abs(time.time() - sent) > PEER_HELLO_MAX_AGE:
+            return False
+        if not hmac.compare_digest(auth, self._sign(node, sent, nonce)):
+            return False
+        return self._mark_seen(f'hello:{nonce}')  # A replayed hello reuses its nonce
+
+    def publish(self, room, payload):
+        """
+        Floods a message that one of this node's clients sent to every peer.
+
+        Args:
+            room: The room the message was sent to.
+            payload: The client's original message bytes.
+        """
+        links = self._snapshot
+        if not links:
+            return
+        msg_id = f'{self.node_id}:{next(self._seq)}'
+        self._mark_seen(msg_id)
+        envelope = json.dumps({"type": "relay", "id": msg_id, "origin": self.node_id,
+                               "room": room, "payload": payload.decode()})
+        frame = encode_frame(envelope)  # Framed once for every peer
+        for link in links:
+            link.connection.send(frame)
+        self.stats.record('published')
+
+    def handle_relay(self, addr, data):
+        """
+        Delivers a relay from a peer locally and forwards it to the other peers.
+
+        Args:
+            addr: The address of the link it arrived on.
+            data: The raw 'relay' frame payload.
+        """
+        try:
+            envelope = json.loads(data)
+            kind = envelope.get('type')
+            if kind == 'ping':  # The accepting node checks that a dialed link is alive
+                link = self.links.get(addr)
+                if link is not None:
+                    link.connection.send(PONG_FRAME)
+                return
+            if kind != 'relay':
+                return
+            msg_id = envelope['id']
+            room = envelope['room']
+            payload = envelope['payload']
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self.logger.error(f'Malformed relay from peer {addr}: {str(e)}')
+            return
+        if not self._mark_seen(msg_id):
+            self.stats.record('duplicates')
+            return
+        self.stats.record('relayed_in')
+        self.server.deliver_federated(room, payload.encode(), envelope.get('origin'))
+        frame = encode_frame(data)  # Forward the envelope exactly as received
+        forwarded = 0
+        for link in self._snapshot:
+            if link.addr != addr:
+                link.connection.send(frame)
+                forwarded += 1
+        if forwarded:
+            self.stats.record('forwarded', forwarded)
+
+    def accept_peer(self, record, hello):
+        """
+        Turns an accepted client connection into a peer link after its 'peer_hello'.
+
+        Args:
+            record: The connection's ClientRecord; it is removed from the client registry.
+            hello: The decoded 'peer_hello' message.
+
+        Returns:
+            bool: False if the hello did not authenticate; the connection stays an ordinary client.
+        """
+        if not self.authenticate(hello):
+            self.logger.warning(f'Rejected an unauthenticated peer_hello from {record.addr}')
+            return False
+        self.server.clients.remove(record.addr)
+        record.peer = self._add_link(PeerLink(hello.get('node'), record.addr, record.connection, record))
+        self.logger.info(f'Peer {hello.get("node")} connected from {record.addr}')
+        return True
+
+    def remove_peer(self, addr):
+        """
+        Drops a peer link and closes its connection.
+
+        Returns:
+            PeerLink: The link that was dropped, or None if addr is not a peer link.
+        """
+        with self._lock:
+            link = self.links.pop(addr, None)
+            if link is None:
+                return None
+            self._snapshot = tuple(self.links.values())
+        link.connection.close()
+        self.logger.info(f'Peer {link.node} at {addr} disconnected')
+        return link
+
+    def _add_link(self, link):
+        with self._lock:
+            self.links[link.addr] = link
+            self._snapshot = tuple(self.links.values())
+        return link
+
+    def _mark_seen(self, msg_id):
+        """Remembers a message ID; returns False if it had already been seen."""
+        with self._seen_lock:
+            if msg_id in self._seen:
+                return False
+            self._seen[msg_id] = None
+            if len(self._seen) > SEEN_CAPACITY:
+                self._seen.popitem(last=False)
+        return True
+
+    def _dial_loop(self, addr):
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                sock = socket.create_connection(addr)
+                if self.tls is not None:
+                    sock = client_handshake(self.tls, sock, addr[0])
+            except OSError as e:
+                self.logger.warning(f'Cannot reach peer {addr[0]}:{addr[1]} ({str(e)}); retrying in {delay:.1f}s')
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            delay = RECONNECT_DELAY
+            local = sock.getsockname()
+            connection = SocketConnection(sock, addr, self.policy)
+            connection.send(encode_frame(self.hello_string()))
+            self._add_link(PeerLink(None, local, connection))
+            self.logger.info(f'Linked to peer {addr[0]}:{addr[1]}')
+            try:
+                for data in iter_frames(sock):
+                    loop = self.server.loop
+                    if loop is not None:  # Accepted links are ChatProtocols; only the event loop may write to them
+                        loop.call_soon_threadsafe(self.handle_relay, local, data)
+                    else:
+                        self.handle_relay(local, data)
+            except OSError as e:
+                self.logger.warning(f'Peer link to {addr[0]}:{addr[1]} failed: {str(e)}')
+            self.remove_peer(local)
+            time.sleep(delay)
@@ -0,0 +1,142 @@
+# ChatFraming.py
+"""
+Length-prefixed message framing shared by ChatServer and ChatClient.
+
+Every message on the wire is a 4-byte big-endian payload length followed by the
+payload bytes, so one recv() may carry several messages or only part of one.
+FrameDecoder reassembles frames incrementally from whatever the socket returns.
+The top bit of the length marks a payload compressed with ChatCompression;
+the decoder inflates such frames, so callers only ever see plain payloads.
+"""
+
+import struct
+
+from ChatCompression import CompressionError, compress, decompress
+
+HEADER = struct.Struct('!I')
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # Refuse frames larger than 16 MiB
+RECV_SIZE = 64 * 1024  # Bytes requested per recv() call
+COMPRESSED_FLAG = 0x80000000  # Length header bit marking a compressed payload
+_COMPACT_THRESHOLD = 64 * 1024  # Consumed bytes tolerated at the head of the buffer
+
+
+class FrameError(ValueError):
+    """Raised when the peer sends a frame header that cannot be valid."""
+
+
+def encode_frame(payload, compressed=False):
+    """
+    Prefixes a payload with its length.
+
+    Args:
+        payload: The message bytes (str is encoded as UTF-8).
+        compressed: The payload is already compressed; set the flag bit.
+
+    Returns:
+        bytes: The framed message, ready for sendall()/transport.write().
+    """
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f'Frame of {len(payload)} bytes exceeds the {MAX_FRAME_SIZE} byte limit')
+    return HEADER.pack(len(payload) | COMPRESSED_FLAG if compressed else len(payload)) + payload
+
+
+def compress_frame(frame):
+    """
+    Returns the compressed form of an encoded plain frame, or the frame itself if compressing does not pay.
+    """
+    compressed = compress(memoryview(frame)[HEADER_SIZE:])
+    return frame if compressed is None else encode_frame(compressed, compressed=True)
+
+
+class FrameDecoder:
+    """
+    Incremental frame reassembly over a single growing bytearray.
+
+    Incoming chunks are appended to the buffer and complete frames are sliced out
+    through a memoryview, so each byte is copied once on the way in and once on
+    the way out regardless of how TCP split or coalesced the stream. Consumed
+    bytes are discarded lazily, only once they make up most of the buffer.
+    """
+    __slots__ = ('_buffer', '_start', 'max_frame_size')
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self._buffer = bytearray()
+        self._start = 0  # Offset of the first unconsumed byte in _buffer
+        self.max_frame_size = max_frame_size
+
+    def __len__(self):
+        """Number of buffered bytes that do not yet form a complete frame."""
+        return len(self._buffer) - self._start
+
+    def feed(self, data):
+        """
+        Appends received bytes and returns every frame they complete.
+
+        Args:
+            data: Bytes as returned by recv() or data_received().
+
+        Returns:
+            list: The payloads (bytes) of all complete frames, in order.
+
+        Raises:
+            FrameError: If a frame header announces more than max_frame_size bytes,
+                or a compressed frame cannot be inflated.
+        """
+        buffer = self._buffer
+        buffer += data
+        start = self._start
+        end = len(buffer)
+        frames = []
+        view = memoryview(buffer)
+        try:
+            while end - start >= HEADER_SIZE:
+                (length,) = HEADER.unpack_from(buffer, start)
+                flagged = length & COMPRESSED_FLAG
+                length &= ~COMPRESSED_FLAG
+                if length > self.max_frame_size:
+                    raise FrameError(f'Frame of {length} bytes exceeds the {self.max_frame_size} byte limit')
+                stop = start + HEADER_SIZE + length
+                if stop > end:
+                    break  # Wait for the rest of this frame
+                if flagged:
+                    try:
+                        frames.append(decompress(view[start + HEADER_SIZE:stop], self.max_frame_size))
+                    except CompressionError as e:
+                        raise FrameError(str(e)) from None
+                else:
+                    frames.append(bytes(view[start + HEADER_SIZE:stop]))
+                start = stop
+        finally:
+            view.release()  # The bytearray cannot be resized while a view is exported
+
+        if start == end:
+            buffer.clear()
+            start = 0
+        elif start >= _COMPACT_THRESHOLD and start >= end - start:
+            del buffer[:start]
+            start = 0
+        self._start = start
+        return frames
+
+    def pending(self):
+        """Returns the buffered bytes that do not yet form a complete frame."""
+        return bytes(self._buffer[self._start:])
+
+
+def iter_frames(sock, decoder=None):
+    """
+    Yields the payload of each frame read from a blocking socket until EOF.
+
+    Args:
+        sock: A connected blocking socket.
+        decoder: An optional FrameDecoder carrying state from earlier reads.
+    """
+    decoder = decoder if decoder is not None else FrameDecoder()
+    while True:
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return
+        yield from decoder.feed(data)
@@ -0,0 +1,293 @@
+# ChatHandoff.py
+"""
+Zero-downtime restarts: a new ChatServer process takes over from a running one.
+
+The running server (started with --handoff-socket PATH) listens on a Unix
+socket. A new server started with --takeover PATH connects to it, and the old
+process hands over, in order:
+
+1. the listening socket, so connection attempts queue in the same backlog and
+   nothing is refused while the processes switch;
+2. room history and the message ID sequence (or, with --journal, it closes
+   the journal for the new process to reopen);
+3. every client connection with its registry state (client ID, nickname,
+   rooms, negotiated compression) and any partial frame it had received.
+
+Sockets travel as SCM_RIGHTS ancillary data, so the kernel connections never
+close and clients see nothing but a short pause. Before a client is exported
+the old process stops reading from it and waits until its outbound queue and
+transport buffer are empty; from then on only the new process reads or writes
+the socket. Unread bytes stay in the kernel receive queue for the new process.
+
+Connections that cannot move are closed and reconnect: TLS sessions (their
+OpenSSL state lives in the old process), federation peer links (peers redial)
+and clients whose backlog did not drain within DRAIN_TIMEOUT. If the new process
+fails before confirming that it holds the sockets, the old one adopts its own
+exported sessions again and carries on.
+
+Messages on the Unix socket are ChatFraming frames holding JSON objects; one
+whose "fd" is true owns the next descriptor received, and every descriptor is
+sent with the first bytes of its own frame, so descriptors and frames arrive in
+the same order.
+"""
+
+import asyncio
+import base64
+from collections import deque
+import json
+import logging
+import os
+import socket
+import threading
+
+from ChatFraming import FrameDecoder, RECV_SIZE, encode_frame
+
+DRAIN_TIMEOUT = 5.0  # Seconds the old process waits for clients' outbound backlogs to be written
+TAKEOVER_TIMEOUT = 30.0  # Seconds either side waits for the other before giving up
+MAX_FDS = 16  # Descriptors accepted per recvmsg(); Linux delivers at most one sender's batch at a time
+
+
+class HandoffError(ConnectionError):
+    """Raised when the other process breaks off a handoff."""
+
+
+class Session:
+    """
+    One client connection being moved between processes.
+
+    Args:
+        sock: The client's socket (a duplicate owned by the handoff).
+        pending: Bytes received that do not yet form a complete frame.
+    """
+    __slots__ = ('sock', 'client_id', 'nickname', 'client_ref', 'rooms', 'compression', 'pending')
+
+    def __init__(self, sock, client_id, nickname=None, client_ref=None, rooms=(), compression=None, pending=b''):
+        self.sock = sock
+        self.client_id = client_id
+        self.nickname = nickname
+        self.client_ref = client_ref
+        self.rooms = list(rooms)
+        self.compression = compression
+        self.pending = pending
+
+    def to_message(self):
+        return {"type": "session", "fd": True, "client_id": self.client_id, "nickname": self.nickname,
+                "client_ref": self.client_ref, "rooms": self.rooms, "compression": self.compression,
+                "pending": base64.b64encode(self.pending).decode()}
+
+    @classmethod
+    def from_message(cls, message, sock):
+        return cls(sock, message["client_id"], message.get("nickname"), message.get("client_ref"),
+                   message.get("rooms", ()), message.get("compression"), base64.b64decode(message.get("pending", "")))
+
+
+class Export:
+    """Everything the old process hands over, collected on its event loop."""
+    __slots__ = ('listener', 'history', 'sessions', 'left_behind')
+
+    def __init__(self, listener, history, sessions, left_behind):
+        self.listener = listener  # Duplicate of the listening socket
+        self.history = history  # HistoryStore.export() result, or None
+        self.sessions = sessions  # Session list
+        self.left_behind = left_behind  # Connections that will be closed instead (TLS, peers, undrained)
+
+
+def send_message(sock, message, fd=None):
+    """Sends one JSON message, with a descriptor attached if fd is given."""
+    frame = encode_frame(json.dumps(message))
+    if fd is None:
+        sock.sendall(frame)
+        return
+    sent = socket.send_fds(sock, [frame], [fd])
+    if sent < len(frame):
+        sock.sendall(frame[sent:])  # The descriptor went with the first chunk
+
+
+class MessageReader:
+    """Reads the JSON messages and descriptors sent by send_message()."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.decoder = FrameDecoder()
+        self.frames = deque()
+        self.fds = deque()
+
+    def receive(self):
+        """
+        Returns the next message and the socket it carries.
+
+        Returns:
+            tuple: (message dict, socket.socket or None), or (None, None) at EOF.
+        """
+        while not self.frames:
+            data, fds, _, _ = socket.recv_fds(self.sock, RECV_SIZE, MAX_FDS)
+            self.fds.extend(fds)
+            if not data:
+                self.close()
+                return None, None
+            self.frames.extend(self.decoder.feed(data))
+        message = json.loads(self.frames.popleft())
+        sock = None
+        if message.get("fd"):
+            if not self.fds:
+                raise HandoffError('A handoff message arrived without its socket')
+            sock = socket.socket(fileno=self.fds.popleft())
+        return message, sock
+
+    def close(self):
+        """Closes descriptors received but never claimed by a message."""
+        while self.fds:
+            os.close(self.fds.popleft())
+
+
+class HandoffListener:
+    """
+    Serves takeover requests for a running asyncio ChatServer.
+
+    The exchange runs on its own thread; only collecting the sessions and the
+    final switch happen on the server's event loop.
+
+    Args:
+        server: The ChatServer; it provides export_sessions(), resume_after_handoff() and finish_handoff().
+        path: The Unix socket path new processes connect to.
+    """
+
+    def __init__(self, server, path):
+        self.server = server
+        self.path = path
+        self.loop = server.loop
+        self.logger = logging.getLogger(__name__)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            os.unlink(path)  # Left behind by the process this one took over from
+        self.sock.bind(path)
+        self.sock.listen(1)
+        threading.Thread(target=self._serve, name='handoff', daemon=True).start()
+
+    def _serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            conn.settimeout(TAKEOVER_TIMEOUT)
+            try:
+                if self._handoff(conn):
+                    return
+            except Exception as e:
+                self.logger.error(f'Handoff failed: {str(e)}')
+            finally:
+                conn.close()
+
+    def _handoff(self, conn):
+        """Runs one takeover; returns True once the new process owns everything."""
+        reader = MessageReader(conn)
+        request, _ = reader.receive()
+        if request is None or request.get("type") != "takeover":
+            return False
+        self.logger.info('A new server process is taking over')
+        export = self._call(self.server.export_sessions())
+        try:
+            send_message(conn, {"type": "listener", "fd": True}, export.listener.fileno())
+            history = export.history
+            if history is not None:
+                for room, messages in history["rooms"].items():
+                    messages = [[msg_id, base64.b64encode(frame).decode()] for msg_id, frame in messages]
+                    send_message(conn, {"type": "history", "room": room, "messages": messages})
+                send_message(conn, {"type": "history_end", "last_id": history["last_id"], "epoch": history["epoch"]})
+            for session in export.sessions:
+                send_message(conn, session.to_message(), session.sock.fileno())
+            send_message(conn, {"type": "end", "sessions": len(export.sessions)})
+            reply, _ = reader.receive()
+            if reply is None or reply.get("type") != "ready":
+                raise HandoffError('The new process did not confirm the handoff')
+        except (OSError, ValueError) as e:
+            self.logger.error(f'Handoff aborted, resuming service: {str(e)}')
+            self._call(self.server.resume_after_handoff(export))
+            return False
+        # The new process holds every socket now; only the journal is left to give up
+        if self.server.history is not None:
+            self.server.history.close()
+        send_message(conn, {"type": "done"})
+        export.listener.close()
+        for session in export.sessions:
+            session.sock.close()  # Our duplicates only; the connections live on in the new process
+        self.logger.info(f'Handed over {len(export.sessions)} clients; {export.left_behind} will reconnect')
+        self.loop.call_soon_threadsafe(self.server.finish_handoff)
+        return True
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+
+class Takeover:
+    """
+    What a new process received from the one it takes over from.
+
+    Attributes:
+        listener: The listening socket.
+        history: The old process's HistoryStore.export(), or None.
+        sessions: Session list.
+    """
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(TAKEOVER_TIMEOUT)
+        self.sock.connect(path)
+        self.reader = MessageReader(self.sock)
+        self.listener = None
+        self.history = None
+        self.sessions = []
+
+    def receive(self):
+        """
+        Asks for the handoff and receives everything up to the end marker.
+
+        Raises:
+            HandoffError: If the old process closes the connection first.
+        """
+        send_message(self.sock, {"type": "takeover", "pid": os.getpid()})
+        rooms = {}
+        while True:
+            message, sock = self.reader.receive()
+            if message is None:
+                raise HandoffError('The running server closed the handoff connection')
+            kind = message.get("type")
+            if kind == "listener":
+                self.listener = sock
+            elif kind == "history":
+                rooms[message["room"]] = [(msg_id, base64.b64decode(frame)) for msg_id, frame in message["messages"]]
+            elif kind == "history_end":
+                self.history = {"rooms": rooms, "last_id": message["last_id"], "epoch": message.get("epoch")}
+            elif kind == "session":
+                self.sessions.append(Session.from_message(message, sock))
+            elif kind == "end":
+                break
+        if self.listener is None:
+            raise HandoffError('The running server did not send its listening socket')
+
+    def confirm(self):
+        """Tells the old process every socket arrived and waits until it has let go of them."""
+        send_message(self.sock, {"type": "ready"})
+        try:
+            self.reader.receive()  # 'done', or EOF if the old process exited first
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def take_over(path):
+    """
+    Connects to a running server's handoff socket and receives its listener, history and clients.
+
+    Returns:
+        Takeover: The received state; call confirm() once it is safe for the old process to exit.
+    """
+    takeover = Takeover(path)
+    try:
+        takeover.receive()
+    except BaseException:
+        takeover.sock.close()
+        for session in takeover.sessions:
+            session.sock.close()
+        if takeover.listener is not None:
+            takeover.listener.close()
+        raise
+    return takeover
@@ -0,0 +1,314 @@
+# ChatHistory.py
+"""
+Recent message history for ChatServer rooms.
+
+Each room keeps a fixed-capacity ring buffer of already-encoded broadcast
+frames, optionally capped in bytes as well, so replaying history to a client is
+a single join of existing bytes objects. Messages get a server-wide increasing
+message ID, stamped into the JSON before it is framed, which lets a client that
+reconnects ask for everything after the last ID it saw. The store's epoch names
+its ID sequence, so a client can tell when a restart has started IDs over.
+
+With a ChatJournal.Journal attached, every recorded message is also journaled,
+message IDs continue where the journal left off, the buffers are refilled from
+it on startup, and requests for IDs older than a buffer holds are answered from
+the journal, a bounded window at a time.
+"""
+
+from collections import OrderedDict
+import itertools
+import os
+import threading
+
+from ChatFraming import encode_frame
+
+DEFAULT_HISTORY = 100  # Messages kept per room
+DEFAULT_HISTORY_BYTES = 128 * 1024  # Encoded bytes kept per room
+DEFAULT_REPLAY = 20  # Messages replayed to a client when it joins a room
+MAX_ROOMS = 1024  # Rooms with history; the least recently written is forgotten first
+RESTORE_MESSAGES = 100000  # Newest journaled messages scanned to refill the buffers on startup
+JOURNAL_SCAN_WINDOW = 10000  # Message IDs one history request may scan in the journal
+
+
+def stamp_message_id(payload, msg_id):
+    """
+    Adds an "id" field to a JSON object payload without re-serializing it.
+
+    Args:
+        payload: The message bytes, expected to be a JSON object.
+        msg_id: The message ID to add.
+
+    Returns:
+        bytes: The stamped payload, or payload unchanged if it is not a JSON object.
+    """
+    end = payload.rstrip()
+    if not end.endswith(b'}'):
+        return payload
+    body = end[:-1].rstrip()
+    separator = b'' if body.endswith(b'{') else b', '
+    return b'%s%s"id": %d}' % (body, separator, msg_id)
+
+
+class RoomHistory:
+    """
+    Ring buffer of (message ID, frame) pairs for one room.
+
+    IDs only ever increase, so lookups by ID are a binary search over the ring.
+    """
+    __slots__ = ('capacity', 'max_bytes', '_ids', '_frames', '_head', '_size', 'bytes', 'evicted_id')
+
+    def __init__(self, capacity=DEFAULT_HISTORY, max_bytes=DEFAULT_HISTORY_BYTES):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self._ids = [0] * capacity
+        self._frames = [None] * capacity
+        self._head = 0  # Slot of the oldest entry
+        self._size = 0
+        self.bytes = 0
+        self.evicted_id = 0  # Highest ID no longer held; older messages may exist elsewhere
+
+    def __len__(self):
+        return self._size
+
+    def append(self, msg_id, frame):
+        """Adds the newest frame, evicting the oldest ones past the capacity or byte cap."""
+        if self._size == self.capacity:
+            self._evict_oldest()
+        slot = (self._head + self._size) % self.capacity
+        self._ids[slot] = msg_id
+        self._frames[slot] = frame
+        self._size += 1
+        self.bytes += len(frame)
+        while self.max_bytes and self.bytes > self.max_bytes and self._size > 1:
+            self._evict_oldest()
+
+    def _evict_oldest(self):
+        slot = self._head
+        self.evicted_id = self._ids[slot]
+        self.bytes -= len(self._frames[slot])
+        self._frames[slot] = None
+        self._head = (slot + 1) % self.capacity
+        self._size -= 1
+
+    def _slice(self, first):
+        """Frames from logical position first (0 = oldest) to the newest."""
+        return [self._frames[(self._head + index) % self.capacity] for index in range(first, self._size)]
+
+    def last(self, count):
+        """Returns up to count of the newest frames, oldest first."""
+        return self._slice(max(0, self._size - count))
+
+    def since(self, msg_id, max_bytes=None, taken=0):
+        """
+        Returns the frames of the messages with an ID greater than msg_id, oldest first.
+
+        Args:
+            max_bytes: Stop before the frames exceed this many bytes (at least one frame is
+                returned unless taken is given).
+            taken: Bytes the caller's answer already holds, counted against max_bytes.
+
+        Returns:
+            tuple: (frames, resume): resume is the ID to continue after if max_bytes cut the
+                answer short, else None.
+        """
+        low, high = 0, self._size
+        while low < high:
+            middle = (low + high) // 2
+            if self._ids[(self._head + middle) % self.capacity] <= msg_id:
+                low = middle + 1
+            else:
+                high = middle
+        if max_bytes is None:
+            return self._slice(low), None
+        frames = []
+        resume = msg_id
+        for index in range(low, self._size):
+            slot = (self._head + index) % self.capacity
+            frame = self._frames[slot]
+            if (frames or taken) and taken + len(frame) > max_bytes:
+                return frames, resume
+            frames.append(frame)
+            taken += len(frame)
+            resume = self._ids[slot]
+        return frames, None
+
+    def oldest_id(self):
+        """The ID of the oldest message still held, or None if empty."""
+        return self._ids[self._head] if self._size else None
+
+
+class HistoryStore:
+    """Per-room RoomHistory buffers plus the server-wide message ID sequence."""
+
+    def __init__(self, capacity=DEFAULT_HISTORY, max_bytes=DEFAULT_HISTORY_BYTES, replay=DEFAULT_REPLAY, journal=None):
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.replay = replay
+        self.journal = journal
+        self._rooms = OrderedDict()
+        self._ids = itertools.count(1)
+        self.last_id = 0  # ID of the newest recorded message
+        self.epoch = os.urandom(8).hex()  # Names this ID sequence; a journal keeps its own across restarts
+        self._lock = threading.Lock()
+        if journal is not None:
+            self._restore()
+
+    def record(self, room, payload, msg_id=None):
+        """
+        Assigns the next message ID, stamps it into the payload and stores the frame.
+
+        ID assignment, the append and the journal append happen under one lock so
+        each ring and the journal stay sorted by ID.
+
+        Args:
+            room: The room the message was sent to.
+            payload: The message bytes.
+            msg_id: An ID assigned elsewhere (the ChatWorkers bus) instead of the next one of this store;
+                it must be greater than every ID recorded so far.
+
+        Returns:
+            tuple: (message ID, frame)
+        """
+        with self._lock:
+            if msg_id is None:
+                msg_id = next(self._ids)
+            stamped = stamp_message_id(payload, msg_id)
+            frame = encode_frame(stamped)
+            self._room(room).append(msg_id, frame)
+            self.last_id = msg_id
+            if self.journal is not None:
+                self.journal.append(msg_id, room, stamped)  # Queued only; the journal fsyncs in batches
+        return msg_id, frame
+
+    def _room(self, room):
+        """The RoomHistory of a room, created if needed; call with the lock held."""
+        history = self._rooms.get(room)
+        if history is None:
+            history = self._rooms[room] = RoomHistory(self.capacity, self.max_bytes)
+            if self.journal is not None:
+                history.evicted_id = self.last_id  # Earlier messages of this room can only be in the journal
+            if len(self._rooms) > MAX_ROOMS:
+                self._rooms.popitem(last=False)
+        else:
+            self._rooms.move_to_end(room)
+        return history
+
+    def _restore(self):
+        """Refills the buffers from the newest journaled messages and continues their IDs."""
+        last_id = self.journal.last_id
+        with self._lock:
+            self.last_id = max(0, last_id - RESTORE_MESSAGES)  # Buffers only cover what is scanned below
+            for record in self.journal.reader().scan(self.last_id):
+                self._room(record.room).append(record.msg_id, encode_frame(record.payload))
+            self.last_id = last_id
+            self._ids = itertools.count(last_id + 1)
+            self.epoch = self.journal.epoch
+
+    def recent(self, room, count=None):
+        """Returns the newest frames of a room (default: the replay count), oldest first."""
+        with self._lock:
+            history = self._rooms.get(room)
+            return history.last(self.replay if count is None else count) if history is not None else []
+
+    def since(self, room, msg_id, max_bytes=None):
+        """
+        Returns the frames of a room's messages after msg_id, oldest first.
+
+        If the buffer no longer reaches back to msg_id, the journal is read
+        instead (see journal_since()), so the answer may be partial.
+
+        Args:
+            max_bytes: Stop before the frames exceed this many bytes (at least one frame is returned).
+
+        Returns:
+            tuple: (frames, resume): resume is the message ID to ask for next, or None once complete.
+        """
+        answer = self.buffered_since(room, msg_id, max_bytes)
+        if answer is not None:
+            return answer
+        return self.journal_since(room, msg_id, max_bytes)
+
+    def buffered_since(self, room, msg_id, max_bytes=None, taken=0):
+        """
+        Returns the frames after msg_id from the room's buffer, without touching disk.
+
+        Returns:
+            tuple: (frames, resume) as for since(), or None if only the journal reaches back to msg_id.
+        """
+        with self._lock:
+            history = self._rooms.get(room)
+            if history is not None and msg_id >= history.evicted_id:
+                return history.since(msg_id, max_bytes, taken)
+            if self.journal is None:  # Older messages are gone
+                return history.since(msg_id, max_bytes, taken) if history is not None else ([], None)
+        return None
+
+    def journal_since(self, room, msg_id, max_bytes=None):
+        """
+        Reads a room's messages after msg_id from the journal; this does disk I/O.
+
+        One call scans at most JOURNAL_SCAN_WINDOW message IDs and returns at
+        most capacity messages and max_bytes bytes, so a request for a long idle
+        room cannot read the whole journal at once nor overrun the client's
+        outbound queue; the caller asks again from resume.
+
+        Returns:
+            tuple: (frames, resume): resume is the message ID to ask for next, or None once complete.
+        """
+        last_id = self.last_id
+        until = min(msg_id + JOURNAL_SCAN_WINDOW, last_id)
+        frames = []
+        taken = 0
+        newest = msg_id
+        for record in self.journal.reader().scan(msg_id, room, until):
+            frame = encode_frame(record.payload)
+            if max_bytes is not None and frames and taken + len(frame) > max_bytes:
+                return frames, newest
+            frames.append(frame)
+            taken += len(frame)
+            newest = record.msg_id
+            if len(frames) == self.capacity:
+                return frames, newest
+        if until < last_id:
+            return frames, until
+        # Messages the committer has not written yet are only buffered
+        tail, resume = self.buffered_since(room, newest, max_bytes, taken) or ([], None)
+        frames.extend(tail)
+        return frames, resume
+
+    def export(self):
+        """
+        Returns the buffered history for another process (see ChatHandoff).
+
+        Returns:
+            dict: {'rooms': {room: [(message ID, frame), ...]}, 'last_id': int, 'epoch': str},
+                rooms least recently written first.
+        """
+        with self._lock:
+            rooms = {}
+            for room, history in self._rooms.items():
+                first = history._head
+                rooms[room] = [(history._ids[(first + index) % history.capacity], frame)
+                               for index, frame in enumerate(history._slice(0))]
+            return {'rooms': rooms, 'last_id': self.last_id, 'epoch': self.epoch}
+
+    def load(self, state):
+        """Refills the buffers from export() output and continues its message IDs and epoch."""
+        with self._lock:
+            for room, messages in state['rooms'].items():
+                history = self._room(room)
+                for msg_id, frame in messages:
+                    history.append(msg_id, frame)
+            self.last_id = max(self.last_id, state['last_id'])
+            self._ids = itertools.count(self.last_id + 1)
+            self.epoch = state.get('epoch') or self.epoch
+
+    def attach(self, journal):
+        """Starts journaling to a journal opened after this store was created, restoring from it."""
+        self.journal = journal
+        self._restore()
+
+    def close(self):
+        """Commits and closes the journal, if any."""
+        if self.journal is not None:
+            self.journal.close()
@@ -0,0 +1,502 @@
+# ChatJournal.py
+"""
+Write-ahead journal of the room messages a ChatServer delivers.
+
+Messages are appended to segment files named after the first message ID they
+hold. Appends only queue the encoded record; a committer thread writes whatever
+has accumulated in one write() and one fsync() (group commit), so a burst of
+messages costs one fsync instead of one each. Every INDEX_INTERVAL bytes the
+segment's sparse index (.idx) gets a (message ID, offset) entry, which lets
+JournalReader jump into a memory-mapped segment close to any ID and scan from
+there without loading the file. Full segments are rotated and the oldest ones
+are deleted once the journal exceeds its size or age retention, checked on
+every rotation and, for a journal that grows slowly or not at all, every
+retention interval.
+
+Run this module to inspect a journal offline:
+    python ChatJournal.py DIRECTORY [--since ID] [--room ROOM] [--stats]
+"""
+
+import argparse
+import bisect
+from collections import namedtuple
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+import zlib
+
+CHECKSUM = struct.Struct('!I')  # CRC-32 of everything after it in the record
+HEADER = struct.Struct('!IQdH')  # payload length, message ID, unix time, room length
+RECORD_OVERHEAD = CHECKSUM.size + HEADER.size
+INDEX_ENTRY = struct.Struct('!QQ')  # message ID, byte offset in the segment
+INDEX_INTERVAL = 4096  # Bytes of log between sparse index entries
+DEFAULT_SEGMENT_BYTES = 64 * 1024 * 1024
+DEFAULT_COMMIT_INTERVAL = 0.005  # Seconds a commit waits for more records to share its fsync
+DEFAULT_COMMIT_BYTES = 1024 * 1024  # A batch this large is committed without waiting
+DEFAULT_RETENTION_INTERVAL = 60.0  # Seconds between retention checks that no rotation triggered
+SEGMENT_SUFFIX = '.log'
+INDEX_SUFFIX = '.idx'
+EPOCH_FILE = 'EPOCH'  # Names the journal's message ID sequence, see journal_epoch()
+
+JournalRecord = namedtuple('JournalRecord', ('msg_id', 'timestamp', 'room', 'payload'))
+
+
+class JournalError(OSError):
+    """Raised by Journal.sync() when messages it waited for could not be written to disk."""
+
+
+def encode_record(msg_id, room, payload, timestamp=None):
+    """
+    Encodes one journal record.
+
+    Args:
+        msg_id: The message ID.
+        room: The room the message was sent to.
+        payload: The message bytes.
+        timestamp: Unix time of the message (default: now).
+    """
+    room = room.encode()
+    header = HEADER.pack(len(payload), msg_id, time.time() if timestamp is None else timestamp, len(room))
+    checksum = zlib.crc32(payload, zlib.crc32(room, zlib.crc32(header)))
+    return b''.join((CHECKSUM.pack(checksum), header, room, payload))
+
+
+def decode_record(buffer, offset):
+    """
+    Decodes the record at offset.
+
+    Returns:
+        tuple: (JournalRecord, offset of the next record), or None if the record
+        is incomplete or fails its checksum (a torn write at the end of the log).
+    """
+    if offset + RECORD_OVERHEAD > len(buffer):
+        return None
+    (checksum,) = CHECKSUM.unpack_from(buffer, offset)
+    length, msg_id, timestamp, room_length = HEADER.unpack_from(buffer, offset + CHECKSUM.size)
+    room_start = offset + RECORD_OVERHEAD
+    payload_start = room_start + room_length
+    end = payload_start + length
+    if end > len(buffer):
+        return None
+    room = buffer[room_start:payload_start]
+    payload = buffer[payload_start:end]
+    header = buffer[offset + CHECKSUM.size:room_start]
+    if zlib.crc32(payload, zlib.crc32(room, zlib.crc32(header))) != checksum:
+        return None
+    return JournalRecord(msg_id, timestamp, room.decode(), payload), end
+
+
+def segment_name(first_id):
+    return f'{first_id:020d}'
+
+
+def list_segments(directory):
+    """Returns [(first message ID, log path)] for every segment, oldest first."""
+    segments = []
+    for name in os.listdir(directory):
+        stem, suffix = os.path.splitext(name)
+        if suffix == SEGMENT_SUFFIX and stem.isdigit():
+            segments.append((int(stem), os.path.join(directory, name)))
+    segments.sort()
+    return segments
+
+
+def index_path(log_path):
+    return log_path[:-len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+
+
+def journal_epoch(directory):
+    """
+    Returns the epoch of the journal in directory, creating it for a new journal.
+
+    The epoch names the journal's message ID sequence: it stays the same as long
+    as IDs continue where the journal left off, so a client can tell a restart
+    that kept its IDs from one that started them over.
+    """
+    path = os.path.join(directory, EPOCH_FILE)
+    try:
+        with open(path) as f:
+            epoch = f.read().strip()
+        if epoch:
+            return epoch
+    except FileNotFoundError:
+        pass
+    epoch = os.urandom(8).hex()
+    with open(path, 'w') as f:
+        f.write(epoch)
+        f.flush()
+        os.fsync(f.fileno())
+    return epoch
+
+
+def _map(path):
+    """Memory-maps a file read-only; returns None for empty files, which cannot be mapped."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class JournalReader:
+    """
+    Scans journal segments through mmap, so only the pages touched are read.
+
+    Safe to use while a Journal is appending to the same directory: each
+    segment is mapped at its current size and a torn record at the end simply
+    ends the scan.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self):
+        return list_segments(self.directory)
+
+    def _start_offset(self, log_path, msg_id):
+        """Offset of the last indexed record whose ID is at most msg_id (0 without an index)."""
+        try:
+            index = _map(index_path(log_path))
+        except FileNotFoundError:
+            return 0
+        if index is None:
+            return 0
+        with index:
+            count = len(index) // INDEX_ENTRY.size
+            ids = [INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)[0] for i in range(count)]
+            position = bisect.bisect_right(ids, msg_id) - 1
+            return INDEX_ENTRY.unpack_from(index, position * INDEX_ENTRY.size)[1] if position >= 0 else 0
+
+    def scan(self, since=0, room=None, until=None):
+        """
+        Yields the records with a message ID greater than since, oldest first.
+
+        Args:
+            since: Skip records up to and including this message ID.
+            room: Only yield records of this room (default: every room).
+            until: Stop after this message ID (default: at the end of the journal).
+        """
+        segments = self.segments()
+        first = max(0, bisect.bisect_right([first_id for first_id, _ in segments], since + 1) - 1)
+        for first_id, log_path in segments[first:]:
+            try:
+                buffer = _map(log_path)
+            except FileNotFoundError:
+                continue  # Removed by retention while scanning
+            if buffer is None:
+                continue
+            with buffer:
+                offset = self._start_offset(log_path, since) if first_id <= since else 0
+                while True:
+                    decoded = decode_record(buffer, offset)
+                    if decoded is None:
+                        break
+                    record, offset = decoded
+                    if until is not None and record.msg_id > until:
+                        return
+                    if record.msg_id > since and (room is None or record.room == room):
+                        yield record
+
+    def last_id(self):
+        """The highest message ID in the journal, or 0 if it is empty."""
+        last = 0
+        for first_id, _ in reversed(self.segments()):
+            for record in self.scan(first_id - 1):
+                last = record.msg_id
+            if last:
+                break
+        return last
+
+
+class Journal:
+    """
+    Appends messages to the current segment with group-committed fsyncs.
+
+    append() is cheap enough for the message path: it encodes the record and
+    queues it under a lock. The committer thread makes records durable in
+    batches; sync() waits for that, close() commits what is left.
+    """
+
+    def __init__(self, directory, segment_bytes=DEFAULT_SEGMENT_BYTES, commit_interval=DEFAULT_COMMIT_INTERVAL,
+                 commit_bytes=DEFAULT_COMMIT_BYTES, retention_bytes=None, retention_seconds=None,
+                 retention_interval=DEFAULT_RETENTION_INTERVAL):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.commit_interval = commit_interval
+        self.commit_bytes = commit_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.retention_interval = retention_interval
+        self.logger = logging.getLogger(__name__)
+        self.stats = {'appended': 0, 'commits': 0, 'bytes': 0, 'segments_rotated': 0, 'segments_deleted': 0,
+                      'failed_commits': 0}
+        self._lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+        self._pending = []  # (message ID, encoded record) waiting for the committer
+        self._pending_bytes = 0
+        self._appended_id = 0  # ID of the last record appended
+        self._durable_id = 0  # ID of the last record written and fsynced
+        self._failed_id = 0  # ID of the last record in a batch whose write or fsync failed
+        self._error = None  # The OSError of that failure
+        self._reported_id = 0  # _failed_id as of the last JournalError raised by sync()
+        self._closed = False
+        self._log_fd = None
+        self._index_fd = None
+        self._size = 0  # Bytes in the active segment
+        self._indexed_at = -INDEX_INTERVAL  # Offset of the active segment's last index entry
+        os.makedirs(directory, exist_ok=True)
+        self.epoch = journal_epoch(directory)
+        self.last_id = self._recover()
+        self._appended_id = self._durable_id = self.last_id
+        self._committer = threading.Thread(target=self._commit_loop, name='journal-commit', daemon=True)
+        self._committer.start()
+
+    def reader(self):
+        return JournalReader(self.directory)
+
+    def append(self, msg_id, room, payload):
+        """
+        Queues one message for the journal; IDs must be appended in increasing order.
+
+        Args:
+            msg_id: The message ID.
+            room: The room the message was sent to.
+            payload: The message bytes.
+        """
+        record = encode_record(msg_id, room, payload)
+        with self._lock:
+            if self._closed:
+                return
+            self._pending.append((msg_id, record))
+            self._pending_bytes += len(record)
+            self._appended_id = msg_id
+            if len(self._pending) == 1 or self._pending_bytes >= self.commit_bytes:
+                self._committed.notify_all()  # Wake the committer for a new batch or a full one
+
+    def sync(self, timeout=None):
+        """
+        Blocks until every message appended so far is on disk.
+
+        Returns:
+            bool: False if the timeout expired first.
+
+        Raises:
+            JournalError: If some of those messages could not be written or fsynced.
+        """
+        with self._lock:
+            target = self._appended_id
+            done = self._committed.wait_for(
+                lambda: self._durable_id >= target or self._failed_id > self._reported_id or self._closed, timeout)
+            if self._failed_id > self._reported_id:  # Each failure is reported once
+                self._reported_id = self._failed_id
+                raise JournalError(f'Journal commit failed; messages up to ID {self._failed_id} are not durable: '
+                                   f'{self._error}') from self._error
+            return done
+
+    def close(self):
+        """Commits the remaining messages and closes the active segment."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._committed.notify_all()
+        self._committer.join()
+        for fd in (self._log_fd, self._index_fd):
+            if fd is not None:
+                os.close(fd)
+        self._log_fd = self._index_fd = None
+
+    def _commit_loop(self):
+        retains = self.retention_bytes is not None or self.retention_seconds is not None
+        retention_due = time.monotonic() + self.retention_interval
+        while True:
+            with self._lock:
+                # With retention, wake up idle for it too: an idle journal never rotates
+                timeout = max(0.0, retention_due - time.monotonic()) if retains else None
+                self._committed.wait_for(lambda: self._pending or self._closed, timeout)
+                if self._pending and not self._closed and self._pending_bytes < self.commit_bytes:
+                    # Group commit: give concurrent appends a moment to join this fsync
+                    self._committed.wait_for(lambda: self._pending_bytes >= self.commit_bytes or self._closed,
+                                             self.commit_interval)
+                batch, self._pending, self._pending_bytes = self._pending, [], 0
+                closed = self._closed
+            if batch:
+                try:
+                    self._write(batch)
+                    error = None
+                except OSError as e:
+                    error = e
+                    self.logger.error(f'Journal write failed, {len(batch)} messages lost: {str(e)}')
+                    self.stats['failed_commits'] += 1
+                    self._abandon_segment()
+                with self._lock:
+                    if error is None:
+                        self._durable_id = batch[-1][0]
+                    else:
+                        self._failed_id = batch[-1][0]
+                        self._error = error
+                    self._committed.notify_all()
+            if retains and not closed and time.monotonic() >= retention_due:
+                retention_due = time.monotonic() + self.retention_interval
+                try:
+                    self._apply_retention()
+                except OSError as e:
+                    self.logger.error(f'Journal retention failed: {str(e)}')
+            if closed:
+                return
+
+    def _write(self, batch):
+        chunk = []
+        for msg_id, record in batch:
+            if self._log_fd is None or (self._size and self._size + len(record) > self.segment_bytes):
+                self._flush(chunk)
+                chunk = []
+                self._rotate(msg_id)
+            if self._size - self._indexed_at >= INDEX_INTERVAL:
+                os.write(self._index_fd, INDEX_ENTRY.pack(msg_id, self._size))  # A hint only, so not fsynced
+                self._indexed_at = self._size
+            chunk.append(record)
+            self._size += len(record)
+        self._flush(chunk)
+        self.stats['appended'] += len(batch)
+        self.stats['commits'] += 1
+
+    def _flush(self, chunk):
+        if not chunk:
+            return
+        data = memoryview(b''.join(chunk))
+        while data:
+            data = data[os.write(self._log_fd, data):]
+        os.fsync(self._log_fd)
+        self.stats['bytes'] += sum(len(record) for record in chunk)
+
+    def _abandon_segment(self):
+        """
+        Closes the active segment after a failed write, which may have left a torn
+        record that ends every scan of it; the next batch starts a new segment.
+        """
+        for fd in (self._log_fd, self._index_fd):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        self._log_fd = self._index_fd = None
+        self._size = 0
+
+    def _rotate(self, first_id):
+        """Closes the active segment and starts a new one beginning at first_id."""
+        if self._log_fd is not None:
+            os.close(self._log_fd)
+            os.close(self._index_fd)
+            self.stats['segments_rotated'] += 1
+        base = os.path.join(self.directory, segment_name(first_id))
+        self._log_fd = os.open(base + SEGMENT_SUFFIX, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        self._index_fd = os.open(base + INDEX_SUFFIX, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self._size = 0
+        self._indexed_at = -INDEX_INTERVAL
+        self._apply_retention()
+
+    def _apply_retention(self):
+        """Deletes the oldest closed segments while the journal is over its size or age limit."""
+        if self.retention_bytes is None and self.retention_seconds is None:
+            return
+        segments = [(path, os.stat(path)) for _, path in list_segments(self.directory)]
+        total = sum(stat.st_size for _, stat in segments)
+        now = time.time()
+        for path, stat in segments[:-1]:  # Never the active segment
+            too_big = self.retention_bytes is not None and total > self.retention_bytes
+            too_old = self.retention_seconds is not None and now - stat.st_mtime > self.retention_seconds
+            if not (too_big or too_old):
+                break
+            for doomed in (path, index_path(path)):
+                try:
+                    os.unlink(doomed)
+                except FileNotFoundError:
+                    pass
+            total -= stat.st_size
+            self.stats['segments_deleted'] += 1
+
+    def _recover(self):
+        """
+        Reopens the newest segment, cutting off a torn record left by a crash,
+        and rebuilds its index.
+
+        Returns:
+            int: The highest message ID in the journal (0 if empty).
+        """
+        segments = list_segments(self.directory)
+        if not segments:
+            return 0
+        first_id, log_path = segments[-1]
+        entries = []
+        last_id = 0
+        offset = 0
+        buffer = _map(log_path)
+        if buffer is not None:
+            with buffer:
+                indexed_at = -INDEX_INTERVAL
+                while True:
+                    decoded = decode_record(buffer, offset)
+                    if decoded is None:
+                        break
+                    if offset - indexed_at >= INDEX_INTERVAL:
+                        entries.append(INDEX_ENTRY.pack(decoded[0].msg_id, offset))
+                        indexed_at = offset
+                    last_id = decoded[0].msg_id
+                    offset = decoded[1]
+                size = len(buffer)
+            if offset < size:
+                self.logger.warning(f'Truncating {size - offset} bytes of torn records from {log_path}')
+                os.truncate(log_path, offset)
+        if not last_id and len(segments) > 1:
+            os.unlink(log_path)  # Nothing survived in the newest segment; continue after the previous one
+            try:
+                os.unlink(index_path(log_path))
+            except FileNotFoundError:
+                pass
+            return JournalReader(self.directory).last_id()
+        with open(index_path(log_path), 'wb') as index:
+            index.write(b''.join(entries))
+        self._log_fd = os.open(log_path, os.O_WRONLY | os.O_APPEND)
+        self._index_fd = os.open(index_path(log_path), os.O_WRONLY | os.O_APPEND)
+        self._size = offset
+        self._indexed_at = INDEX_ENTRY.unpack(entries[-1])[1] if entries else -INDEX_INTERVAL
+        return last_id or first_id - 1  # An empty segment was named after the next ID; keep the epoch's IDs unique
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print or summarize the messages in a ChatServer journal.')
+    parser.add_argument('directory', help='The journal directory (ChatServer --journal).')
+    parser.add_argument('--since', type=int, default=0, help='Only messages after this message ID.')
+    parser.add_argument('--room', default=None, help='Only messages of this room.')
+    parser.add_argument('--stats', action='store_true', help='Print per-room counts instead of the messages.')
+    args = parser.parse_args()
+
+    reader = JournalReader(args.directory)
+    if not args.stats:
+        for record in reader.scan(args.since, args.room):
+            print(json.dumps({'id': record.msg_id, 'time': record.timestamp, 'room': record.room,
+                              'payload': record.payload.decode(errors='replace')}))
+        return
+    rooms = {}
+    started = time.perf_counter()
+    total_bytes = 0
+    for record in reader.scan(args.since, args.room):
+        count = rooms.setdefault(record.room, [0, 0])
+        count[0] += 1
+        count[1] += len(record.payload)
+        total_bytes += len(record.payload)
+    elapsed = time.perf_counter() - started
+    for room, (messages, size) in sorted(rooms.items()):
+        print(f'{room}: {messages} messages, {size} bytes')
+    print(f'Scanned {sum(c[0] for c in rooms.values())} messages ({total_bytes} bytes) in {elapsed:.2f}s',
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
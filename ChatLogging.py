@@ -0,0 +1,242 @@
+# ChatLogging.py
+"""
+Non-blocking logging for the chat servers.
+
+setup_logging() points the root logger at an EnqueueHandler, so a log call on
+a handler thread or the event loop only creates the record and puts it on a
+queue, without taking the handler lock that serializes ordinary handlers. A single BatchingListener thread formats whatever has queued up
+and writes it to the log file or stderr with one write and one flush per batch.
+Records are formatted as text or as one JSON object per line.
+
+Per-message records go to the MESSAGE_LOGGER logger, which can be sampled (one
+record in N) and rate-limited (N records per second) before anything is queued.
+"""
+
+import atexit
+from datetime import datetime, timezone
+import json
+import logging
+from logging.handlers import QueueHandler
+import queue
+import sys
+import threading
+import time
+
+MESSAGE_LOGGER = 'chat.messages'  # Per-message FROM/TO CLIENT records
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+QUEUE_SIZE = 65536  # Records buffered before new ones are dropped
+MAX_BATCH = 1024  # Records written per write() call at most
+DEFAULT_MESSAGE_RATE = 100  # Per-message records per second
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'thread': record.threadName,
+            'process': record.process,
+        }
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            entry['suppressed'] = suppressed
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class EnqueueHandler(QueueHandler):
+    """
+    A QueueHandler that only enqueues.
+
+    QueueHandler.prepare() formats the message on the calling thread so the
+    record can be pickled; records here never leave the process, so formatting
+    is left to the listener. The queue is a SimpleQueue, whose put() needs no
+    handler lock, so handle() skips it. Once QUEUE_SIZE records are waiting,
+    new ones are dropped and counted instead of growing the backlog.
+    """
+
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def handle(self, record):
+        if self.filter(record):
+            self.enqueue(record)
+        return record
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() < QUEUE_SIZE:
+            self.queue.put(record)
+        else:
+            self.dropped += 1
+
+
+class BatchingListener:
+    """
+    Drains the record queue on one thread and writes records in batches.
+
+    Works like logging.handlers.QueueListener with a single output stream, but
+    everything queued since the last write is formatted and written together.
+    """
+
+    _STOP = None
+
+    def __init__(self, records, stream, formatter, handler=None):
+        self.queue = records
+        self.stream = stream
+        self.formatter = formatter
+        self.handler = handler  # The EnqueueHandler feeding the queue, for its drop count
+        self._reported_drops = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Writes everything queued so far and stops the thread."""
+        if self._thread is not None:
+            self.queue.put(self._STOP)
+            self._thread.join()
+            self._thread = None
+            if self.stream not in (sys.stderr, sys.stdout):
+                self.stream.close()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < MAX_BATCH:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = self._STOP in batch
+            lines = []
+            for record in batch:
+                if record is self._STOP:
+                    continue
+                try:
+                    lines.append(self.formatter.format(record))
+                except Exception:
+                    lines.append(f'Unformattable log record from {record.name}: {record.msg!r}')
+            dropped = self.handler.dropped if self.handler is not None else 0
+            if dropped != self._reported_drops:
+                lines.append(f'{dropped - self._reported_drops} log records dropped because the log queue was full')
+                self._reported_drops = dropped
+            if lines:
+                try:
+                    self.stream.write('\n'.join(lines) + '\n')
+                    self.stream.flush()
+                except (OSError, ValueError):
+                    pass  # Nowhere left to report it
+            if stopping:
+                return
+
+
+class SampleFilter(logging.Filter):
+    """Passes one record in every `every`."""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = every
+        self._seen = 0
+
+    def filter(self, record):
+        self._seen += 1
+        return self._seen % self.every == 0
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Passes at most `rate` records per second (token bucket with a one second burst).
+
+    The first record let through after some were suppressed carries their count
+    in record.suppressed and in its message.
+    """
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._tokens = float(rate)
+        self._last = time.monotonic()
+        self._suppressed = 0
+
+    def filter(self, record):
+        now = time.monotonic()
+        self._tokens = min(float(self.rate), self._tokens + (now - self._last) * self.rate)
+        self._last = now
+        if self._tokens < 1:
+            self._suppressed += 1
+            return False
+        self._tokens -= 1
+        if self._suppressed:
+            record.suppressed, self._suppressed = self._suppressed, 0
+            record.msg = f'{record.msg} (%d similar records suppressed)'
+            record.args = tuple(record.args or ()) + (record.suppressed,)
+        return True
+
+
+def setup_logging(level=logging.INFO, log_file=None, json_format=False, sample=1, message_rate=DEFAULT_MESSAGE_RATE):
+    """
+    Routes all logging through the queue and a batching writer thread.
+
+    Args:
+        level: The root log level.
+        log_file: Append to this file instead of writing to stderr.
+        json_format: Write one JSON object per record instead of text lines.
+        sample: Keep one per-message record in this many.
+        message_rate: Keep at most this many per-message records per second (0 for no limit).
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+    records = queue.SimpleQueue()
+    handler = EnqueueHandler(records)
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    messages = logging.getLogger(MESSAGE_LOGGER)
+    for existing in list(messages.filters):
+        messages.removeFilter(existing)
+    if sample > 1:
+        messages.addFilter(SampleFilter(sample))
+    if message_rate:
+        messages.addFilter(RateLimitFilter(message_rate))
+
+    stream = open(log_file, 'a', encoding='utf-8') if log_file else sys.stderr
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+    _listener = BatchingListener(records, stream, formatter, handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+    return _listener
+
+
+def add_logging_arguments(parser):
+    """Adds the logging options shared by the servers to an argparse parser."""
+    parser.add_argument("--log-file", default=None, help="Append logs to this file instead of stderr.")
+    parser.add_argument("--log-format", choices=("text", "json"), default="text", help="Log line format.")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="Minimum level logged.")
+    parser.add_argument("--log-sample", type=int, default=1,
+                        help="Log one per-message record in this many (default: every one).")
+    parser.add_argument("--log-rate", type=int, default=DEFAULT_MESSAGE_RATE,
+                        help="At most this many per-message records per second (0 for no limit).")
+
+
+def setup_logging_from_args(args):
+    """Calls setup_logging() with the options added by add_logging_arguments()."""
+    return setup_logging(getattr(logging, args.log_level), args.log_file, args.log_format == "json",
+                         max(1, args.log_sample), max(0, args.log_rate))
@@ -0,0 +1,293 @@
+# ChatMetrics.py
+"""
+Counters, gauges and latency histograms for ChatServer, served in the
+Prometheus text format.
+
+Counters and histograms are updated on the message path, so each update is a
+few integer operations under an uncontended lock. Gauges that describe current
+state (connections, queue depths) are callbacks evaluated only when the
+endpoint is scraped. Histograms use HDR-style log-linear buckets: every power
+of two is split into SUB_BUCKETS linear buckets, which bounds the relative
+error of any percentile to 1/SUB_BUCKETS with a fixed, small number of counters.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import threading
+import time
+
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS  # ~3% worst-case percentile error
+EXPORT_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # Prometheus 'le' buckets, in seconds
+EXPORT_QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def bucket_index(value):
+    """Maps a non-negative integer to its log-linear bucket."""
+    if value < SUB_BUCKETS:
+        return value
+    exponent = value.bit_length() - SUB_BUCKET_BITS - 1
+    return exponent * SUB_BUCKETS + (value >> exponent)
+
+
+def bucket_upper_bound(index):
+    """The largest value that falls into bucket index."""
+    if index < SUB_BUCKETS:
+        return index
+    exponent, top = divmod(index, SUB_BUCKETS)
+    exponent -= 1
+    return ((top + SUB_BUCKETS + 1) << exponent) - 1
+
+
+class Counter:
+    """A monotonically increasing count."""
+    __slots__ = ('name', 'help', 'value', '_lock')
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter', f'{self.name} {self.value}']
+
+
+class Gauge:
+    """A value computed by a callback each time the metrics are scraped."""
+    __slots__ = ('name', 'help', 'read')
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        return [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge', f'{self.name} {self.read()}']
+
+
+class Histogram:
+    """
+    An HDR-style histogram of non-negative integer samples.
+
+    Args:
+        name: The metric name.
+        help: The metric description.
+        unit: Seconds per recorded unit, used when exporting (1e-6 for microseconds).
+    """
+    __slots__ = ('name', 'help', 'unit', '_counts', 'count', 'total', 'max', '_lock')
+
+    def __init__(self, name, help, unit=1e-6):
+        self.name = name
+        self.help = help
+        self.unit = unit
+        self._counts = []
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def record(self, value):
+        index = bucket_index(value)
+        with self._lock:
+            counts = self._counts
+            if index >= len(counts):
+                counts.extend([0] * (index + 1 - len(counts)))
+            counts[index] += 1
+            self.count += 1
+            self.total += value
+            if value > self.max:
+                self.max = value
+
+    def snapshot(self):
+        """Returns (bucket counts, count, total, max) as of now."""
+        with self._lock:
+            return list(self._counts), self.count, self.total, self.max
+
+    def percentile(self, fraction, snapshot=None):
+        """
+        Returns the value at the given fraction (0..1) of the samples, in recorded units.
+
+        The result is the upper bound of the bucket holding that sample, capped at the maximum seen.
+        """
+        counts, count, _, largest = snapshot or self.snapshot()
+        if not count:
+            return 0
+        rank = max(1, int(round(fraction * count)))
+        seen = 0
+        for index, bucket in enumerate(counts):
+            seen += bucket
+            if seen >= rank:
+                return min(bucket_upper_bound(index), largest)
+        return largest
+
+    def render(self):
+        snapshot = self.snapshot()
+        counts, count, total, _ = snapshot
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        cumulative = 0
+        index = 0
+        for bound in EXPORT_BOUNDS:
+            limit = bound / self.unit
+            while index < len(counts) and bucket_upper_bound(index) <= limit:
+                cumulative += counts[index]
+                index += 1
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {count}')
+        lines.append(f'{self.name}_sum {round(total * self.unit, 9)}')
+        lines.append(f'{self.name}_count {count}')
+        quantiles = f'{self.name}_quantile'
+        lines.append(f'# HELP {quantiles} Percentiles of {self.name} from the full-resolution histogram.')
+        lines.append(f'# TYPE {quantiles} gauge')
+        for fraction in EXPORT_QUANTILES:
+            lines.append(f'{quantiles}{{quantile="{fraction}"}} {round(self.percentile(fraction, snapshot) * self.unit, 9)}')
+        return lines
+
+
+class CounterSet:
+    """
+    A fixed group of named counters, e.g. what one server component did so far.
+
+    Subclasses name the counters in FIELDS. Updates take one lock, so they are
+    meant for infrequent events (overflows, connects, heartbeats), not for every
+    frame. ServerMetrics.watch() exports the counters as gauges.
+    """
+    FIELDS = ()
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = dict.fromkeys(self.FIELDS, 0)
+
+    def record(self, field, count=1):
+        with self._lock:
+            self._counts[field] += count
+
+    def __getitem__(self, field):
+        return self._counts[field]
+
+    def snapshot(self):
+        """Returns a copy of all counters."""
+        with self._lock:
+            return dict(self._counts)
+
+
+class MetricsRegistry:
+    """The metrics of one process, in registration order."""
+
+    def __init__(self):
+        self._metrics = []
+        self.started = time.time()
+
+    def counter(self, name, help):
+        return self._add(Counter(name, help))
+
+    def gauge(self, name, help, read):
+        return self._add(Gauge(name, help, read))
+
+    def histogram(self, name, help, unit=1e-6):
+        return self._add(Histogram(name, help, unit))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:  # A gauge callback must never break the scrape
+                logging.error(f'Failed to collect metric {metric.name}: {str(e)}')
+        return '\n'.join(lines) + '\n'
+
+
+class ServerMetrics(MetricsRegistry):
+    """The instruments a ChatServer updates on its message path."""
+
+    def __init__(self):
+        super().__init__()
+        self.messages_in = self.counter('chat_messages_received_total', 'Frames received from clients.')
+        self.bytes_in = self.counter('chat_bytes_received_total', 'Frame payload bytes received from clients.')
+        self.bytes_out = self.counter('chat_bytes_sent_total', 'Bytes written to client sockets.')
+        self.send_errors = self.counter('chat_send_errors_total', 'Client connections dropped by a socket error or a failed send.')
+        self.connections = self.counter('chat_connections_total', 'Client connections accepted.')
+        self.direct_messages = self.counter('chat_direct_messages_total',
+                                            'Direct messages delivered to one client by nickname.')
+        self.frames_compressed = self.counter('chat_frames_compressed_total',
+                                              'Broadcast frames compressed (once per broadcast, shared by all recipients).')
+        self.broadcast_latency = self.histogram(
+            'chat_broadcast_latency_seconds',
+            'Time from receiving a room message to queuing it for every recipient.')
+        self.tls_handshakes = self.counter('chat_tls_handshakes_total', 'Completed TLS handshakes.')
+        self.tls_resumed = self.counter('chat_tls_resumed_total', 'TLS handshakes that resumed an earlier session.')
+        self.tls_failures = self.counter('chat_tls_handshake_failures_total', 'TLS handshakes that failed or timed out.')
+        self.tls_handshake_latency = self.histogram(
+            'chat_tls_handshake_seconds', 'TLS handshake duration.')
+
+    def count_tls_handshake(self, resumed):
+        self.tls_handshakes.inc()
+        if resumed:
+            self.tls_resumed.inc()
+
+    def watch(self, server):
+        """Registers the gauges that read a server's current state."""
+        def queued():
+            return [record.connection.outbound.queued_bytes for record in server.clients.snapshot()]
+
+        self.gauge('chat_active_connections', 'Connected clients.', lambda: len(server.clients))
+        self.gauge('chat_rooms', 'Rooms with at least one member.', lambda: len(server.clients.room_names()))
+        self.gauge('chat_outbound_queued_bytes', 'Bytes waiting in all outbound queues.', lambda: sum(queued()))
+        self.gauge('chat_outbound_queued_bytes_max', 'Largest single outbound queue in bytes.',
+                   lambda: max(queued(), default=0))
+        self.gauge('chat_outbound_congested_clients', 'Clients over their high watermark.',
+                   lambda: sum(1 for record in server.clients.snapshot() if record.connection.outbound.congested))
+        for field in server.backpressure.stats.snapshot():
+            self.gauge(f'chat_backpressure_{field}', f'Backpressure {field.replace("_", " ")} so far.',
+                       lambda field=field: server.backpressure.stats.snapshot()[field])
+        for field in server.admission.stats.snapshot():
+            self.gauge(f'chat_admission_{field}', f'Admission control: {field.replace("_", " ")} so far.',
+                       lambda field=field: server.admission.stats.snapshot()[field])
+        for field in server.heartbeat.stats.snapshot():
+            self.gauge(f'chat_heartbeat_{field}', f'Heartbeats: {field.replace("_", " ")} so far.',
+                       lambda field=field: server.heartbeat.stats.snapshot()[field])
+        self.gauge('chat_heartbeat_tracked', 'Connections with a heartbeat deadline in the timer wheel.',
+                   lambda: len(server.heartbeat))
+        self.gauge('chat_uptime_seconds', 'Seconds since the server started.', lambda: round(time.time() - self.started, 3))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None  # Set on the per-server subclass
+
+    def do_GET(self):
+        if self.path not in ('/metrics', '/'):
+            self.send_error(404)
+            return
+        body = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes are not worth a log line each
+
+
+def serve_metrics(registry, port, host='127.0.0.1'):
+    """
+    Serves registry at http://host:port/metrics from a background thread.
+
+    Returns:
+        ThreadingHTTPServer: The running server; call shutdown() to stop it.
+    """
+    handler = type('MetricsHandler', (_MetricsHandler,), {'registry': registry})
+    httpd = ThreadingHTTPServer((host, port), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, name='metrics-http', daemon=True).start()
+    return httpd
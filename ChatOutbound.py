@@ -0,0 +1,223 @@
+# ChatOutbound.py
+"""
+Per-client outbound queues for the broadcast pipeline.
+
+A broadcast is encoded into one frame and the same bytes object is pushed onto
+the queue of every recipient; a dedicated writer per client drains its queue to
+the network. Publishing therefore never waits on a slow socket.
+"""
+
+from collections import deque
+import logging
+import socket
+import threading
+
+from ChatBackpressure import DropNewestPolicy
+
+DRAIN_BYTES = 256 * 1024  # Bytes a writer takes from its queue per write
+
+
+class OutboundQueue:
+    """
+    Bounded FIFO of pre-encoded frames waiting to be written to one client.
+
+    The backlog is measured in bytes against the policy's watermarks: above the
+    high watermark the queue is congested and every push goes through the
+    BackpressurePolicy until a drain brings it back under the low watermark.
+    The wakeup callable is invoked whenever the queue goes from empty to
+    non-empty (and on close), so a busy writer is not signalled once per frame;
+    on_evict is called when the policy disconnects the client.
+    """
+    __slots__ = ('_frames', '_coalesced', '_lock', '_wakeup', '_on_evict', 'policy',
+                 'queued_bytes', 'congested', 'closed', 'evicted')
+
+    def __init__(self, wakeup, policy=None, on_evict=None):
+        self._frames = deque()
+        self._coalesced = None  # sender -> newest frame, only used by CoalescePolicy
+        self._lock = threading.Lock()
+        self._wakeup = wakeup
+        self._on_evict = on_evict
+        self.policy = policy if policy is not None else DropNewestPolicy()
+        self.queued_bytes = 0
+        self.congested = False
+        self.closed = False
+        self.evicted = False
+
+    def __len__(self):
+        return len(self._frames) + (len(self._coalesced) if self._coalesced else 0)
+
+    def put(self, frame, key=None, force=False):
+        """
+        Appends a frame for delivery, applying the backpressure policy if congested.
+
+        Args:
+            frame: Encoded bytes; the object is shared, never copied.
+            key: The sender of the frame, used by CoalescePolicy.
+            force: Append even if congested; only for small control frames the client must get.
+
+        Returns:
+            bool: False if the queue is closed or the policy did not append the frame.
+        """
+        evicted = False
+        with self._lock:
+            if self.closed:
+                return False
+            was_empty = not self._frames and not self._coalesced
+            if force:
+                admitted = True
+            elif self.congested or self.queued_bytes + len(frame) > self.policy.high_watermark:
+                if not self.congested:
+                    self.congested = True
+                    self.policy.stats.record('congestion_events')
+                admitted = self.policy.admit(self, frame, key)
+                evicted = self.evicted
+            else:
+                admitted = True
+            if admitted:
+                self._frames.append(frame)
+                self.queued_bytes += len(frame)
+            wake = was_empty and (admitted or bool(self._coalesced))
+        if evicted:
+            if self._on_evict is not None:
+                self._on_evict()
+            return False
+        if wake:
+            self._wakeup()
+        return admitted
+
+    def drain(self, max_bytes=DRAIN_BYTES):
+        """
+        Removes and returns pending frames, oldest first.
+
+        Args:
+            max_bytes: Stop once this many bytes are taken (at least one frame is returned).
+        """
+        frames = []
+        taken = 0
+        with self._lock:
+            pending = self._frames
+            while pending and (taken < max_bytes or not frames):
+                frame = pending.popleft()
+                frames.append(frame)
+                taken += len(frame)
+            if not pending and self._coalesced and taken < max_bytes:
+                frames.extend(self._coalesced.values())
+                taken += sum(len(frame) for frame in self._coalesced.values())
+                self._coalesced = None
+            self.queued_bytes -= taken
+            if self.congested and self.queued_bytes <= self.policy.low_watermark:
+                self.congested = False
+        return frames
+
+    def discard_oldest(self, target_bytes):
+        """Drops the oldest frames until the backlog is at most target_bytes (lock held)."""
+        dropped_frames = dropped_bytes = 0
+        pending = self._frames
+        while pending and self.queued_bytes > target_bytes:
+            frame = pending.popleft()
+            self.queued_bytes -= len(frame)
+            dropped_frames += 1
+            dropped_bytes += len(frame)
+        return dropped_frames, dropped_bytes
+
+    def coalesce(self, key, frame):
+        """
+        Holds frame as the newest pending frame from key (lock held).
+
+        Returns:
+            bool: True if an older pending frame from the same sender was replaced.
+        """
+        if self._coalesced is None:
+            self._coalesced = {}
+        previous = self._coalesced.pop(key, None)  # Re-insert so delivery follows arrival order
+        self._coalesced[key] = frame
+        self.queued_bytes += len(frame) - (len(previous) if previous is not None else 0)
+        return previous is not None
+
+    def evict(self):
+        """Closes the queue and discards its backlog (lock held); on_evict runs after unlock."""
+        self._frames.clear()
+        self._coalesced = None
+        self.queued_bytes = 0
+        self.closed = True
+        self.evicted = True
+
+    def close(self):
+        """Refuses further frames; frames already queued are still delivered."""
+        with self._lock:
+            if self.closed:
+                return
+            self.closed = True
+        self._wakeup()
+
+
+class SocketConnection:
+    """
+    A blocking client socket paired with its outbound queue and writer thread.
+
+    This is what the thread-per-connection engine stores for each client: the
+    handler thread keeps reading from the socket while the writer thread owns
+    all sends and finally closes the socket once the queue is closed and empty.
+    """
+    __slots__ = ('sock', 'addr', 'outbound', 'metrics', '_ready', '_writer')
+
+    def __init__(self, sock, addr, policy=None, metrics=None):
+        self.sock = sock
+        self.addr = addr
+        self.metrics = metrics  # ChatMetrics.ServerMetrics counting bytes sent and send errors, if any
+        self._ready = threading.Event()
+        self.outbound = OutboundQueue(self._ready.set, policy, self._evict)
+        self._writer = threading.Thread(target=self._write_loop, name=f'writer-{addr}', daemon=True)
+        self._writer.start()
+
+    def send(self, frame, key=None, force=False):
+        """Queues an encoded frame for the writer thread; never blocks on the network."""
+        return self.outbound.put(frame, key, force)
+
+    sendall = send
+
+    def close(self):
+        """Stops accepting frames; the writer flushes what is queued, then closes the socket."""
+        self.outbound.close()
+
+    def abort(self):
+        """Drops the connection without flushing; the handler's recv returns and runs the usual cleanup."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # Unblocks both the writer and the handler's recv
+        except OSError:
+            pass
+        self.outbound.close()  # Only now: the writer closes the socket once the queue is closed
+        self._ready.set()
+
+    def _evict(self):
+        """Called when the backpressure policy disconnects this client."""
+        logging.warning(f'Disconnecting slow client {self.addr}')
+        self.abort()
+
+    def _write_loop(self):
+        outbound = self.outbound
+        try:
+            while True:
+                closed = outbound.closed  # Read before draining so no frame queued before close() is lost
+                frames = outbound.drain()
+                if frames:
+                    data = frames[0] if len(frames) == 1 else b''.join(frames)
+                    self.sock.sendall(data)
+                    if self.metrics is not None:
+                        self.metrics.bytes_out.inc(len(data))
+                elif closed:
+                    break
+                else:
+                    self._ready.wait()
+                    self._ready.clear()
+        except OSError as e:
+            logging.error(f'Failed to send to client {self.addr}: {str(e)}')
+            if self.metrics is not None:
+                self.metrics.send_errors.inc()
+            outbound.close()
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)  # Wake the reader so the handler cleans up
+            except OSError:
+                pass
+        finally:
+            self.sock.close()
@@ -0,0 +1,216 @@
+# ChatRegistry.py
+"""
+Client registry for ChatServer.
+
+Each connected client is one slotted ClientRecord, indexed by address, by a
+server-assigned numeric ID and (once the handshake names it) by nickname, so
+every add, remove and lookup is a dict operation. Rooms form an inverted index
+from room name to its members, so a room message only touches that room.
+Broadcasts iterate an immutable snapshot that is rebuilt only after the
+membership has changed.
+"""
+
+import threading
+
+DEFAULT_ROOM = 'lobby'  # Every client joins this room on connect
+
+
+class ClientRecord:
+    """Everything the server tracks about one connected client."""
+    __slots__ = ('client_id', 'addr', 'connection', 'nickname', 'client_ref', 'rooms', 'peer', 'compression', 'limiter',
+                 'last_seen', 'pinged', 'claim', 'held')
+
+    def __init__(self, client_id, addr, connection):
+        self.client_id = client_id  # Stable server-assigned ID, never reused
+        self.addr = addr
+        self.connection = connection  # SocketConnection or ChatProtocol
+        self.nickname = None  # Set by the nickname handshake
+        self.client_ref = None  # The clientID the client sent in its handshake
+        self.rooms = set()  # Names of the rooms this client has joined
+        self.peer = None  # ChatFederation.PeerLink once the connection identifies as a peer server
+        self.compression = None  # Compression algorithm negotiated in the handshake
+        self.limiter = None  # ChatAdmission.ClientLimiter when rate limits are configured
+        self.last_seen = 0.0  # time.monotonic() of the last frame received, for heartbeats
+        self.pinged = 0.0  # time.monotonic() of the last ping sent, or 0
+        self.claim = None  # (nickname, granted) once the worker bus has answered a nickname claim
+        self.held = None  # Frames received while a claim is pending (asyncio engine), replayed in order
+
+    def __repr__(self):
+        return f'ClientRecord(id={self.client_id}, addr={self.addr}, nickname={self.nickname!r})'
+
+
+class Room:
+    """The members of one named room and their broadcast snapshot."""
+    __slots__ = ('name', 'members', '_snapshot')
+
+    def __init__(self, name):
+        self.name = name
+        self.members = set()
+        self._snapshot = ()
+
+    def __len__(self):
+        return len(self.members)
+
+
+class ClientRegistry:
+    """
+    O(1) add/remove/lookup of clients by address, ID and nickname.
+
+    Writers take a lock; snapshot() and members() are lock-free in the common
+    case because they return tuples that are replaced, never mutated, when
+    membership changes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_addr = {}
+        self._by_id = {}
+        self._by_nickname = {}
+        self._rooms = {}  # room name -> Room
+        self._next_id = 1  # IDs are never reused
+        self._snapshot = ()  # None once membership has changed since the last rebuild
+
+    def __len__(self):
+        return len(self._by_addr)
+
+    def __contains__(self, addr):
+        return addr in self._by_addr
+
+    def add(self, addr, connection, client_id=None):
+        """
+        Registers a new client.
+
+        Args:
+            addr: The client's address.
+            connection: The client's connection object.
+            client_id: Keep this ID (a client handed over by another process) instead of assigning one.
+
+        Returns:
+            ClientRecord: The new record, or None if addr or client_id is already registered.
+        """
+        with self._lock:
+            if addr in self._by_addr or client_id in self._by_id:
+                return None
+            if client_id is None:
+                client_id = self._next_id
+            self._next_id = max(self._next_id, client_id + 1)  # Also past handed-over IDs
+            record = ClientRecord(client_id, addr, connection)
+            self._by_addr[addr] = record
+            self._by_id[record.client_id] = record
+            self._snapshot = None
+        return record
+
+    def remove(self, addr):
+        """
+        Unregisters a client from every index.
+
+        Returns:
+            ClientRecord: The removed record, or None if addr was not registered.
+        """
+        with self._lock:
+            record = self._by_addr.pop(addr, None)
+            if record is None:
+                return None
+            del self._by_id[record.client_id]
+            for name in record.rooms:
+                self._discard_member(name, record)
+            if record.nickname is not None and self._by_nickname.get(record.nickname) is record:
+                del self._by_nickname[record.nickname]
+            self._snapshot = None
+        return record
+
+    def get(self, addr):
+        return self._by_addr.get(addr)
+
+    def get_by_id(self, client_id):
+        return self._by_id.get(client_id)
+
+    def get_by_nickname(self, nickname):
+        return self._by_nickname.get(nickname)
+
+    def set_nickname(self, record, nickname):
+        """
+        Names a client, replacing any nickname it had before.
+
+        Returns:
+            bool: False if another connected client already uses the nickname.
+        """
+        with self._lock:
+            owner = self._by_nickname.get(nickname)
+            if owner is not None and owner is not record:
+                return False
+            if record.addr not in self._by_addr:
+                return False  # Disconnected while the handshake was in flight
+            if record.nickname is not None and self._by_nickname.get(record.nickname) is record:
+                del self._by_nickname[record.nickname]
+            record.nickname = nickname
+            self._by_nickname[nickname] = record
+        return True
+
+    def join(self, record, room):
+        """
+        Subscribes a client to a room, creating the room if needed.
+
+        Returns:
+            bool: False if the client was already a member or has disconnected.
+        """
+        with self._lock:
+            if room in record.rooms or record.addr not in self._by_addr:
+                return False
+            entry = self._rooms.get(room)
+            if entry is None:
+                entry = self._rooms[room] = Room(room)
+            entry.members.add(record)
+            entry._snapshot = None
+            record.rooms.add(room)
+        return True
+
+    def leave(self, record, room):
+        """
+        Unsubscribes a client from a room; empty rooms are dropped.
+
+        Returns:
+            bool: False if the client was not a member.
+        """
+        with self._lock:
+            if room not in record.rooms:
+                return False
+            record.rooms.discard(room)
+            self._discard_member(room, record)
+        return True
+
+    def _discard_member(self, room, record):
+        entry = self._rooms.get(room)
+        if entry is None:
+            return
+        entry.members.discard(record)
+        entry._snapshot = None
+        if not entry.members:
+            del self._rooms[room]
+
+    def members(self, room):
+        """Returns an immutable tuple of the records subscribed to room (empty if none)."""
+        entry = self._rooms.get(room)
+        if entry is None:
+            return ()
+        snapshot = entry._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = entry._snapshot
+                if snapshot is None:
+                    snapshot = entry._snapshot = tuple(entry.members)
+        return snapshot
+
+    def room_names(self):
+        """Returns the names of all rooms that currently have members."""
+        return list(self._rooms)
+
+    def snapshot(self):
+        """Returns an immutable tuple of all records, safe to iterate without the lock."""
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = self._snapshot = tuple(self._by_addr.values())
+        return snapshot
@@ -1,6 +1,7 @@
 # ChatServer.py
 
-from collections import deque
+import asyncio
+import resource
 import socket
 from socket import AF_INET, SOCK_STREAM
 import sys
@@ -8,87 +9,611 @@ import logging
 import threading
 import argparse
 import json
+import os
+import time
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from ChatAdmission import DEFAULT_BACKLOG, AdmissionControl
+from ChatBackpressure import DEFAULT_HIGH_WATERMARK, DEFAULT_LOW_WATERMARK, POLICIES, make_policy
+from ChatCodec import CodecError, MessageCodec
+from ChatCompression import ALGORITHM, negotiate
+from ChatFederation import Federation, parse_peer
+from ChatFraming import FrameDecoder, compress_frame, encode_frame, iter_frames
+from ChatHandoff import DRAIN_TIMEOUT, Export, HandoffListener, Session, take_over
+from ChatHistory import DEFAULT_HISTORY, DEFAULT_HISTORY_BYTES, DEFAULT_REPLAY, HistoryStore
+from ChatJournal import DEFAULT_COMMIT_INTERVAL, DEFAULT_SEGMENT_BYTES, Journal
+from ChatLogging import MESSAGE_LOGGER, add_logging_arguments, setup_logging_from_args
+from ChatMetrics import ServerMetrics, serve_metrics
+from ChatOutbound import OutboundQueue, SocketConnection
+from ChatRegistry import DEFAULT_ROOM, ClientRegistry
+from ChatTLS import HANDSHAKE_TIMEOUT, client_context, server_context, server_handshake
+from ChatTimers import DEFAULT_PING_INTERVAL, DEFAULT_PING_TIMEOUT, HeartbeatMonitor
+from ChatWorkers import run_workers
 
 class ChatServer:
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, backpressure=None, history=None):
         self.logger = logging.getLogger(__name__)
+        self.message_logger = logging.getLogger(MESSAGE_LOGGER)  # Per-message records; sampled and rate-limited
         self.port = port
         self.ip = ip
+        self.backpressure = backpressure if backpressure is not None else make_policy('drop-newest')  # Slow-consumer policy shared by all outbound queues
         self.server_socket = socket.socket(AF_INET, SOCK_STREAM)
-        self.client_dict = dict()  # dictionary of connected clients
-        self.active_clients = deque()  # Use deque to efficiently add/remove clients
-        self.lock = threading.Lock()   # lock for thread-safe access to client_dict
+        self.clients = ClientRegistry()  # connected clients, indexed by address, ID and nickname
+        self.reuse_port = False  # Set by ChatWorkers so several processes can share the port
+        self.worker_id = None
+        self.bus = None  # ChatWorkers.BusLink to the other workers: room messages, nicknames and direct messages
+        self.federation = None  # ChatFederation.Federation linking this server to its peers
+        self.loop = None  # The event loop, when running the asyncio engine
+        self.history = history  # ChatHistory.HistoryStore of recent room messages, or None
+        self.admission = AdmissionControl()  # Connection caps and per-client rate limits (all off by default)
+        self.heartbeat = HeartbeatMonitor(ping=self.ping_client, reap=self.reap_client)  # Pings silent clients, drops dead ones
+        self.metrics = ServerMetrics()  # Counters and histograms, exported when metrics_port is set
+        self.metrics.watch(self)
+        self.metrics_port = None  # Serve Prometheus metrics on localhost at this port
+        self.compression = ALGORITHM  # Compression accepted from clients that offer it, or None
+        self.tls = None  # ssl.SSLContext from ChatTLS.server_context(), or None for plaintext
+        self.backlog = DEFAULT_BACKLOG  # listen() backlog for both engines
+        self.handoff_path = None  # Unix socket on which a new process may take over (asyncio engine)
+        self.takeover = None  # Handoff socket of a running server to take over from instead of binding the port
+        self.reopen_journal = None  # Opens the journal once the process taken over from has closed it
+        self.handing_off = False  # Set while clients are being handed to a new process
+        self._listener = None  # The asyncio Server accepting connections
+        self._stopped = None  # Future resolved once a handoff has completed
 
-    def broadcast_message(self, sender, message):
+    def broadcast_message(self, sender, message, room=None):
         """
         Broadcasts a message to all connected clients except the sender.
 
+        The message is framed once and the same bytes object is pushed onto every
+        recipient's outbound queue. Recipients come from the registry's immutable
+        snapshots, so no lock is held and no send happens on this thread.
+
         Args:
             sender: The client sending the message.
             message: The message to broadcast.
+            room: Only deliver to this room's members (default: every client).
+
+        Returns:
+            bytes: The encoded frame, so the caller can reuse it (e.g. for the echo).
+        """
+        return self.broadcast_frame(sender, encode_frame(message), room)
+
+    def broadcast_frame(self, sender, frame, room=None, echo=False, key=None):
+        """
+        Same as broadcast_message for a message that is already framed.
+
+        Recipients that negotiated compression get a compressed copy, made at
+        most once per broadcast and shared by all of them.
+
+        Args:
+            echo: Send the frame to the sender as well.
+            key: Who the message is from, for the coalesce policy (default: sender). Frames
+                without a key are never coalesced.
         """
+        if key is None:
+            key = sender
+        compressed = None
         try:
-            with self.lock:
-                # Filter out the sender before iterating over active clients
-                for socket in [client for client in self.active_clients if client != sender]:
-                    try:
-                        socket.send(message.encode())
-                    except Exception as e:
-                        logging.error(f'Failed to send message to client {socket}: {str(e)}')
-                        # Remove the client if an error occurs during sending
-                        self.rm_client(socket)
+            recipients = self.clients.snapshot() if room is None else self.clients.members(room)
+            for record in recipients:
+                client = record.connection
+                if client is sender and not echo:
+                    continue
+                if record.compression is None:
+                    client.send(frame, key)  # Enqueue only; congested queues defer to self.backpressure
+                    continue
+                if compressed is None:
+                    compressed = compress_frame(frame)
+                    self.metrics.frames_compressed.inc()
+                client.send(compressed, key)
         except Exception as e:
+            self.metrics.send_errors.inc()
             self.logger.error(f'Error occurred while broadcasting message: {str(e)}')
+        return frame
+
+    def frame_room_message(self, room, clientEncoded, msgType):
+        """
+        Frames a room message, recording chat messages in the room history.
+
+        Recorded messages are stamped with their history message ID first, so
+        every recipient sees the ID it can later pass to a 'history' request.
+
+        Returns:
+            bytes: The encoded frame.
+        """
+        if self.history is not None and msgType == 'message':
+            return self.history.record(room, clientEncoded)[1]
+        return encode_frame(clientEncoded)
+
+    def send_history(self, record, room, since=None, epoch=None):
+        """
+        Replays a room's recent messages to one client as a single write.
+
+        Every replay ends with a 'history_end' message carrying the history's
+        epoch, so a client learns when message IDs have started over. For a
+        request with since, its "more" flag tells the client to ask again from
+        "next". One answer holds at most the backpressure low watermark in
+        bytes, so it fits a healthy client's queue. When the answer has to come
+        from the journal, the asyncio engine reads it on an executor thread so
+        the event loop never waits for the disk.
+
+        Args:
+            record: The client's ClientRecord.
+            room: The room whose history is replayed.
+            since: Only replay messages with a greater message ID (default: the last few messages).
+            epoch: The epoch since belongs to; if it is not the current one, everything held is replayed.
+        """
+        if self.history is None:
+            return
+        if since is None:
+            self.send_replay(record, self.history.recent(room), room=room)
+            return
+        if epoch is not None and epoch != self.history.epoch:
+            since = 0  # An ID from before a restart that started IDs over means nothing here
+        max_bytes = self.backpressure.low_watermark
+        answer = self.history.buffered_since(room, since, max_bytes)
+        if answer is not None:
+            self.send_replay(record, *answer, room=room, since=since)
+        elif self.loop is not None:
+            future = self.loop.run_in_executor(None, self.history.journal_since, room, since, max_bytes)
+            future.add_done_callback(lambda done: self.send_replay(record, *done.result(), room=room, since=since))
+        else:
+            self.send_replay(record, *self.history.journal_since(room, since, max_bytes), room=room, since=since)
+
+    def send_replay(self, record, frames, resume=None, room=None, since=None):
+        """
+        Queues replayed frames for one client, followed by a 'history_end' message if room is given.
+
+        The frames go through the backpressure policy like any other traffic;
+        the 'history_end' message bypasses it, so the client always learns
+        where to continue, from since again if the policy refused the frames.
+
+        Args:
+            resume: The message ID to continue from, or None if the replay is complete.
+            since: The message ID the replay started after, or None for a replay of the last few messages.
+        """
+        if frames and not record.connection.send(b''.join(frames)) and since is not None:  # One chunk, one write
+            resume = since
+        if room is not None:
+            end = {"type": "history_end", "room": room, "since": since, "more": resume is not None, "next": resume,
+                   "epoch": self.history.epoch}
+            record.connection.send(encode_frame(json.dumps(end)), force=True)
 
     def add_client(self, client, socket):
         """
-        Adds a new client to the client dictionary.
+        Adds a new client to the client registry.
 
         Args:
             client: The client's address.
-            socket: The client's socket.
+            socket: The client's connection (a SocketConnection or ChatProtocol).
+
+        Returns:
+            ClientRecord: The client's record, or None if the address is already connected.
         """
-        try:
-            with self.lock:
-                if client not in self.client_dict:  # Check if the client is already connected
-                    self.client_dict[client] = socket
-                    self.active_clients.append(socket)  # Add to both dict and set for broadcasting
-                    client_id = self.get_next_client_id()
-                    self.client_dict[client_id] = {'socket': socket, 'addr': addr}
-
-                    logging.info(f'Client {client} connected successfully.')
-        except KeyError as e:
-            logging.error(f'Error occurred while adding client {client}: {str(e)}')
-
-    def get_next_client_id(self):
-        """Get a unique identifier for a new client."""
-        self.client_id += 1
-        return self.client_id
-
-    
+        record = self.clients.add(client, socket)
+        if record is None:
+            logging.error(f'Error occurred while adding client {client}: already connected')
+        else:
+            self.clients.join(record, DEFAULT_ROOM)
+            record.limiter = self.admission.limiter()
+            self.heartbeat.watch(record)
+            self.metrics.connections.inc()
+            logging.info(f'Client {client} connected successfully as #{record.client_id}.')
+            self.send_history(record, DEFAULT_ROOM)
+        return record
+
+    def adopt_client(self, client, connection, session):
+        """
+        Registers a client handed over by another server process with the state it had there.
+
+        Args:
+            client: The client's address.
+            connection: The client's ChatProtocol.
+            session: The ChatHandoff.Session describing it.
+
+        Returns:
+            ClientRecord: The client's record, or None if the address or ID is already connected.
+        """
+        record = self.clients.add(client, connection, session.client_id)
+        if record is None:
+            logging.error(f'Error occurred while adopting client {client}: already connected')
+            return None
+        if session.nickname is not None and self.clients.set_nickname(record, session.nickname):
+            record.client_ref = session.client_ref
+        for room in session.rooms:
+            self.clients.join(record, room)
+        record.compression = session.compression if session.compression == self.compression else None
+        record.limiter = self.admission.limiter()
+        self.heartbeat.watch(record)
+        return record
+
     def rm_client(self, addr):
         """
-        Removes a client from the client dictionary and closes their socket.
+        Removes a client from the client registry and closes their connection.
+        Pending outbound frames are still flushed by the client's writer.
+
         Args:
             addr: The client's address.
         """
-        with self.lock:
+        record = self.clients.remove(addr)
+        if record is None:
+            link = self.federation.remove_peer(addr) if self.federation is not None else None
+            if link is not None:
+                if link.record is not None:
+                    self.heartbeat.forget(link.record)  # Peers left the registry but are still pinged
+                return
+            logging.error(f'Error occurred while removing client {addr}: not connected')
+            return
+        self.heartbeat.forget(record)
+        if self.bus is not None:
+            self.bus.release(str(record.client_id))  # Also covers a claim granted after the client left
+        try:
+            record.connection.close()
+            logging.info(f'Client {addr} disconnected successfully.')
+        except Exception as e:
+            logging.error(f'Unexpected error occurred while disconnecting client {addr}: {str(e)}')
+
+    def ping_client(self, record):
+        """Pings a client that has been silent for the ping interval (called by the heartbeat monitor)."""
+        record.connection.send(PING_FRAME)
+        self.message_logger.info('TO CLIENT %s: %s', record.addr, 'ping')
+
+    def reap_client(self, record):
+        """
+        Drops a client that did not answer a ping in time (called by the heartbeat monitor).
+
+        The connection is aborted so its handler thread or protocol runs the
+        usual rm_client cleanup.
+        """
+        self.logger.warning(f'Client {record.addr} did not answer a ping within {self.heartbeat.timeout}s; disconnecting')
+        record.connection.abort()
+
+    def claim_nickname(self, record, clientData, clientEncoded):
+        """
+        Claims a handshake's nickname from the worker bus before it is registered.
+
+        With --workers the bus is the one nickname directory of all workers. The
+        thread-per-connection engine waits for its answer on the client's handler
+        thread; the asyncio engine holds this frame and any that follow it on
+        record.held and replays them once the answer is in, so the event loop
+        never waits and the client's frames keep their order.
+
+        Args:
+            record: The sending client's ClientRecord.
+            clientData: The decoded 'nickname' message.
+            clientEncoded: The frame payload.
+
+        Returns:
+            bool: True if the frame is held until the bus answers.
+        """
+        if self.bus is None or not clientData.get('nickname') or record.claim is not None:
+            return False
+        nickname = str(clientData['nickname'])
+        token = str(record.client_id)
+        if self.loop is None:
+            answered = threading.Event()
+            answer = []
+
+            def claimed(granted):
+                answer.append(granted)
+                answered.set()
+            self.bus.claim(nickname, token, claimed)
+            answered.wait()
+            record.claim = (nickname, answer[0])
+            return False
+        record.held = [clientEncoded]
+        self.bus.claim(nickname, token,
+                       lambda granted: self.loop.call_soon_threadsafe(self.nickname_claimed, record, nickname, granted))
+        return True
+
+    def nickname_claimed(self, record, nickname, granted):
+        """Replays the frames held while a nickname claim was pending (asyncio engine, on the event loop)."""
+        held, record.held = record.held, None
+        record.claim = (nickname, granted)
+        if self.clients.get(record.addr) is not record:
+            return  # Left in the meantime; rm_client has released the nickname
+        for clientEncoded in held:
+            if self.handle_message(record, clientEncoded):
+                record.connection.close()
+                return
+
+    def register_nickname(self, record, clientData):
+        """
+        Records the nickname from a client's handshake message.
+
+        Nicknames are unique among the connected clients: the registry's nickname
+        index answers the check in one lookup, after claim_nickname() has checked
+        the other workers' clients. A taken nickname is refused with an error and
+        the client may send another handshake.
+
+        Args:
+            record: The sending client's ClientRecord.
+            clientData: The decoded 'nickname' message.
+
+        Returns:
+            bool: False if the nickname is already in use.
+        """
+        if not clientData.get('nickname'):
+            return True
+        nickname = str(clientData['nickname'])
+        claim, record.claim = record.claim, None
+        if claim is not None and not claim[1] or not self.clients.set_nickname(record, nickname):
+            logging.warning(f'Client {record.addr} requested nickname {nickname}, which is already in use.')
+            record.connection.send(NICKNAME_IN_USE_FRAME)
+            return False
+        record.client_ref = clientData.get('clientID')
+        logging.info(f'Client {record.addr} registered nickname {nickname}.')
+        return True
+
+    def check_sender(self, record, clientData):
+        """
+        Checks that a client may send a message others will see under its nickname.
+
+        Messages are forwarded as received, so one whose "nickname" field is not
+        the sender's registered nickname would let a client speak as another
+        user; it is refused, as is anything from a client without a nickname
+        (including one whose requested nickname was already in use).
+
+        Args:
+            record: The sending client's ClientRecord.
+            clientData: The decoded message, or None if it is not a JSON object.
+
+        Returns:
+            bool: False if the message was refused with an error.
+        """
+        if record.nickname is None:
+            text = "Choose a nickname before sending messages"
+        elif clientData is not None and str(clientData.get('nickname', record.nickname)) != record.nickname:
+            text = f"Messages must be sent under your nickname {record.nickname}"
+        else:
+            return True
+        record.connection.send(encode_frame(json.dumps({"type": "error", "message": text})))
+        return False
+
+    def send_direct(self, record, clientData, clientEncoded):
+        """
+        Delivers a 'direct' message to the one client named in its "to" field.
+
+        The recipient is found through the nickname index and only its outbound
+        queue is touched; the original bytes are forwarded, compressed if the
+        recipient negotiated compression. A recipient that is not a client of
+        this process is looked for on the other workers through the bus (but
+        not on peer servers).
+
+        Args:
+            record: The sending client's ClientRecord, already checked by check_sender().
+            clientData: The decoded 'direct' message.
+            clientEncoded: The frame payload.
+        """
+        nickname = str(clientData.get('to'))
+        recipient = self.clients.get_by_nickname(nickname)
+        if recipient is None and self.bus is not None:
+            self.bus.send_direct(nickname, str(record.client_id), clientEncoded)  # Answered by direct_failed() if unknown
+            return
+        if recipient is None:
+            self.send_unknown_recipient(record, nickname)
+            return
+        self.forward_direct(recipient, clientEncoded, ('direct', record.connection))  # Coalesced apart from room messages
+
+    def forward_direct(self, recipient, clientEncoded, key=None):
+        """Queues a direct message for its recipient, compressed if the recipient negotiated compression."""
+        frame = encode_frame(clientEncoded)
+        recipient.connection.send(frame if recipient.compression is None else compress_frame(frame), key)
+        self.metrics.direct_messages.inc()
+        self.message_logger.info('TO CLIENT %s: %s', recipient.addr, clientEncoded)
+
+    def send_unknown_recipient(self, record, nickname):
+        """Tells a client that no one is using the nickname it sent a direct message to."""
+        error = json.dumps({"type": "error", "message": f"No client is using the nickname {nickname}"})
+        record.connection.send(encode_frame(error))
+
+    def deliver_direct(self, nickname, clientEncoded):
+        """
+        Delivers a direct message that a client of another worker sent to a client of this one.
+
+        Called from the bus reader thread; like deliver_relayed(), the asyncio
+        engine hands the delivery to the event loop.
+        """
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._deliver_direct, nickname, clientEncoded)
+        else:
+            self._deliver_direct(nickname, clientEncoded)
+
+    def _deliver_direct(self, nickname, clientEncoded):
+        recipient = self.clients.get_by_nickname(nickname)
+        if recipient is not None:  # Otherwise it left after the bus routed the message
+            self.forward_direct(recipient, clientEncoded)
+
+    def direct_failed(self, nickname, token):
+        """Reports a direct message whose recipient no worker knows back to its sender (bus reader thread)."""
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self._direct_failed, nickname, token)
+        else:
+            self._direct_failed(nickname, token)
+
+    def _direct_failed(self, nickname, token):
+        record = self.clients.get_by_id(int(token))
+        if record is not None:
+            self.send_unknown_recipient(record, nickname)
+
+    def negotiate_compression(self, record, clientData):
+        """
+        Accepts a compression algorithm offered in a client's handshake and acknowledges it.
+
+        Args:
+            record: The sending client's ClientRecord.
+            clientData: The decoded 'nickname' message.
+        """
+        if self.compression is None or record.compression is not None:
+            return
+        algorithm = negotiate(clientData.get('compression'))
+        if algorithm is not None:
+            record.connection.send(encode_frame(json.dumps({"type": "compression", "algorithm": algorithm})))
+            record.compression = algorithm  # Set after the plain acknowledgement is queued
+
+    def handle_message(self, record, clientEncoded):
+        """
+        Processes one framed message from a client; shared by both engines.
+
+        Args:
+            record: The sending client's ClientRecord.
+            clientEncoded: The frame payload.
+
+        Returns:
+            bool: True if the client asked to disconnect.
+        """
+        record.last_seen = time.monotonic()  # Any frame counts as a heartbeat
+        if record.held is not None:  # A nickname claim is pending; nickname_claimed() replays this
+            record.held.append(clientEncoded)
+            return False
+        limiter = record.limiter
+        if limiter is not None and not limiter.allow(len(clientEncoded)):
+            if limiter.start_episode():  # Tell the client once, not once per dropped frame
+                error = json.dumps({"type": "error", "message": "Rate limit exceeded; messages are being dropped"})
+                record.connection.send(encode_frame(error))
+            return False
+        if record.peer is not None:
+            self.federation.handle_relay(record.addr, clientEncoded)
+            return False
+        received = time.perf_counter_ns()
+        self.metrics.messages_in.inc()
+        self.metrics.bytes_in.inc(len(clientEncoded))
+        clientMessage = clientEncoded.decode()
+        self.message_logger.info('FROM CLIENT %s: %s', record.addr, clientMessage)
+        if clientMessage.strip().upper() == "DISCONNECT":
+            frame = self.broadcast_message(record.connection, "DISCONNECT")
+            record.connection.send(frame)
+            self.message_logger.info('TO CLIENT %s: %s', record.addr, "DISCONNECT")
+            return True
+
+        clientData = parse_message(clientEncoded)
+        msgType = clientData.get('type') if clientData is not None else None
+        room = DEFAULT_ROOM
+        if clientData is not None and clientData.get('room') is not None:
+            room = str(clientData['room'])
+
+        if msgType == 'nickname':
+            if self.claim_nickname(record, clientData, clientEncoded):
+                return False  # Handled once the other workers' clients have been checked
+            if not self.register_nickname(record, clientData):
+                return False
+            self.negotiate_compression(record, clientData)
+        elif msgType == 'direct':
+            if self.check_sender(record, clientData):
+                self.send_direct(record, clientData, clientEncoded)
+            return False
+        elif msgType == 'join':
+            joined = self.clients.join(record, room)
+            record.connection.send(encode_frame(clientMessage))  # Acknowledge by echoing the request
+            if joined:
+                self.send_history(record, room)
+            return False
+        elif msgType == 'leave':
+            self.clients.leave(record, room)
+            record.connection.send(encode_frame(clientMessage))
+            return False
+        elif msgType == 'pong':
+            self.heartbeat.stats.record('pongs_received')
+            return False
+        elif msgType == 'ping':
+            record.connection.send(PONG_FRAME)
+            return False
+        elif msgType == 'peer_hello' and self.federation is not None:
+            if not self.federation.accept_peer(record, clientData):
+                record.connection.send(PEER_REJECTED_FRAME)
+                return True
+            record.limiter = self.admission.peer_limiter()  # Client limits would drop the whole mesh's relays
+            return False
+
+        if room not in record.rooms:
+            error = json.dumps({"type": "error", "message": f"Not a member of room {room}"})
+            record.connection.send(encode_frame(error))
+            return msgType == 'disconnect'
+        if msgType == 'history':
             try:
-                connectionSocket = self.client_dict[addr]
-                connectionSocket.close()
-                self.active_clients.remove(connectionSocket)
-                del self.client_dict[addr]  # Ensure the client is removed from the dictionary
-                logging.info(f'Client {addr} disconnected successfully.')
-            except KeyError as e:
-                logging.error(f'Error occurred while removing client {addr}: {str(e)}')
-            except ValueError:
-                logging.error(f'Socket for client {addr} not found in active clients list.')
-            except Exception as e:
-                logging.error(f'Unexpected error occurred while disconnecting client {addr}: {str(e)}')
+                since = None if clientData.get('since') is None else int(clientData['since'])
+            except (TypeError, ValueError):
+                error = json.dumps({"type": "error", "message": "'since' must be a message ID"})
+                record.connection.send(encode_frame(error))
+                return False
+            self.send_history(record, room, since, clientData.get('epoch'))
+            return False
+        if not self.check_sender(record, clientData):
+            return msgType == 'disconnect'
+        if self.sequenced(msgType):
+            self.bus.sequence(room, clientEncoded)  # Delivered here as well once the bus has numbered it
+        else:
+            frame = self.frame_room_message(room, clientEncoded, msgType)
+            self.broadcast_frame(record.connection, frame, room, echo=True)
+            self.metrics.broadcast_latency.record((time.perf_counter_ns() - received) // 1000)
+            if self.bus is not None:
+                self.bus.publish(room, clientEncoded)
+        if self.federation is not None:
+            self.federation.publish(room, clientEncoded)
+        self.message_logger.info('TO CLIENT %s: %s', record.addr, clientMessage)
+        return msgType == 'disconnect'
+
+    def deliver_relayed(self, room, clientEncoded, origin=None, msg_id=None):
+        """
+        Delivers a room message that a client of another worker sent.
+
+        Called from the bus reader thread; with the asyncio engine the broadcast
+        is handed to the event loop so outbound queues are only touched there.
+
+        Args:
+            room: The room the message was sent to.
+            clientEncoded: The original message payload.
+            origin: The worker or peer node the message came from.
+            msg_id: The message ID the bus gave a numbered chat message (which may come from this worker).
+        """
+        if self.handing_off:
+            return  # Clients are moving to the new process; its own links carry the traffic
+        clientData = parse_message(clientEncoded)
+        if msg_id is not None and self.history is not None:
+            frame = self.history.record(room, clientEncoded, msg_id)[1]
+        else:
+            frame = self.frame_room_message(room, clientEncoded, clientData.get('type') if clientData else None)
+        key = None  # Not coalesced unless the sender is known
+        if clientData is not None and clientData.get('nickname') is not None:
+            key = ('relay', origin, str(clientData['nickname']))
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.broadcast_frame, None, frame, room, False, key)
+        else:
+            self.broadcast_frame(None, frame, room, key=key)
+
+    def deliver_federated(self, room, clientEncoded, origin=None):
+        """
+        Delivers a room message relayed by a peer server to this node's clients,
+        including those of the other workers when running with --workers.
+        """
+        clientData = parse_message(clientEncoded)
+        if self.sequenced(clientData.get('type') if clientData else None):
+            self.bus.sequence(room, clientEncoded, origin)
+            return
+        self.deliver_relayed(room, clientEncoded, origin)
+        if self.bus is not None:
+            self.bus.publish(room, clientEncoded, origin)
+
+    def sequenced(self, msgType):
+        """True if a room message of this type gets its message ID from the bus, so that all workers agree on it."""
+        return self.bus is not None and self.history is not None and msgType == 'message'
 
+    def accept_tls(self, connectionSocket, addr):
+        """
+        Runs the TLS handshake for a newly accepted client.
 
+        Returns:
+            ChatTLS.TLSSocket: The established connection, or None if the handshake failed.
+        """
+        started = time.perf_counter_ns()
+        try:
+            tlsSocket = server_handshake(self.tls, connectionSocket)
+        except OSError as e:  # ssl.SSLError and timeouts included
+            self.metrics.tls_failures.inc()
+            self.logger.warning(f'TLS handshake with {addr} failed: {str(e)}')
+            return None
+        self.metrics.tls_handshake_latency.record((time.perf_counter_ns() - started) // 1000)
+        self.metrics.count_tls_handshake(tlsSocket.session_reused)
+        return tlsSocket
 
     def client_handler(self, connectionSocket, addr):
         """
@@ -99,60 +624,556 @@ class ChatServer:
             connectionSocket: The client's socket.
             addr: The client's address.
         """
+        if self.tls is not None:
+            connectionSocket = self.accept_tls(connectionSocket, addr)  # On this thread, never the accept loop
+            if connectionSocket is None:
+                self.admission.release(addr)
+                return
+        connection = SocketConnection(connectionSocket, addr, self.backpressure, self.metrics)  # Starts the client's writer thread
+        record = None
         try:
-            self.add_client(addr, connectionSocket)
+            record = self.add_client(addr, connection)
+            if record is None:
+                return
             self.logger.info('Client %s made connection', addr)
-            
-            while True:
-                clientEncoded = connectionSocket.recv(1024)
-                if not clientEncoded:
-                    break  # Client disconnected
-                
-                clientMessage = clientEncoded.decode()
-                self.logger.info('FROM CLIENT %s: %s', addr, clientMessage)
-                serverSentence = "DISCONNECT" if clientMessage.strip().upper() == "DISCONNECT" else clientMessage
-                self.broadcast_message(connectionSocket, serverSentence)
-                connectionSocket.send(serverSentence.encode())
-                self.logger.info('TO CLIENT %s: %s', addr, serverSentence)
-                if clientMessage.strip().upper() == "DISCONNECT":
+
+            for clientEncoded in iter_frames(connectionSocket):  # Ends when the client disconnects
+                if self.handle_message(record, clientEncoded):
                     break  # Client
         except Exception as e:
             logging.error("Failed to handle client %s: %s", addr, str(e))
         finally:
-            self.rm_client(addr)  # Ensure the client is removed and the socket is closed
-
-
+            if record is not None:
+                self.rm_client(addr)  # Ensure the client is removed and the socket is closed
+            connection.close()  # No-op if rm_client already closed it
+            self.admission.release(addr)
 
     def start(self):
         """Start the chat server."""
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.ip, self.port))  # Correctly use self.port here
-        self.server_socket.listen()
+        self.server_socket.listen(self.backlog)
         
         print("Chat server is running...")
+        self.heartbeat.start()
         
         while True:
             connectionSocket, addr = self.server_socket.accept()
+            if not self.admission.admit(addr):  # Over a connection cap: close before spending a thread on it
+                connectionSocket.close()
+                continue
             client_thread = threading.Thread(target=self.client_handler, args=(connectionSocket, addr))
             client_thread.start()
 
+    async def serve_async(self):
+        """
+        Runs the chat server on the current asyncio event loop.
+
+        Every connection is served by a ChatProtocol instance on a single thread,
+        so idle clients cost a transport and a protocol object instead of a thread stack.
+        With takeover set, the listening socket and clients come from the running
+        server instead; with handoff_path set, this server can hand them on in turn.
+        """
+        loop = self.loop = asyncio.get_running_loop()
+        self._stopped = loop.create_future()
+        if self.takeover is not None:
+            try:
+                await self.take_over(self.takeover)
+            except OSError as e:  # Includes ChatHandoff.HandoffError
+                logging.error(f'Cannot take over from {self.takeover}: {str(e)}')
+                sys.exit(1)
+        else:
+            await self.listen()
+        print("Chat server is running (asyncio)...")
+        self.heartbeat.start_on(loop)
+        if self.handoff_path is not None:
+            HandoffListener(self, self.handoff_path)
+        await self._stopped
+
+    async def listen(self, sock=None):
+        """
+        Starts accepting connections on the configured address, or on an inherited listening socket.
+
+        Connections are accepted in plaintext; ChatProtocol applies admission
+        control first and only then upgrades admitted ones to TLS.
+        """
+        if sock is None:
+            address = {'host': self.ip, 'port': self.port, 'reuse_address': True, 'reuse_port': self.reuse_port or None}
+        else:
+            address = {'sock': sock}
+        self._listener = await self.loop.create_server(lambda: ChatProtocol(self), backlog=self.backlog, **address)
+
+    async def take_over(self, path):
+        """
+        Takes the listening socket, history and clients over from the server listening for handoffs at path.
+
+        Raises:
+            ChatHandoff.HandoffError: If the running server breaks off the handoff.
+        """
+        takeover = await self.loop.run_in_executor(None, take_over, path)
+        await self.loop.run_in_executor(None, takeover.confirm)  # The old process has let go once this returns
+        if self.reopen_journal is not None:
+            self.history.attach(self.reopen_journal())
+        elif self.history is not None and takeover.history is not None:
+            self.history.load(takeover.history)
+        await self.adopt_sessions(takeover.sessions)
+        await self.listen(takeover.listener)
+        logging.info(f'Took over {len(takeover.sessions)} clients from {path}')
+
+    async def adopt_sessions(self, sessions):
+        """
+        Serves handed-over client sockets, each with its own ChatProtocol.
+
+        Nobody is read from until every client is registered, so no broadcast misses a client adopted later.
+        """
+        protocols = []
+        for session in sessions:
+            _, protocol = await self.loop.connect_accepted_socket(lambda session=session: ChatProtocol(self, session),
+                                                                  session.sock)
+            protocols.append(protocol)
+        for protocol in protocols:
+            protocol.start_adopted()
+
+    async def export_sessions(self, drain_timeout=DRAIN_TIMEOUT):
+        """
+        Stops serving and detaches every client that can move to a new process.
+
+        Reading stops everywhere first; each client is detached once its outbound
+        backlog has been written, so the new process starts on a frame boundary.
+
+        Returns:
+            ChatHandoff.Export: The listening socket, history and sessions to send.
+        """
+        self.handing_off = True
+        self.heartbeat.stop()
+        server_socket = self._listener.sockets[0]
+        listener = socket.fromfd(server_socket.fileno(), server_socket.family, server_socket.type)  # A duplicate
+        self._listener.close()
+        records = self.clients.snapshot()
+        for record in records:
+            record.connection.transport.pause_reading()
+        deadline = self.loop.time() + drain_timeout
+        while any(not record.connection.drained() for record in records) and self.loop.time() < deadline:
+            await asyncio.sleep(0.01)
+        sessions = []
+        for record in self.clients.snapshot():  # No awaits from here on: nothing else may write to these sockets
+            protocol = record.connection
+            if record.peer is not None or protocol.transport.get_extra_info('ssl_object') is not None:
+                continue
+            if not protocol.drained():
+                continue
+            sessions.append(protocol.hand_off())
+        history = self.history.export() if self.history is not None and self.history.journal is None else None
+        return Export(listener, history, sessions, len(self.clients))
+
+    async def resume_after_handoff(self, export):
+        """Takes back the exported clients and resumes serving after a failed handoff."""
+        await self.adopt_sessions(export.sessions)
+        for record in self.clients.snapshot():
+            record.connection.transport.resume_reading()
+        await self.listen(export.listener)
+        self.handing_off = False
+        self.heartbeat.start_on(self.loop)
+
+    def finish_handoff(self):
+        """Closes the connections that could not be handed over and stops the server."""
+        for record in self.clients.snapshot():
+            record.connection.close()  # TLS clients, peers and slow clients reconnect to the new process
+        self.loop.call_later(0.1, self._stopped.set_result, None)  # Let the closes go out first
+
+    def start_async(self):
+        """Start the chat server using the asyncio event-loop engine."""
+        raise_fd_limit()
+        try:
+            asyncio.run(self.serve_async())
+        except KeyboardInterrupt:
+            pass
+
+
+PING_FRAME = encode_frame(json.dumps({"type": "ping"}))
+PONG_FRAME = encode_frame(json.dumps({"type": "pong"}))
+PEER_REJECTED_FRAME = encode_frame(json.dumps({"type": "error", "message": "Peer authentication failed"}))
+NICKNAME_IN_USE_FRAME = encode_frame(json.dumps({"type": "error", "message": "Nickname already in use"}))
+CODEC = MessageCodec()  # Decodes messages for routing only; clients' bytes are forwarded as received
+
+
+def parse_message(clientMessage):
+    """
+    Decodes a client's JSON message (str or bytes).
+
+    Returns:
+        dict: The message, or None if it is not a JSON object (e.g. a bare "DISCONNECT").
+    """
+    try:
+        return CODEC.decode(clientMessage)
+    except CodecError:
+        return None
+
+
+class ChatProtocol(asyncio.Protocol):
+    """
+    asyncio counterpart of ChatServer.client_handler, one instance per connection.
+
+    The protocol doubles as the client's connection in the server's registry:
+    it exposes send() and close() so add_client, rm_client, handle_message and
+    broadcast_message behave exactly as they do for the thread-per-connection engine. Frames are
+    queued on an OutboundQueue and flushed in batches from a callback scheduled
+    once per loop iteration; nothing is drained while the transport has paused
+    writing, so a slow client's backlog stays under the backpressure policy.
+    """
+    __slots__ = ('server', 'transport', 'addr', 'record', 'decoder', 'outbound', '_loop',
+                 '_flush_scheduled', '_paused', 'session', '_early')
+
+    def __init__(self, server, session=None):
+        self.server = server
+        self.transport = None
+        self.addr = None
+        self.record = None
+        self.decoder = FrameDecoder()
+        self.outbound = OutboundQueue(self._schedule_flush, server.backpressure, self._evict)
+        self._loop = asyncio.get_running_loop()
+        self._flush_scheduled = False
+        self._paused = False
+        self.session = session  # ChatHandoff.Session of a client handed over by another process
+        self._early = b''  # Bytes that arrived with the end of the TLS handshake, before registration
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        if self.session is not None:
+            self._adopt()
+            return
+        if not self.server.admission.admit(self.addr):  # Before any TLS work, so a refused flood costs no handshakes
+            transport.abort()
+            return
+        if self.server.tls is not None:
+            transport.pause_reading()  # The ClientHello is for start_tls(), not data_received()
+            self._loop.create_task(self._start_tls(transport))
+            return
+        self._register()
+
+    async def _start_tls(self, transport):
+        """
+        Runs the TLS handshake of an admitted connection, then registers the client.
+
+        The handshake runs on the event loop like all other I/O (asyncio cannot
+        move it to another thread); its CPU cost, mostly the key exchange,
+        delays every other client while it runs. Resumed sessions skip most of
+        it, and --workers spreads handshakes over several processes.
+        """
+        started = time.perf_counter_ns()
+        try:
+            transport = await self._loop.start_tls(transport, self, self.server.tls, server_side=True,
+                                                   ssl_handshake_timeout=HANDSHAKE_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:  # ssl.SSLError and resets included
+            self.server.metrics.tls_failures.inc()
+            self.server.logger.warning(f'TLS handshake with {self.addr} failed: {str(e) or type(e).__name__}')
+            self.server.admission.release(self.addr)
+            transport.abort()
+            return
+        self.transport = transport
+        self.server.metrics.tls_handshake_latency.record((time.perf_counter_ns() - started) // 1000)
+        self.server.metrics.count_tls_handshake(transport.get_extra_info('ssl_object').session_reused)
+        if transport.is_closing():  # Lost before this task resumed; connection_lost saw no record to clean up
+            self.server.admission.release(self.addr)
+            return
+        self._register()
+        if self.record is not None and self._early:
+            early, self._early = self._early, b''
+            self.data_received(early)
+
+    def _register(self):
+        self.record = self.server.add_client(self.addr, self)
+        if self.record is None:
+            self.server.admission.release(self.addr)
+            self.transport.abort()
+            return
+        self.server.logger.info('Client %s made connection', self.addr)
+
+    def _adopt(self):
+        self.server.admission.admit(self.addr, force=True)
+        self.record = self.server.adopt_client(self.addr, self, self.session)
+        if self.record is None:
+            self.server.admission.release(self.addr)
+            self.transport.abort()
+            return
+        self.transport.pause_reading()  # Until start_adopted()
+
+    def start_adopted(self):
+        """Starts reading from a handed-over client, beginning with the partial frame the previous process had read."""
+        session, self.session = self.session, None
+        if self.record is None:
+            return
+        self.transport.resume_reading()
+        if session.pending:
+            self.data_received(session.pending)
+
+    def hand_off(self):
+        """
+        Detaches this client for a new server process without closing its connection.
+
+        Returns:
+            ChatHandoff.Session: The client's state and a duplicate of its socket.
+        """
+        record, self.record = self.record, None
+        sock = self.transport.get_extra_info('socket')
+        session = Session(socket.fromfd(sock.fileno(), sock.family, sock.type), record.client_id, record.nickname,
+                          record.client_ref, sorted(record.rooms), record.compression, self.decoder.pending())
+        self.server.clients.remove(self.addr)
+        self.server.heartbeat.forget(record)
+        self.server.admission.release(self.addr)
+        self.outbound.close()
+        self.transport.abort()  # Closes this process's descriptor only; the duplicate keeps the connection open
+        return session
+
+    def drained(self):
+        """True once every queued frame has been handed to the kernel."""
+        return not len(self.outbound) and not self.transport.get_write_buffer_size()
+
+    def data_received(self, data):
+        if self.record is None:  # Only before _start_tls() has registered the client
+            self._early += data
+            return
+        try:
+            for clientEncoded in self.decoder.feed(data):
+                if self.server.handle_message(self.record, clientEncoded):
+                    self.close()
+                    break
+        except Exception as e:
+            logging.error("Failed to handle client %s: %s", self.addr, str(e))
+            self.transport.abort()
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            self.server.metrics.send_errors.inc()
+        self.outbound.close()
+        if self.record is not None:
+            self.server.rm_client(self.addr)  # Same cleanup path as the threaded handler's finally block
+            self.server.admission.release(self.addr)
+
+    def pause_writing(self):
+        self._paused = True  # Leave frames in the outbound queue until the transport drains
+
+    def resume_writing(self):
+        self._paused = False
+        self._flush()
+
+    def send(self, frame, key=None, force=False):
+        """Queue an encoded frame for this client; never blocks the event loop."""
+        return self.outbound.put(frame, key, force)
+
+    sendall = send
+
+    def close(self):
+        """Stop accepting frames, flush what is queued and close the transport."""
+        self.outbound.close()
+
+    def abort(self):
+        """Drops the connection without flushing; connection_lost() runs the usual rm_client cleanup."""
+        self.transport.abort()
+
+    def _evict(self):
+        """Called when the backpressure policy disconnects this client."""
+        logging.warning(f'Disconnecting slow client {self.addr}')
+        self.abort()
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self.transport.is_closing():
+            return
+        while not self._paused:  # writelines() may pause the protocol once the transport buffer is full
+            frames = self.outbound.drain()
+            if not frames:
+                break
+            self.transport.writelines(frames)
+            self.server.metrics.bytes_out.inc(sum(map(len, frames)))
+        if self.outbound.closed and not len(self.outbound):
+            self.transport.close()  # Closes once the transport's own buffer is written
+
+
+def raise_fd_limit():
+    """Raise the soft open-file limit to the hard limit so the server can hold 10k+ sockets."""
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError) as e:
+        logging.warning(f'Could not raise open-file limit: {str(e)}')
+
+
+def open_journal(args, worker_id=None):
+    """Opens the journal configured on the command line; each worker journals to its own subdirectory."""
+    directory = args.journal if worker_id is None else os.path.join(args.journal, f'worker-{worker_id}')
+    return Journal(directory, args.segment_bytes, args.commit_interval,
+                   retention_bytes=args.retention_bytes or None,
+                   retention_seconds=args.retention_hours * 3600 or None)
+
+
+def create_server(args, worker_id=None):
+    """
+    Builds a ChatServer from the parsed command line.
+
+    Args:
+        args: The argparse namespace produced by main().
+        worker_id: The worker number with --workers; each worker journals to its own subdirectory.
+    """
+    backpressure = make_policy(args.policy, args.high_watermark, args.low_watermark)
+    journal = None
+    if args.journal and not args.takeover:  # A takeover opens the journal once the old process has closed it
+        journal = open_journal(args, worker_id)
+    history = HistoryStore(args.history, args.history_bytes, args.replay, journal) if args.history > 0 else None
+    server = ChatServer(args.server_ip, args.port, backpressure, history)
+    server.handoff_path = args.handoff_socket
+    server.takeover = args.takeover
+    if args.journal and args.takeover:
+        server.reopen_journal = lambda: open_journal(args, worker_id)
+    server.compression = None if args.compression == 'none' else args.compression
+    server.admission = AdmissionControl(args.max_connections, args.max_per_ip, args.message_rate, args.message_burst,
+                                        args.byte_rate, args.byte_burst, args.peer_message_rate, args.peer_byte_rate)
+    server.backlog = args.backlog
+    server.heartbeat = HeartbeatMonitor(args.ping_interval, args.ping_timeout, server.ping_client, server.reap_client)
+    if args.tls_cert:
+        server.tls = server_context(args.tls_cert, args.tls_key)
+    if args.metrics_port:
+        server.metrics_port = args.metrics_port + (worker_id or 0)  # One endpoint per worker
+    if args.peer or args.node_id:
+        server.federation = Federation(server, args.node_id, [parse_peer(peer) for peer in args.peer], args.peer_secret)
+        if args.tls_cert:
+            server.federation.tls = client_context(args.tls_ca)  # Peers listen with TLS too
+    return server
+
+
+def run_server(server, mode):
+    """Runs a server on the selected engine until it is interrupted."""
+    if server.federation is not None:
+        server.federation.start()  # Dial peers; links retry until the peers are up
+    if server.metrics_port:
+        serve_metrics(server.metrics, server.metrics_port)
+        logging.info(f'Serving metrics at http://127.0.0.1:{server.metrics_port}/metrics')
+    try:
+        if mode == "asyncio":
+            server.start_async()  # Single event loop, flat per-connection memory
+        else:
+            server.start()  # Start the server with proper backlog and thread
+    finally:
+        if server.history is not None:
+            server.history.close()  # Commit the journal's last batch
+
 
 def main():
     parser = argparse.ArgumentParser(description="Start a chat server.")
     parser.add_argument("port", type=int, help="Port number must be between 1 and 65536.")
     parser.add_argument("server_ip", help="Server IP address.")
+    parser.add_argument("--mode", choices=("thread", "asyncio"), default="thread",
+                        help="Server engine: one thread per client (default) or a single asyncio event loop.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of server processes sharing the port via SO_REUSEPORT (default 1).")
+    parser.add_argument("--peer", action="append", default=[], metavar="HOST:PORT",
+                        help="Federate with another chat server (repeatable).")
+    parser.add_argument("--node-id", default=None,
+                        help="Name of this server in the federation; setting it (or --peer) lets other servers link to this one.")
+    parser.add_argument("--peer-secret", default=os.environ.get("CHAT_PEER_SECRET"), metavar="SECRET",
+                        help="Shared secret that authenticates federation peers; required with --peer or --node-id "
+                             "(default: $CHAT_PEER_SECRET, which keeps it out of the process list).")
+    parser.add_argument("--policy", choices=tuple(POLICIES), default="drop-newest",
+                        help="What to do with a client whose backlog crosses the high watermark.")
+    parser.add_argument("--high-watermark", type=int, default=DEFAULT_HIGH_WATERMARK,
+                        help="Per-client backlog in bytes at which the slow-consumer policy applies.")
+    parser.add_argument("--low-watermark", type=int, default=DEFAULT_LOW_WATERMARK,
+                        help="Per-client backlog in bytes at which a slow client is considered caught up.")
+    parser.add_argument("--history", type=int, default=DEFAULT_HISTORY,
+                        help="Messages kept per room for replay to joining clients (0 disables history).")
+    parser.add_argument("--history-bytes", type=int, default=DEFAULT_HISTORY_BYTES,
+                        help="Encoded bytes kept per room; older messages are dropped first (0 for no byte cap).")
+    parser.add_argument("--replay", type=int, default=DEFAULT_REPLAY,
+                        help="Messages replayed to a client when it joins a room.")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on 127.0.0.1 at this port (worker N uses port + N).")
+    parser.add_argument("--journal", default=None, metavar="DIRECTORY",
+                        help="Write every room message to a write-ahead journal in this directory and restore history from it.")
+    parser.add_argument("--segment-bytes", type=int, default=DEFAULT_SEGMENT_BYTES,
+                        help="Journal segment size at which a new segment is started.")
+    parser.add_argument("--commit-interval", type=float, default=DEFAULT_COMMIT_INTERVAL,
+                        help="Seconds the journal waits to group messages into one fsync.")
+    parser.add_argument("--retention-bytes", type=int, default=0,
+                        help="Delete the oldest journal segments beyond this many bytes (0 keeps everything).")
+    parser.add_argument("--retention-hours", type=float, default=0,
+                        help="Delete journal segments older than this (0 keeps everything).")
+    parser.add_argument("--compression", choices=(ALGORITHM, "none"), default=ALGORITHM,
+                        help="Compress broadcasts for clients that offer this algorithm (default) or never compress.")
+    parser.add_argument("--backlog", type=int, default=DEFAULT_BACKLOG,
+                        help="Pending connections the kernel queues (listen backlog).")
+    parser.add_argument("--max-connections", type=int, default=0,
+                        help="Refuse connections beyond this many concurrent clients, per worker (0: no limit).")
+    parser.add_argument("--max-per-ip", type=int, default=0,
+                        help="Refuse connections beyond this many from one IP address, per worker (0: no limit).")
+    parser.add_argument("--message-rate", type=float, default=0,
+                        help="Frames per second each client may send; excess frames are dropped (0: no limit).")
+    parser.add_argument("--message-burst", type=float, default=0,
+                        help="Frames a client may send at once after being idle (default: one second's worth).")
+    parser.add_argument("--byte-rate", type=float, default=0,
+                        help="Payload bytes per second each client may send (0: no limit).")
+    parser.add_argument("--byte-burst", type=float, default=0,
+                        help="Payload bytes a client may send at once (default: one second's worth); "
+                             "larger frames are always dropped.")
+    parser.add_argument("--peer-message-rate", type=float, default=0,
+                        help="Frames per second each federation peer link may send (0: no limit).")
+    parser.add_argument("--peer-byte-rate", type=float, default=0,
+                        help="Payload bytes per second each federation peer link may send (0: no limit).")
+    parser.add_argument("--ping-interval", type=float, default=DEFAULT_PING_INTERVAL,
+                        help="Seconds of silence after which a client is pinged (0 disables heartbeats).")
+    parser.add_argument("--ping-timeout", type=float, default=DEFAULT_PING_TIMEOUT,
+                        help="Seconds a pinged client has to send anything before it is disconnected.")
+    parser.add_argument("--handoff-socket", default=None, metavar="PATH",
+                        help="Listen on this Unix socket for a new server process to take over without dropping clients (asyncio engine).")
+    parser.add_argument("--takeover", default=None, metavar="PATH",
+                        help="Take the listening socket, clients and history over from the server at this handoff socket.")
+    parser.add_argument("--tls-cert", default=None, metavar="PEM",
+                        help="Serve TLS with this certificate chain (plaintext if omitted).")
+    parser.add_argument("--tls-key", default=None, metavar="PEM",
+                        help="Private key for --tls-cert (default: read from the certificate file).")
+    parser.add_argument("--tls-ca", default=None, metavar="PEM",
+                        help="Certificate to trust when dialing --peer servers over TLS (default: system store).")
+    add_logging_arguments(parser)
     args = parser.parse_args()
-    server_ip = args.server_ip
+    setup_logging_from_args(args)
     port = args.port
     try:
         if not 1 <= port <= 65536:
             raise ValueError("Port number must be between 1 and 65536.")
-    except ValueError as e:
+        if args.workers < 1:
+            raise ValueError("The number of workers must be at least 1.")
+        if args.history < 0 or args.history_bytes < 0 or args.replay < 0:
+            raise ValueError("History sizes must not be negative.")
+        if args.journal and args.history == 0:
+            raise ValueError("--journal needs message history; do not combine it with --history 0.")
+        if args.segment_bytes < 1 or args.commit_interval < 0 or args.retention_bytes < 0 or args.retention_hours < 0:
+            raise ValueError("Journal sizes and intervals must not be negative.")
+        if args.backlog < 1:
+            raise ValueError("The listen backlog must be at least 1.")
+        if args.tls_key and not args.tls_cert:
+            raise ValueError("--tls-key needs --tls-cert.")
+        if (args.peer or args.node_id) and not args.peer_secret:
+            raise ValueError("Federation needs --peer-secret (or CHAT_PEER_SECRET) so peers can authenticate.")
+        if (args.handoff_socket or args.takeover) and (args.mode != "asyncio" or args.workers > 1):
+            raise ValueError("--handoff-socket and --takeover need --mode asyncio and a single worker.")
+        ActiveServer = create_server(args)
+    except (ValueError, OSError) as e:  # Includes unreadable TLS certificates (ssl.SSLError)
         logging.error(str(e))
         sys.exit(1)  # Exit with an error code
-    ActiveServer = ChatServer(server_ip, port)
-    ActiveServer.start()  # Start the server with proper backlog and thread
-
+    if args.workers > 1:
+        if ActiveServer.history is not None:
+            ActiveServer.history.close()  # Only built to validate args; workers journal to their own subdirectories
+        run_workers(args)  # Each worker builds its own ChatServer from args
+    else:
+        run_server(ActiveServer, args.mode)
 
 
 if __name__ == "__main__":
@@ -1,28 +1,95 @@
 from collections import deque
-import json
 from socket import AF_INET, SOCK_STREAM, socket
 import sys
 import logging
 import threading
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+from ChatCodec import MessageCodec
+from ChatFraming import encode_frame, iter_frames
+from ChatLogging import MESSAGE_LOGGER, setup_logging
 
+message_logger = logging.getLogger(MESSAGE_LOGGER)  # Per-message records; sampled and rate-limited
+codec = MessageCodec()  # Validates incoming messages; they are forwarded as received
 client_dict = {}  # Dictionary of connected clients
-lock = threading.Lock()  # Lock for thread-safe access to client_dict
+nickname_dict = {}  # Nickname -> client, for uniqueness checks and direct messages
+client_nicknames = {}  # Client -> its registered nickname
+lock = threading.RLock()  # Lock for thread-safe access to the client dictionaries (re-entered by rm_client during broadcast)
+NICKNAME_IN_USE_FRAME = encode_frame('{"type": "error", "message": "Nickname already in use"}')
 
 def broadcast_message(sender, message):
     """
     Broadcasts a message to all connected clients except the sender.
     """
+    frame = encode_frame(message)
     with lock:
-        for client, conn_socket in client_dict.items():
+        for client, conn_socket in list(client_dict.items()):
             if client != sender:
                 try:
-                    conn_socket.send(message.encode())
+                    conn_socket.sendall(frame)
                 except Exception as e:
                     logging.error(f'Failed to send message to client {client}: {str(e)}')
                     rm_client(client)  # Remove the client if an error occurs
 
+def send_error(conn_socket, text):
+    """
+    Sends an error message to one client.
+    """
+    conn_socket.sendall(encode_frame(codec.encode({"type": "error", "message": text})))
+
+def register_nickname(client, conn_socket, nickname):
+    """
+    Registers a client's nickname, refusing one that another client already uses.
+
+    Returns:
+        bool: False if the nickname is already in use.
+    """
+    with lock:
+        owner = nickname_dict.get(nickname)
+        if owner is not None and owner != client:
+            conn_socket.sendall(NICKNAME_IN_USE_FRAME)
+            logging.warning(f'Client {client} requested nickname {nickname}, which is already in use.')
+            return False
+        previous = client_nicknames.get(client)
+        if previous is not None:
+            del nickname_dict[previous]
+        nickname_dict[nickname] = client
+        client_nicknames[client] = nickname
+    logging.info(f'Client {client} registered nickname {nickname}.')
+    return True
+
+def check_sender(client, conn_socket, clientData):
+    """
+    Refuses a message from a client without a nickname, or one carrying another nickname than the sender's.
+
+    Returns:
+        bool: False if the message was refused with an error.
+    """
+    with lock:
+        nickname = client_nicknames.get(client)
+    if nickname is None:
+        send_error(conn_socket, 'Choose a nickname before sending messages')
+        return False
+    if str(clientData.get('nickname', nickname)) != nickname:
+        send_error(conn_socket, f'Messages must be sent under your nickname {nickname}')
+        return False
+    return True
+
+def send_direct(sender, message, recipient_nickname):
+    """
+    Sends a message to the one client registered under recipient_nickname, instead of broadcasting it.
+    """
+    with lock:
+        conn_socket = client_dict[sender]
+        recipient = nickname_dict.get(recipient_nickname)
+        if recipient is None:
+            send_error(conn_socket, f'No client is using the nickname {recipient_nickname}')
+            return
+        try:
+            client_dict[recipient].sendall(encode_frame(message))
+        except Exception as e:
+            logging.error(f'Failed to send message to client {recipient}: {str(e)}')
+            rm_client(recipient)
+
 def add_client(client, socket):
     """
     Adds a new client to the client dictionary.
@@ -39,6 +106,9 @@ def rm_client(client):
         if client in client_dict:
             client_dict[client].close()
             del client_dict[client]
+            nickname = client_nicknames.pop(client, None)
+            if nickname is not None:
+                del nickname_dict[nickname]
             logging.info(f'Client {client} disconnected successfully.')
 
 def client_handler(connectionSocket, addr):
@@ -47,15 +117,20 @@ def client_handler(connectionSocket, addr):
     """
     try:
         add_client(addr, connectionSocket)  # Add client on successful connection
-        while True:
-            clientEncoded = connectionSocket.recv(1024)
-            if not clientEncoded:
-                break
-            clientData = json.loads(clientEncoded.decode())
-            logging.info(f'Client {addr} sent message: {clientData}')
-            if clientData['type'] == 'disconnect':
+        for clientEncoded in iter_frames(connectionSocket):  # Ends when the client disconnects
+            msgType, clientData = codec.validate(clientEncoded)  # Raises CodecError for anything but a typed JSON object
+            message_logger.info('Client %s sent message: %s', addr, clientData)
+            if msgType == 'disconnect':
                 break
-            broadcast_message(addr, json.dumps(clientData))
+            if msgType == 'nickname' and clientData.get('nickname'):
+                if not register_nickname(addr, connectionSocket, str(clientData['nickname'])):
+                    continue  # Not announced; the client may try another nickname
+            elif not check_sender(addr, connectionSocket, clientData):
+                continue  # Forwarded as received, so it must not speak for someone else
+            elif msgType == 'direct':
+                send_direct(addr, clientEncoded, str(clientData.get('to')))
+                continue
+            broadcast_message(addr, clientEncoded)  # Pass-through: the original bytes, not a re-serialized copy
     except Exception as e:
         logging.error(f'An error occurred with client {addr}: {str(e)}')
     finally:
@@ -63,6 +138,7 @@ def client_handler(connectionSocket, addr):
         connectionSocket.close()
 
 if __name__ == "__main__":
+    setup_logging()  # Log calls only enqueue; a background thread writes them in batches
     if len(sys.argv) != 3:
         logging.error("Usage: python ChatServer.py <port> <server_ip>")
         sys.exit()
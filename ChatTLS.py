@@ -0,0 +1,215 @@
+# ChatTLS.py
+"""
+Optional TLS for the chat servers and clients.
+
+Servers load a certificate into server_context(); session tickets are on (TLS
+1.2 tickets and SESSION_TICKETS TLS 1.3 tickets per full handshake), so a
+client that reconnects resumes its session instead of paying for a full
+handshake. Clients use client_context(), a ResumingContext that remembers the
+last session per server and offers it on the next connection, both for
+blocking sockets and for asyncio streams.
+
+OpenSSL connections must not be read and written from two threads at once, but
+the thread-per-connection server and the blocking client do exactly that (a
+reader thread plus a writer). TLSSocket serializes the two directions on a
+non-blocking socket and waits for readiness outside its lock.
+
+The thread engine runs each server handshake on the new client's handler
+thread (server_handshake()), so the accept loop only accepts and established
+clients keep their own threads. The asyncio engine hands the context to the
+event loop, whose SSL transport handshakes without blocking but spends the
+handshake CPU on the loop; --workers spreads that over processes. Ticket keys
+belong to one process, so with --workers a session only resumes on the worker
+that issued it. TLS 1.3 resumption still does a key exchange, so it saves
+about a quarter of the server's handshake cost, not all of it.
+
+generate_self_signed() writes a throwaway certificate with the openssl command
+line tool, for tests and ChatBench.
+"""
+
+import os
+import select
+import socket
+import ssl
+import subprocess
+import threading
+
+HANDSHAKE_TIMEOUT = 10.0  # Seconds a client gets to complete the TLS handshake
+SESSION_TICKETS = 2  # TLS 1.3 tickets sent after each full handshake
+
+
+def server_context(certfile, keyfile=None):
+    """
+    Builds the server side TLS context.
+
+    Args:
+        certfile: PEM certificate chain.
+        keyfile: PEM private key (default: read from certfile).
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile, keyfile)
+    context.num_tickets = SESSION_TICKETS
+    return context
+
+
+class ResumingContext(ssl.SSLContext):
+    """
+    A client context that offers the last session seen from each server.
+
+    Sessions are kept per server hostname; remember() stores one after a
+    connection is up (TLS 1.3 tickets arrive after the handshake, so call it
+    once data has been received).
+    """
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT):
+        self.sessions = {}
+
+    def remember(self, server_hostname, ssl_object):
+        """Keeps ssl_object's session (an SSLSocket or SSLObject) for the next connection."""
+        session = ssl_object.session if ssl_object is not None else None
+        if session is not None and session.has_ticket:
+            self.sessions[server_hostname] = session
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None:
+            session = self.sessions.get(server_hostname)
+        return super().wrap_socket(sock, *args, server_hostname=server_hostname, session=session, **kwargs)
+
+    def wrap_bio(self, incoming, outgoing, *args, server_hostname=None, session=None, **kwargs):
+        if session is None:  # asyncio's SSL transport never passes one
+            session = self.sessions.get(server_hostname)
+        return super().wrap_bio(incoming, outgoing, *args, server_hostname=server_hostname, session=session, **kwargs)
+
+
+def client_context(cafile=None, verify=True):
+    """
+    Builds the client side TLS context.
+
+    Args:
+        cafile: Trust this PEM certificate (e.g. a self-signed server certificate) instead of the system store.
+        verify: Verify the server certificate and hostname; False accepts any certificate.
+    """
+    context = ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    elif cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    return context
+
+
+class TLSSocket:
+    """
+    A connected SSLSocket that one thread can read while another writes.
+
+    Every SSL call is made under a lock on a non-blocking socket; waiting for
+    the network happens outside the lock, so a blocked reader never holds up
+    the writer. Only the calls the chat engines use are provided.
+    """
+    __slots__ = ('ssl_socket', '_lock', '_readable', '_writable')
+
+    def __init__(self, ssl_socket):
+        self.ssl_socket = ssl_socket
+        self._lock = threading.Lock()
+        ssl_socket.setblocking(False)
+        self._readable = select.poll()  # poll, not select: server sockets often exceed FD_SETSIZE
+        self._readable.register(ssl_socket, select.POLLIN)
+        self._writable = select.poll()
+        self._writable.register(ssl_socket, select.POLLOUT)
+
+    @property
+    def session_reused(self):
+        return self.ssl_socket.session_reused
+
+    def recv(self, size):
+        while True:
+            with self._lock:
+                try:
+                    return self.ssl_socket.recv(size)
+                except ssl.SSLWantReadError:
+                    waiter = self._readable
+                except ssl.SSLWantWriteError:
+                    waiter = self._writable
+                except ssl.SSLZeroReturnError:
+                    return b''  # The peer closed the TLS session
+            waiter.poll()
+
+    def sendall(self, data):
+        view = memoryview(data)
+        sent = 0
+        while sent < len(view):
+            with self._lock:
+                try:
+                    sent += self.ssl_socket.send(view[sent:])
+                    continue
+                except ssl.SSLWantReadError:
+                    waiter = self._readable
+                except (ssl.SSLWantWriteError, BlockingIOError):
+                    waiter = self._writable
+            waiter.poll()
+
+    def shutdown(self, how):
+        socket.socket.shutdown(self.ssl_socket, how)  # TCP only; SSLSocket.shutdown would unwrap under the reader
+
+    def close(self):
+        self.ssl_socket.close()
+
+    def __getattr__(self, name):
+        return getattr(self.ssl_socket, name)  # setsockopt, fileno, getpeername, ...
+
+
+def server_handshake(context, sock, timeout=HANDSHAKE_TIMEOUT):
+    """
+    Runs the server side handshake on an accepted socket, blocking the calling thread only.
+
+    Returns:
+        TLSSocket: The established connection.
+
+    Raises:
+        OSError: If the handshake fails or times out (ssl.SSLError is an OSError).
+    """
+    ssl_socket = context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+    try:
+        ssl_socket.settimeout(timeout)
+        ssl_socket.do_handshake()
+    except OSError:
+        ssl_socket.close()  # wrap_socket() detached sock, so closing it would not release the descriptor
+        raise
+    return TLSSocket(ssl_socket)
+
+
+def client_handshake(context, sock, server_hostname):
+    """
+    Wraps a connected client socket, resuming the last session with this server if there is one.
+
+    Returns:
+        TLSSocket: The established connection.
+    """
+    ssl_socket = context.wrap_socket(sock, server_hostname=server_hostname)
+    return TLSSocket(ssl_socket)
+
+
+def generate_self_signed(directory, hostname='localhost', days=30):
+    """
+    Writes a self-signed EC certificate and key for hostname, localhost and 127.0.0.1.
+
+    Returns:
+        tuple: (certificate path, key path)
+
+    Raises:
+        RuntimeError: If the openssl tool is missing or fails.
+    """
+    certfile = os.path.join(directory, 'chat-cert.pem')
+    keyfile = os.path.join(directory, 'chat-key.pem')
+    command = ['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+               '-nodes', '-keyout', keyfile, '-out', certfile, '-days', str(days), '-subj', f'/CN={hostname}',
+               '-addext', f'subjectAltName=DNS:{hostname},DNS:localhost,IP:127.0.0.1']
+    try:
+        subprocess.run(command, check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError) as e:
+        raise RuntimeError(f'Could not generate a self-signed certificate: {str(e)}') from None
+    return certfile, keyfile
@@ -0,0 +1,313 @@
+# ChatTimers.py
+"""
+Connection heartbeats for ChatServer, driven by a hierarchical timer wheel.
+
+A dead peer is otherwise only noticed when recv() returns nothing or a send
+fails, so a half-open connection (the client vanished without a FIN) would hold
+its thread, registry slot and admission slot forever. HeartbeatMonitor pings
+every client that has been silent for the ping interval and disconnects it if
+nothing at all arrives within the ping timeout.
+
+Deadlines live in a TimerWheel instead of one timer per connection: each level
+is a ring of slots (dicts keyed by connection), level 0 one tick per slot and
+every higher level one full turn of the level below per slot. Scheduling,
+rescheduling and cancelling are a dict insert or delete; each tick empties one
+level 0 slot, and once per turn a higher level slot is redistributed into the
+levels below. Message handling only stores the arrival time on the client's
+record. When a connection's timer fires, the monitor compares that time with the
+deadline and, if the client has spoken since, moves the timer to the new
+deadline. Each client therefore costs about one wheel operation per ping
+interval, however many messages it sends.
+
+Run this module to see the cost with many connections:
+    python ChatTimers.py [--timers 100000]
+"""
+
+import argparse
+import logging
+import threading
+import time
+
+from ChatMetrics import CounterSet
+
+TICK = 0.1  # Seconds per level 0 slot; deadlines fire up to one tick late
+WHEEL_BITS = (8, 6, 6, 6)  # Slots per level as powers of two: 256 ticks, then 64 turns of the level below
+DEFAULT_PING_INTERVAL = 30.0  # Seconds of silence before a client is pinged
+DEFAULT_PING_TIMEOUT = 10.0  # Seconds a pinged client has to send anything before it is disconnected
+
+
+class Timer:
+    """One scheduled key and the wheel slot that holds it."""
+    __slots__ = ('key', 'expires', 'slot')
+
+    def __init__(self, key):
+        self.key = key
+        self.expires = 0  # Absolute tick
+        self.slot = None  # The slot dict holding this timer
+
+
+class TimerWheel:
+    """
+    A hierarchical timing wheel of keys and deadlines, one timer per key.
+
+    Not thread-safe; HeartbeatMonitor serializes access.
+
+    Args:
+        tick: Seconds per level 0 slot.
+        now: The current time on the clock deadlines are given in (default: time.monotonic()).
+    """
+
+    def __init__(self, tick=TICK, now=None):
+        self.tick = tick
+        self._levels = [[{} for _ in range(1 << bits)] for bits in WHEEL_BITS]
+        self._shifts = []
+        shift = 0
+        for bits in WHEEL_BITS:
+            self._shifts.append(shift)
+            shift += bits
+        self._span = 1 << shift  # Ticks covered by the whole wheel; later deadlines wait in the top level
+        self._current = int((time.monotonic() if now is None else now) / tick)  # Next tick to run
+        self._timers = {}  # key -> Timer
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, key):
+        return key in self._timers
+
+    def schedule(self, key, when):
+        """
+        Sets key's deadline, replacing any earlier one.
+
+        Args:
+            key: Any hashable object.
+            when: Time at which key expires; it is returned by the first advance() at or after it.
+        """
+        timer = self._timers.get(key)
+        if timer is None:
+            timer = self._timers[key] = Timer(key)
+        else:
+            del timer.slot[key]
+        timer.expires = -int(-when // self.tick)  # Round up so a timer never fires early
+        self._place(timer)
+
+    def cancel(self, key):
+        """Removes key's deadline, if it has one."""
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            del timer.slot[key]
+
+    def _place(self, timer):
+        expires = max(timer.expires, self._current)
+        delta = expires - self._current
+        if delta >= self._span:
+            expires = self._current + self._span - 1  # Parked at the far end; placed again when it cascades
+            delta = self._span - 1
+        for level, bits in enumerate(WHEEL_BITS):
+            shift = self._shifts[level]
+            if delta < 1 << (shift + bits):
+                break
+        slot = self._levels[level][(expires >> shift) & ((1 << bits) - 1)]
+        slot[timer.key] = timer
+        timer.slot = slot
+
+    def advance(self, now=None):
+        """
+        Runs every tick up to now.
+
+        Returns:
+            list: The keys whose deadlines have passed; they are no longer scheduled.
+        """
+        target = int((time.monotonic() if now is None else now) / self.tick)
+        levels = self._levels
+        expired = []
+        while self._current <= target:
+            current = self._current
+            index = current & ((1 << WHEEL_BITS[0]) - 1)
+            if not index:
+                self._cascade(current)
+            slot = levels[0][index]
+            if slot:
+                for key in slot:
+                    del self._timers[key]
+                expired.extend(slot)
+                slot.clear()
+            self._current = current + 1
+        return expired
+
+    def _cascade(self, current):
+        """Spreads the higher level slots that start at this tick over the levels below."""
+        for level in range(1, len(WHEEL_BITS)):
+            index = (current >> self._shifts[level]) & ((1 << WHEEL_BITS[level]) - 1)
+            slot = self._levels[level][index]
+            if slot:
+                timers = list(slot.values())
+                slot.clear()
+                for timer in timers:
+                    self._place(timer)
+            if index:
+                break  # Only a full turn of this level moves the next one
+
+
+class HeartbeatStats(CounterSet):
+    """Server-wide counters of what the heartbeat monitor did."""
+    FIELDS = ('pings_sent', 'pongs_received', 'reaped')
+
+
+class HeartbeatMonitor:
+    """
+    Pings silent clients and reaps the ones that stay silent.
+
+    Watched records need 'last_seen' and 'pinged' attributes (ChatRegistry.ClientRecord
+    has them); the server sets last_seen = time.monotonic() for every frame it receives.
+    Heartbeats are off when interval is 0.
+
+    Args:
+        interval: Seconds of silence after which a client is pinged.
+        timeout: Seconds a pinged client has to send anything before it is reaped.
+        ping: Called with a record to send it a ping.
+        reap: Called with a record to drop its connection; the server's usual disconnect
+            cleanup must then forget() it.
+        tick: Timer wheel resolution in seconds.
+    """
+
+    def __init__(self, interval=DEFAULT_PING_INTERVAL, timeout=DEFAULT_PING_TIMEOUT, ping=None, reap=None, tick=TICK):
+        if interval < 0 or timeout <= 0:
+            raise ValueError('The ping interval must not be negative and the ping timeout must be positive')
+        self.interval = interval
+        self.timeout = timeout
+        self.ping = ping
+        self.reap = reap
+        self.tick = tick
+        self.stats = HeartbeatStats()
+        self.wheel = TimerWheel(tick)
+        self._lock = threading.Lock()  # Taken on connect, disconnect and ticks, never per message
+        self._thread = None
+        self._timer = None  # asyncio.TimerHandle of the next tick with start_on()
+
+    def __len__(self):
+        return len(self.wheel)
+
+    def watch(self, record):
+        """Starts tracking a newly connected client."""
+        if not self.interval:
+            return
+        now = time.monotonic()
+        record.last_seen = now
+        record.pinged = 0.0
+        with self._lock:
+            self.wheel.schedule(record, now + self.interval)
+
+    def forget(self, record):
+        """Stops tracking a client (it disconnected or does not need heartbeats)."""
+        if not self.interval:
+            return
+        with self._lock:
+            self.wheel.cancel(record)
+
+    def advance(self, now=None):
+        """Handles every deadline that has passed; pings and reaps run after the lock is released."""
+        now = time.monotonic() if now is None else now
+        pings = []
+        reaps = []
+        with self._lock:
+            wheel = self.wheel
+            for record in wheel.advance(now):
+                pinged = record.pinged
+                if pinged > record.last_seen:  # Pinged and silent since
+                    if now >= pinged + self.timeout:
+                        reaps.append(record)
+                    else:
+                        wheel.schedule(record, pinged + self.timeout)
+                    continue
+                deadline = record.last_seen + self.interval
+                if now < deadline:  # Spoke since the timer was set
+                    wheel.schedule(record, deadline)
+                    continue
+                record.pinged = now
+                wheel.schedule(record, now + self.timeout)
+                pings.append(record)
+        for record in pings:
+            self.ping(record)
+        for record in reaps:
+            self.reap(record)
+        if pings:
+            self.stats.record('pings_sent', len(pings))
+        if reaps:
+            self.stats.record('reaped', len(reaps))
+
+    def start(self):
+        """Advances the wheel from a daemon thread (thread-per-connection engine)."""
+        if not self.interval or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='heartbeats', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick)
+            try:
+                self.advance()
+            except Exception as e:  # Keep ticking; one bad callback must not stop heartbeats for everyone
+                logging.error(f'Heartbeat tick failed: {str(e)}')
+
+    def start_on(self, loop):
+        """Advances the wheel from loop's callbacks (asyncio engine); ping and reap then run on the loop."""
+        if not self.interval or self._timer is not None:
+            return
+
+        def tick():
+            self._timer = loop.call_later(self.tick, tick)  # First, so a failing callback cannot stop the ticks
+            self.advance()
+
+        self._timer = loop.call_later(self.tick, tick)
+
+    def stop(self):
+        """Stops the ticks started by start_on(); start_on() resumes them."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the timer wheel with many connection deadlines.')
+    parser.add_argument('--timers', type=int, default=100000, help='Connection deadlines to track.')
+    args = parser.parse_args()
+
+    class Record:
+        __slots__ = ('last_seen', 'pinged')
+
+    records = [Record() for _ in range(args.timers)]
+    monitor = HeartbeatMonitor(DEFAULT_PING_INTERVAL, DEFAULT_PING_TIMEOUT, ping=lambda record: None,
+                               reap=lambda record: None)
+    started = time.perf_counter_ns()
+    for record in records:
+        monitor.watch(record)
+    watch_ns = (time.perf_counter_ns() - started) / args.timers
+
+    started = time.perf_counter_ns()
+    now = time.monotonic()
+    for _ in range(args.timers):
+        records[0].last_seen = now  # What the server does per received frame
+    touch_ns = (time.perf_counter_ns() - started) / args.timers
+
+    ticks = 100
+    started = time.perf_counter_ns()
+    for step in range(1, ticks + 1):
+        monitor.advance(now + step * TICK)  # Nothing is due yet: the steady-state cost of a tick
+    idle_tick_us = (time.perf_counter_ns() - started) / ticks / 1000
+
+    started = time.perf_counter_ns()
+    monitor.advance(now + DEFAULT_PING_INTERVAL + TICK)  # Every client is due for a ping at once
+    ping_all_ms = (time.perf_counter_ns() - started) / 1e6
+
+    started = time.perf_counter_ns()
+    for record in records:
+        monitor.forget(record)
+    forget_ns = (time.perf_counter_ns() - started) / args.timers
+    print(f'{args.timers} connections: watch {watch_ns:.0f}ns, per-message update {touch_ns:.0f}ns, '
+          f'forget {forget_ns:.0f}ns, idle tick {idle_tick_us:.1f}us, '
+          f'pinging all {ping_all_ms:.1f}ms ({monitor.stats["pings_sent"]} pings)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+# ChatWorkers.py
+"""
+Multi-process mode for ChatServer.
+
+The parent process runs a MessageBus on a Unix domain socket and spawns N worker
+processes. Every worker binds the same TCP port with SO_REUSEPORT, so the kernel
+spreads incoming clients across them, and publishes each room message it
+delivers locally to the bus. The bus relays it to every other worker, which
+delivers it to its own members of that room. With message history, chat
+messages are numbered by the bus instead: it gives each one the next message
+ID and sends it to every worker, the sender's included, so a client sees the
+same IDs whichever worker it reconnects to.
+
+The bus is also the one nickname directory of all workers: a worker claims a
+nickname from it before registering a client under that name, and direct
+messages for a client of another worker are routed through it.
+
+SIGTERM to the parent stops every worker; a worker that loses the bus (its
+parent is gone) stops as well.
+"""
+
+import itertools
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+from ChatBackpressure import make_policy
+from ChatFraming import encode_frame, iter_frames
+from ChatJournal import JournalReader, journal_epoch
+from ChatLogging import setup_logging_from_args
+from ChatOutbound import SocketConnection
+
+BUS_HIGH_WATERMARK = 64 * 1024 * 1024  # A worker may fall this far behind on the bus before relays are dropped
+BUS_LOW_WATERMARK = 16 * 1024 * 1024
+_FIELD_LENGTH = struct.Struct('!H')  # Length prefix of the two names in a bus message
+_MESSAGE_ID = struct.Struct('!Q')  # Prefix of the client message in a NUMBERED bus message
+WORKER_STOP_TIMEOUT = 5.0  # Seconds a terminated worker gets to commit its journal before it is killed
+
+# Bus message kinds (the first byte of every bus message)
+ROOM_MESSAGE = b'r'  # Room, origin, client message: relayed to every other worker
+SEQUENCE = b's'  # Room, origin, client message: the bus numbers it and sends it on as NUMBERED
+NUMBERED = b'i'  # Room, origin, message ID + client message: sent to every worker, the origin included
+CLAIM = b'c'  # Nickname, client token: a worker asks for a nickname for one of its clients
+GRANTED = b'g'  # Nickname, client token: the bus's answers to a claim
+REFUSED = b'n'
+RELEASE = b'x'  # Client token: the client left, its nickname is free again
+DIRECT = b'd'  # Nickname, sender token, client message: for the worker whose client has the nickname
+UNKNOWN_RECIPIENT = b'u'  # Nickname, sender token: no client of any worker has the nickname
+
+
+def encode_bus_message(kind, first, second='', payload=b''):
+    """
+    Packs a message kind, two names and an optional client message payload into one bus message.
+
+    Args:
+        kind: One of the bus message kinds, e.g. ROOM_MESSAGE.
+        first: The room name or nickname.
+        second: The origin of a room message or the client token.
+        payload: The client's message, as bytes.
+    """
+    first = first.encode()
+    second = second.encode()
+    return kind + _FIELD_LENGTH.pack(len(first)) + first + _FIELD_LENGTH.pack(len(second)) + second + payload
+
+
+def decode_bus_message(data):
+    """Reverses encode_bus_message, returning (kind, first, second, payload)."""
+    (length,) = _FIELD_LENGTH.unpack_from(data, 1)
+    start = 1 + _FIELD_LENGTH.size
+    first = data[start:start + length].decode()
+    start += length
+    (length,) = _FIELD_LENGTH.unpack_from(data, start)
+    start += _FIELD_LENGTH.size
+    end = start + length
+    return data[:1], first, data[start:end].decode(), data[end:]
+
+
+def _bus_policy():
+    return make_policy('drop-newest', BUS_HIGH_WATERMARK, BUS_LOW_WATERMARK)
+
+
+class MessageBus:
+    """
+    Relays bus messages between worker processes; runs in the parent.
+
+    Each worker link is a SocketConnection (so relays are queued and written by
+    a writer thread) plus a reader thread. A room message is framed once and
+    pushed to every link except the one it arrived on; a message to number gets
+    the next ID of the one sequence of all workers and is pushed to every link;
+    nickname claims and direct messages are answered from the nickname directory.
+
+    Args:
+        path: The Unix socket path to listen on.
+        first_id: The first message ID to hand out (after the workers' journals).
+    """
+
+    def __init__(self, path, first_id=1):
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+        self.links = []
+        self.lock = threading.Lock()
+        self._ids = itertools.count(first_id)
+        self._sequence_lock = threading.Lock()  # Held while pushing, so every link gets IDs in increasing order
+        self.nicknames = {}  # Nickname -> (link, client token) of the client using it, on any worker
+        self.owned = {}  # (link, client token) -> nickname
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen()
+
+    def serve_forever(self):
+        """Accepts worker links until the listener is closed."""
+        while True:
+            try:
+                sock, _ = self.listener.accept()
+            except OSError:
+                return
+            link = SocketConnection(sock, f'bus-link-{len(self.links)}', _bus_policy())
+            with self.lock:
+                self.links = self.links + [link]  # Copy-on-write so readers iterate without the lock
+            threading.Thread(target=self._relay, args=(link,), daemon=True).start()
+
+    def _relay(self, source):
+        try:
+            for payload in iter_frames(source.sock):
+                kind = payload[:1]
+                if kind == SEQUENCE:
+                    self._number(payload)
+                    continue
+                if kind != ROOM_MESSAGE:
+                    self._route(source, payload)
+                    continue
+                frame = encode_frame(payload)
+                for link in self.links:
+                    if link is not source:
+                        link.send(frame)
+        except OSError as e:
+            self.logger.error(f'Bus link {source.addr} failed: {str(e)}')
+        finally:
+            with self.lock:
+                self.links = [link for link in self.links if link is not source]
+                for owner in [owner for owner in self.owned if owner[0] is source]:  # The worker's clients are gone
+                    del self.nicknames[self.owned.pop(owner)]
+            source.close()
+
+    def _number(self, payload):
+        """Gives a room message the next message ID and sends it to every worker."""
+        _, room, origin, message = decode_bus_message(payload)
+        with self._sequence_lock:
+            msg_id = next(self._ids)
+            frame = encode_frame(encode_bus_message(NUMBERED, room, origin, _MESSAGE_ID.pack(msg_id) + message))
+            for link in self.links:
+                link.send(frame)
+
+    def _route(self, source, payload):
+        """Answers a nickname claim or release, or routes a direct message, from one worker link."""
+        kind, nickname, token, _ = decode_bus_message(payload)
+        owner = (source, token)
+        with self.lock:
+            if kind == RELEASE:
+                nickname = self.owned.pop(owner, None)
+                if nickname is not None:
+                    del self.nicknames[nickname]
+                return
+            holder = self.nicknames.get(nickname)
+            if kind == CLAIM:
+                granted = holder is None or holder == owner
+                if granted:
+                    previous = self.owned.get(owner)
+                    if previous is not None:
+                        del self.nicknames[previous]  # Renamed: the old nickname is free again
+                    self.nicknames[nickname] = owner
+                    self.owned[owner] = nickname
+                source.send(encode_frame(encode_bus_message(GRANTED if granted else REFUSED, nickname, token)))
+            elif kind == DIRECT:
+                if holder is None:
+                    source.send(encode_frame(encode_bus_message(UNKNOWN_RECIPIENT, nickname, token)))
+                else:
+                    holder[0].send(encode_frame(payload))
+
+    def close(self):
+        self.listener.close()
+        try:
+            os.unlink(self.path)
+            os.rmdir(os.path.dirname(self.path))
+        except OSError:
+            pass
+
+
+class BusLink:
+    """
+    A worker's connection to the parent's MessageBus.
+
+    Sending only enqueues, so it is safe from handler threads or the event loop.
+    A reader thread hands relayed and numbered room messages to the server's
+    deliver_relayed(), direct messages to deliver_direct() and unknown
+    recipients to direct_failed(), and calls back pending nickname claims.
+    """
+
+    def __init__(self, path, worker_id, server, retries=50):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        for attempt in range(retries):
+            try:
+                sock.connect(path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if attempt == retries - 1:
+                    raise
+                time.sleep(0.1)
+        self.worker_id = worker_id
+        self.server = server
+        self.connection = SocketConnection(sock, f'bus-{worker_id}', _bus_policy())
+        self._claims = {}  # Client token -> callback waiting for the answer to its nickname claim
+        self._claims_lock = threading.Lock()
+        self._closed = False  # Set once the bus is lost; claims are refused from then on
+        self._reader = threading.Thread(target=self._read_loop, name=f'bus-reader-{worker_id}', daemon=True)
+        self._reader.start()
+
+    def publish(self, room, payload, origin=None):
+        """Sends a locally delivered room message to every other worker (origin defaults to this worker)."""
+        origin = f'worker-{self.worker_id}' if origin is None else origin
+        self.connection.send(encode_frame(encode_bus_message(ROOM_MESSAGE, room, origin, payload)))
+
+    def sequence(self, room, payload, origin=None):
+        """Sends a chat message to be numbered by the bus; every worker, this one included, then delivers it."""
+        origin = f'worker-{self.worker_id}' if origin is None else origin
+        self.connection.send(encode_frame(encode_bus_message(SEQUENCE, room, origin, payload)))
+
+    def claim(self, nickname, token, callback):
+        """
+        Asks the bus for a nickname, so that no client of any worker uses it twice.
+
+        Args:
+            nickname: The nickname a client asked for.
+            token: The client's ID, as a string; a client holds at most one nickname.
+            callback: Called as callback(granted) from the reader thread once the bus answers.
+        """
+        with self._claims_lock:
+            if not self._closed:
+                self._claims[token] = callback
+                self.connection.send(encode_frame(encode_bus_message(CLAIM, nickname, token)))
+                return
+        callback(False)
+
+    def release(self, token):
+        """Frees the nickname of a client that left."""
+        self.connection.send(encode_frame(encode_bus_message(RELEASE, '', token)))
+
+    def send_direct(self, nickname, token, payload):
+        """Sends a direct message to the worker whose client uses nickname (token identifies the sender)."""
+        self.connection.send(encode_frame(encode_bus_message(DIRECT, nickname, token, payload)))
+
+    def _read_loop(self):
+        try:
+            for data in iter_frames(self.connection.sock):
+                kind, first, second, payload = decode_bus_message(data)
+                if kind == ROOM_MESSAGE:
+                    self.server.deliver_relayed(first, payload, second)
+                elif kind == NUMBERED:
+                    (msg_id,) = _MESSAGE_ID.unpack_from(payload)
+                    self.server.deliver_relayed(first, payload[_MESSAGE_ID.size:], second, msg_id)
+                elif kind == DIRECT:
+                    self.server.deliver_direct(first, payload)
+                elif kind == UNKNOWN_RECIPIENT:
+                    self.server.direct_failed(first, second)
+                else:
+                    with self._claims_lock:
+                        callback = self._claims.pop(second, None)
+                    if callback is not None:
+                        callback(kind == GRANTED)
+        except OSError as e:
+            logging.error(f'Worker {self.worker_id} lost the message bus: {str(e)}')
+        else:
+            logging.error(f'Worker {self.worker_id} lost the message bus')
+        finally:
+            with self._claims_lock:
+                self._closed = True
+                claims, self._claims = self._claims, {}
+            for callback in claims.values():
+                callback(False)  # Nobody can vouch for the nickname any more
+        os.kill(os.getpid(), signal.SIGTERM)  # Cut off from the other workers; stop like the parent would stop us
+
+
+def _terminate(signum, frame):
+    """SIGTERM handler: unwinds the main thread so the usual cleanup runs."""
+    raise SystemExit(128 + signum)
+
+
+def _worker_main(worker_id, args, bus_path, epoch):
+    """Entry point of a worker process: one ChatServer sharing the port via SO_REUSEPORT."""
+    from ChatServer import create_server, run_server  # Imported here to avoid a cycle with ChatServer.main
+
+    listener = setup_logging_from_args(args)  # Spawned workers start without the parent's logging setup
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        server = create_server(args, worker_id)
+        server.reuse_port = True
+        server.worker_id = worker_id
+        if server.history is not None:
+            server.history.epoch = epoch  # The bus numbers messages for all workers, so they share one sequence
+        server.bus = BusLink(bus_path, worker_id, server)
+        logging.info(f'Worker {worker_id} (pid {os.getpid()}) serving {args.server_ip}:{args.port}')
+        run_server(server, args.mode)  # Commits the journal however it ends
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    logging.info(f'Worker {worker_id} stopped')
+    listener.stop()  # os._exit() skips atexit, where the log writer is normally flushed
+    sys.stdout.flush()
+    os._exit(0)  # Handler threads of connected clients must not keep the worker alive
+
+
+def run_workers(args):
+    """
+    Runs args.workers ChatServer processes on one port, joined by a MessageBus.
+
+    Args:
+        args: The parsed ChatServer command line; every worker is built from it.
+    """
+    first_id = 1
+    epoch = os.urandom(8).hex()
+    if args.journal:  # Continue the message IDs of the last run
+        epoch = journal_epoch(args.journal)
+        for worker_id in range(args.workers):
+            directory = os.path.join(args.journal, f'worker-{worker_id}')
+            if os.path.isdir(directory):
+                first_id = max(first_id, JournalReader(directory).last_id() + 1)
+    bus_path = os.path.join(tempfile.mkdtemp(prefix='chatbus-'), 'bus.sock')
+    bus = MessageBus(bus_path, first_id)
+    threading.Thread(target=bus.serve_forever, name='message-bus', daemon=True).start()
+
+    context = multiprocessing.get_context('spawn')  # Workers must not inherit the bus threads
+    processes = [context.Process(target=_worker_main, args=(worker_id, args, bus_path, epoch), name=f'chat-worker-{worker_id}')
+                 for worker_id in range(args.workers)]
+    previous = signal.signal(signal.SIGTERM, _terminate)  # Stop the workers too rather than orphan them
+    for process in processes:
+        process.start()
+    print(f"Chat server is running with {args.workers} workers...")
+    try:
+        for process in processes:
+            process.join()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)  # A second SIGTERM must not cut the cleanup short
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + WORKER_STOP_TIMEOUT
+        for process in processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f'Worker {process.name} did not stop; killing it')
+                process.kill()
+                process.join()
+        bus.close()
+        signal.signal(signal.SIGTERM, previous)